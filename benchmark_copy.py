@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# Compare functions.cpdir() against cp -a on a synthetic tree shaped like linux-firmware:
+# a few thousand files in nested vendor dirs, mostly small with some large blobs, plus symlinks.
+
+import argparse
+import random
+import tempfile
+from time import perf_counter
+
+from functions import *
+
+
+def process_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", dest="files", type=int, default=4000, help="Number of files in the tree.")
+    parser.add_argument("--size", dest="size", type=int, default=1000, help="Total size of the tree in MB.")
+    parser.add_argument("--runs", dest="runs", type=int, default=3, help="Runs per copy method.")
+    parser.add_argument("--dir", dest="work_dir", default=None,
+                        help="Directory to run the benchmark in. Its filesystem decides if reflinks can be used.")
+    return parser.parse_args()
+
+
+def create_benchmark_tree(root: str, file_count: int, total_size: int) -> None:
+    random.seed(0)
+    # file sizes roughly follow linux-firmware: most files are a few kb, a few are several mb
+    weights = [random.paretovariate(1.2) for _ in range(file_count)]
+    scale = total_size / sum(weights)
+    for index, weight in enumerate(weights):
+        file_dir = f"{root}/vendor{index % 60}/chip{index % 7}"
+        mkdir(file_dir, create_parents=True)
+        with open(f"{file_dir}/fw{index}.bin", "wb") as file:
+            file.write(os.urandom(max(1, int(weight * scale))))
+        if index % 10 == 0:
+            os.symlink(f"fw{index}.bin", f"{file_dir}/fw{index}-link.bin")
+
+
+def time_copy(copy_function, src: str, dst_root: str, runs: int) -> float:
+    best_time = None
+    for run in range(runs):
+        dst = f"{dst_root}/run{run}"
+        start = perf_counter()
+        copy_function(src, dst)
+        bash("sync")
+        run_time = perf_counter() - start
+        best_time = run_time if best_time is None else min(best_time, run_time)
+        bash(f"rm -rf {dst}")
+    return best_time
+
+
+if __name__ == "__main__":
+    args = process_args()
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        print_status(f"Creating tree with {args.files} files, {args.size}mb")
+        create_benchmark_tree(f"{work_dir}/src", args.files, args.size * 1024 ** 2)
+        bash("sync")
+
+        cp_time = time_copy(lambda src, dst: bash(f"cp -a {src} {dst}"), f"{work_dir}/src", work_dir, args.runs)
+        cpdir_time = time_copy(cpdir, f"{work_dir}/src", work_dir, args.runs)
+
+    print_header(f"cp -a:  {cp_time:.2f}s ({args.size / cp_time:.0f}mb/s)")
+    print_header(f"cpdir:  {cpdir_time:.2f}s ({args.size / cpdir_time:.0f}mb/s)")
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Compare the archive formats of the image on the same raw image: compression ratio, compression time and the time
+# flash_image.py needs to decompress them. The raw image is a build output like eupneaos.bin.
+#   benchmark_formats.py eupneaos.bin
+
+import argparse
+import tempfile
+from time import perf_counter
+
+from flash_image import read_image
+from functions import *
+
+
+def process_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image", help="Raw image to compress.")
+    parser.add_argument("--jobs", dest="jobs", type=int, default=os.cpu_count() or 1,
+                        help="Frames of seekable zstd images that are decompressed in parallel.")
+    parser.add_argument("--dir", dest="work_dir", default=None, help="Directory for the compressed images.")
+    return parser.parse_args()
+
+
+def compress_xz(image: str, archive: str, options: list) -> None:
+    with open(image, "rb") as source, open(archive, "wb") as output:
+        subprocess.run(["xz", "-c", *options], stdin=source, stdout=output, check=True)
+
+
+def compress_zstd(image: str, archive: str, level: int) -> None:
+    compressor = SeekableZstdCompressor(archive, level=level)
+    with open(image, "rb") as source:
+        while data := source.read(ZSTD_SEEKABLE_FRAME_SIZE):
+            compressor.feed(data)
+    compressor.finish()
+
+
+def decompress_image(archive: str, jobs: int) -> None:
+    if archive.endswith(".rar"):
+        bash(f"rar p -inul {archive} > /dev/null")
+        return
+    for _ in read_image(archive, jobs):
+        pass
+
+
+# name, file extension, compress function
+FORMATS = [
+    ("xz -9 (release)", "xz", lambda image, archive: compress_xz(image, archive, ["-9", "-T0"])),
+    ("xz -9, 16mb blocks", "xz", lambda image, archive: compress_xz(image, archive, ["-9", "-T0",
+                                                                                    "--block-size=16MiB"])),
+    ("seekable zstd -19", "zst", lambda image, archive: compress_zstd(image, archive, 19)),
+    ("seekable zstd -12", "zst", lambda image, archive: compress_zstd(image, archive, 12)),
+]
+if shutil.which("rar"):
+    FORMATS.append(("rar -m5 (release)", "rar", lambda image, archive: bash(f"rar a -m5 -ep {archive} {image}")))
+
+
+if __name__ == "__main__":
+    args = process_args()
+    image_size = os.path.getsize(args.image)
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        for index, (name, extension, compress) in enumerate(FORMATS):
+            archive = f"{work_dir}/image{index}.bin.{extension}"
+            print_status(f"Compressing with {name}")
+            start = perf_counter()
+            compress(args.image, archive)
+            compress_time = perf_counter() - start
+            print_status(f"Decompressing {name}")
+            start = perf_counter()
+            decompress_image(archive, args.jobs)
+            decompress_time = perf_counter() - start
+            results.append((name, os.path.getsize(archive), compress_time, decompress_time))
+            rmfile(archive)
+
+    print_header(f"{'format':<22}{'size':>10}{'ratio':>8}{'compress':>12}{'decompress':>12}")
+    for name, size, compress_time, decompress_time in results:
+        print_header(f"{name:<22}{size / 1048576:>8.0f}mb{image_size / size:>8.2f}{compress_time:>11.1f}s"
+                     f"{decompress_time:>11.1f}s")
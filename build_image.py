@@ -1,29 +1,153 @@
 #!/usr/bin/env python3
 # This script is cloud oriented, therefore it is not very user-friendly.
 
+import abc
 import argparse
+import atexit
+import fcntl
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import queue
+import shlex
+import tarfile
+import uuid
+from time import perf_counter
 
 from functions import *
 
+# Space for everything installed on top of the base rootfs (system upgrade, KDE, firmware, eupnea kernel).
+# The image is sparse, so unused headroom is never allocated and compress_image() shrinks it away anyway
+PACKAGES_HEADROOM = 8 * 1024 ** 3
+# Everything in front of the rootfs partition: gpt, 2 kernel partitions and the ESP -> see prepare_image()
+ROOTFS_PART_OFFSET = 629 * 1024 ** 2
+# The same layout for images that are assembled from a staging directory -> see assemble_image()
+KERNEL_PART_OFFSETS = [1 * 1024 ** 2, 65 * 1024 ** 2]
+KERNEL_PART_SIZE = 64 * 1024 ** 2
+ESP_PART_OFFSET = 129 * 1024 ** 2
+ESP_PART_SIZE = 500 * 1024 ** 2
+# Room for the backup gpt at the end of the image
+IMAGE_TAIL_SIZE = 1024 ** 2
+# Free space that is added to the estimated size of the rootfs filesystem, on top of the reserved blocks
+ROOTFS_FS_HEADROOM = 64 * 1024 ** 2
+# The raw image is read once in chunks of this size and every chunk is handed to all artifact writers
+ARTIFACT_CHUNK_SIZE = 4 * 1024 ** 2
+# Max chunks queued per artifact writer -> the slowest writer throttles reading at 64mb of buffered data
+ARTIFACT_QUEUE_CHUNKS = 16
+# The eupnea kernel of each kernel type: github repo with the bzImage releases and the package in the eupnea repo
+KERNELS = {
+    "mainline": {"repo": "mainline-kernel", "package": "eupnea-mainline-kernel"},
+    "stable": {"repo": "chromeos-kernel", "package": "eupnea-chromeos-kernel"},
+}
+
+# Paths of the image that is built. A matrix build runs one process per variant image -> see build_variant_images()
+image_name = "eupneaos"
+rootfs_dir = "/mnt/eupneaos"
+# Downloads and other work files. Builds with --staging-dir keep them in the staging dir -> see __main__
+work_dir = "/tmp/eupneaos-build"
+kernel_dir = f"{work_dir}/eupneaos"
+# Key of the last base rootfs layer, the variant layers are cached on top of it. Passed on to the variant processes
+base_layer_key = None
+
 
 # parse arguments from the cli. Only for testing/advanced use. All other parameters are handled by cli_input.py
 def process_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--dev", dest="dev_build", default=False, help="Use latest dev build. May be unstable.")
-    parser.add_argument("--chromeos", dest="stable", default=False, help="Use chromeos stable kernel.")
+    parser.add_argument("--dev", dest="dev_build", action="store_true", default=False,
+                        help="Use latest dev build of the kernel. May be unstable.")
+    parser.add_argument("--chromeos", dest="stable", action="store_true", default=False,
+                        help="Use chromeos stable kernel.")
+    parser.add_argument("--image-formats", dest="image_formats", default="tar.xz,rar",
+                        help="Comma separated archive formats of the image: tar.xz, rar, zst (seekable zstd) and xz "
+                             "(block xz). zst and xz are written without a tar and can be flashed with "
+                             "flash_image.py, which decompresses them in parallel.")
+    parser.add_argument("--chunk-store", dest="chunk_store", default=None,
+                        help="Directory to add the chunks of the image to, for delta updates with delta_image.py. "
+                             "Without it, only the chunk manifest is written.")
+    parser.add_argument("--chunk-store-size", dest="chunk_store_size", type=int, default=20,
+                        help="Max size of the chunk store in GB.")
+    parser.add_argument("--matrix", dest="matrix", default=None,
+                        help="Build several images from one base rootfs, e.g. 'mainline,stable,mainline-nokde'. "
+                             "A variant is a kernel type, optionally without KDE.")
+    parser.add_argument("--variant", dest="variant", default=None, help=argparse.SUPPRESS)  # used by --matrix
+    parser.add_argument("--base-image", dest="base_image", default=None, help=argparse.SUPPRESS)  # used by --matrix
+    parser.add_argument("--base-layer-key", dest="base_layer_key", default=None,
+                        help=argparse.SUPPRESS)  # used by --matrix
+    parser.add_argument("--layer-cache", dest="layer_cache", default="/var/cache/eupneaos-layers",
+                        help="Directory for the rootfs layer snapshots.")
+    parser.add_argument("--no-layer-cache", dest="no_layer_cache", action="store_true", default=False,
+                        help="Run all rootfs build steps from scratch. New snapshots are still saved.")
+    parser.add_argument("--layer-cache-size", dest="layer_cache_size", type=int, default=30,
+                        help="Max size of the rootfs layer cache in GB.")
+    parser.add_argument("--package-cache", dest="package_cache", default="/var/cache/eupneaos-rpms",
+                        help="Host directory for downloaded rpms, shared between builds.")
+    parser.add_argument("--package-cache-size", dest="package_cache_size", type=int, default=20,
+                        help="Max size of the package cache in GB.")
+    parser.add_argument("--profile-dir", dest="profile_dir", default=".",
+                        help="Directory for the build timeline (build-profile.json) and trace (build-trace.json).")
+    parser.add_argument("--compare-profiles", dest="compare_profiles", nargs=2, metavar=("OLD", "NEW"),
+                        help="Compare the timelines of two builds and exit.")
+    parser.add_argument("--offline-repo", dest="offline_repo", default=None,
+                        help="Install all packages from this local repo directory instead of the online repos.")
+    parser.add_argument("--staging-dir", dest="staging_dir", default=None,
+                        help="Build the rootfs in a directory and assemble the image from it, without loop devices "
+                             "or mounts. Allows parallel builds on one host.")
+    parser.add_argument("--no-dedup", dest="no_dedup", action="store_true", default=False,
+                        help="Don't replace duplicate files in /usr with hardlinks.")
+    parser.add_argument("--verify-labels", dest="verify_labels", action="store_true", default=False,
+                        help="Check all SELinux labels of the finished rootfs and fail on wrong ones.")
     return parser.parse_args()
 
 
-# Create, mount, partition the img and flash the mainline eupnea kernel
-def prepare_image() -> str:
+# Download the kernel and the fedora rootfs. Through the download cache, repeated builds only download changed files
+@profiled
+def download_kernel(kernel_type: str) -> None:
+    print_status(f"Downloading {kernel_type} kernel")
+    mkdir(kernel_dir, create_parents=True)
+    release = "download/dev-build" if args.dev_build else "latest/download"
+    download_file(f"https://github.com/eupnea-linux/{KERNELS[kernel_type]['repo']}/releases/{release}/bzImage",
+                  f"{kernel_dir}/bzImage")
+
+
+@profiled
+def download_rootfs() -> None:
+    print_status("Downloading rootfs")
+    mkdir(work_dir, create_parents=True)
+    download_file("https://github.com/eupnea-linux/fedora-rootfs/releases/latest/download/fedora-rootfs-37.tar.xz",
+                  f"{work_dir}/rootfs.tar.xz")
+
+
+# Get the uncompressed size of the rootfs tarball from the xz index, without decompressing it
+def get_rootfs_size() -> int:
+    # robot mode output is tab separated -> "totals streams blocks compressed uncompressed ..."
+    totals = bash(f"xz --robot --list {work_dir}/rootfs.tar.xz | grep '^totals'")
+    return int(totals.split("\t")[4])
+
+
+# Print how much of the image is actually allocated on disk compared to its apparent size
+def print_image_usage(stage: str) -> None:
+    image_stat = os.stat(f"{image_name}.bin")
+    apparent = image_stat.st_size / 1048576
+    allocated = image_stat.st_blocks * 512 / 1048576  # st_blocks is always in 512 byte units
+    print_status(f"Image after {stage}: {apparent:.0f}mb apparent, {allocated:.0f}mb allocated")
+
+
+# Create, partition and mount the img. The kernels are flashed by flash_kernel()
+@profiled
+def prepare_image(root_partuuid: str) -> str:
     print_status("Preparing image")
 
-    try:
-        bash("fallocate -l 10G eupneaos.bin")
-    except subprocess.CalledProcessError:  # try fallocate, if it fails use dd
-        bash(f"dd if=/dev/zero of=eupneaos.bin status=progress bs=1024 count={10 * 1000000}")
+    # Size the image from the rootfs footprint instead of a fixed size and round it up to a full MiB
+    image_size = ROOTFS_PART_OFFSET + get_rootfs_size() + PACKAGES_HEADROOM
+    image_size = -(-image_size // 1048576) * 1048576
+    # Create a sparse image: truncate only sets the apparent size, no zeros are written to disk
+    rmfile(f"{image_name}.bin")
+    bash(f"truncate --size={image_size} {image_name}.bin")
+    print_image_usage("creation")
     print_status("Mounting empty image")
-    img_mnt = bash("losetup -f --show eupneaos.bin")
+    img_mnt = bash(f"losetup -f --show {image_name}.bin")
     if img_mnt == "":
         print_error("Failed to mount image")
         exit(1)
@@ -41,174 +165,936 @@ def prepare_image() -> str:
     bash(f"cgpt add -i 1 -t kernel -S 1 -T 5 -P 15 {img_mnt}")  # set kernel flags
     bash(f"cgpt add -i 2 -t kernel -S 1 -T 5 -P 1 {img_mnt}")  # set backup kernel flags
     bash(f"cgpt add -i 3 -t efi {img_mnt}")  # Set ESP type to efi
+    # the PARTUUID is chosen up front, so that the kernel can be signed with it while the image is prepared
+    bash(f"cgpt add -i 4 -u {root_partuuid} {img_mnt}")
 
     print_status("Formatting rootfs part")
     # Format boot
     bash(f"yes 2>/dev/null | mkfs.vfat -F32 {img_mnt}p3")  # 2>/dev/null is to supress yes broken pipe warning
     # Create rootfs ext4 partition
     bash(f"yes 2>/dev/null | mkfs.ext4 {img_mnt}p4")  # 2>/dev/null is to supress yes broken pipe warning
+    mount_image(img_mnt)
+
+    print_image_usage("formatting")
+    print_status("Partitioning complete")
+    return img_mnt
+
+
+def mount_image(img_mnt: str) -> None:
+    mkdir(rootfs_dir, create_parents=True)
     # Mount rootfs partition
-    bash(f"mount {img_mnt}p4 /mnt/eupneaos")
+    bash(f"mount {img_mnt}p4 {rootfs_dir}")
     # Mount esp
-    bash("mkdir -p /mnt/eupneaos/boot")
-    bash(f"mount {img_mnt}p3 /mnt/eupneaos/boot")
+    bash(f"mkdir -p {rootfs_dir}/boot")
+    bash(f"mount {img_mnt}p3 {rootfs_dir}/boot")
 
-    # get uuid of rootfs partition
-    rootfs_partuuid = bash(f"blkid -o value -s PARTUUID {img_mnt}p4")
-    # write PARTUUID to kernel flags and save it as a file
-    with open("configs/kernel.flags", "r") as flags:
-        temp_cmdline = flags.read().replace("insert_partuuid", rootfs_partuuid).strip()
-    with open("kernel.flags", "w") as config:
-        config.write(temp_cmdline)
 
-    print_status("Partitioning complete")
-    flash_kernel(f"{img_mnt}p1")
-    flash_kernel(f"{img_mnt}p2")  # flash reserve kernel
+# Attach and mount a clone of the base image of a matrix build. Every variant gets its own rootfs PARTUUID
+@profiled
+def attach_image(root_partuuid: str) -> str:
+    img_mnt = bash(f"losetup -f --show -P {image_name}.bin")
+    bash(f"cgpt add -i 4 -u {root_partuuid} {img_mnt}")
+    mount_image(img_mnt)
     return img_mnt
 
 
-def flash_kernel(kernel_part: str) -> None:
-    print_status("Flashing kernel to image")
-    # Sign kernel
+# write PARTUUID to kernel flags and save it as a file
+def write_kernel_flags(root_partuuid: str) -> None:
+    mkdir(kernel_dir, create_parents=True)
+    with open("configs/kernel.flags", "r") as flags:
+        temp_cmdline = flags.read().replace("insert_partuuid", root_partuuid).strip()
+    with open(f"{kernel_dir}/kernel.flags", "w") as config:
+        config.write(temp_cmdline)
+
+
+# Both kernel partitions get the same signed kernel -> it is only signed once
+@profiled
+def sign_kernel() -> None:
+    print_status("Signing kernel")
     bash("futility vbutil_kernel --arch x86_64 --version 1 --keyblock /usr/share/vboot/devkeys/kernel.keyblock"
-         + " --signprivate /usr/share/vboot/devkeys/kernel_data_key.vbprivk --bootloader kernel.flags" +
-         " --config kernel.flags --vmlinuz /tmp/eupneaos-build/bzImage --pack /tmp/eupneaos-build/bzImage.signed")
-    bash(f"dd if=/tmp/eupneaos-build/bzImage.signed of={kernel_part}")  # part 1 is the kernel partition
-    cpfile("/tmp/eupneaos-build/bzImage", "/mnt/eupneaos/boot/vmlinuz-eupnea")  # Copy kernel to /boot for uefi
+         + f" --signprivate /usr/share/vboot/devkeys/kernel_data_key.vbprivk --bootloader {kernel_dir}/kernel.flags"
+         + f" --config {kernel_dir}/kernel.flags --vmlinuz {kernel_dir}/bzImage --pack {kernel_dir}/bzImage.signed")
+
 
+# kernel_part is a partition device or the image itself with the offset of the partition
+@profiled
+def flash_kernel(kernel_part: str, offset: int = 0) -> None:
+    print_status(f"Flashing kernel to {kernel_part}")
+    bash(f"dd if={kernel_dir}/bzImage.signed of={kernel_part} oflag=seek_bytes seek={offset} conv=notrunc")
     print_status("Kernel flashed successfully")
 
 
-def get_uuids(img_mnt: str) -> list:
-    bootuuid = bash(f"blkid -o value -s PARTUUID {img_mnt}p3")
-    rootuuid = bash(f"blkid -o value -s PARTUUID {img_mnt}p4")
-    return [bootuuid, rootuuid]
+#######################################################################################
+#                                 DIRECT IMAGE ASSEMBLY                               #
+#######################################################################################
+# With --staging-dir, the rootfs is built in a plain directory. The partitions are then written straight into the
+# image file at their offsets: mkfs.vfat + mtools for the ESP, mkfs.ext4 -d for the rootfs and the gpt is written last.
+# The rootfs filesystem is created at its final size, so it doesn't have to be shrunk like a loop mounted one.
+
+def prepare_staging() -> None:
+    print_status(f"Preparing staging directory {rootfs_dir}")
+    if path_exists(rootfs_dir):
+        rmdir(rootfs_dir)
+    mkdir(f"{rootfs_dir}/boot", create_parents=True)
+
+
+# Clone the base rootfs of a matrix build. Every variant builds in its own copy
+@profiled
+def clone_base_rootfs(base_dir: str) -> None:
+    print_status(f"Cloning {base_dir} to {rootfs_dir}")
+    if path_exists(rootfs_dir):
+        rmdir(rootfs_dir, keep_dir=False)
+    # reflinks share all blocks with the base rootfs on btrfs or xfs
+    bash(f"cp -a --reflink=auto {base_dir} {rootfs_dir}")
+
+
+# Estimate the blocks and inodes ext4 needs for a directory tree. Hardlinked files are counted once
+def get_tree_usage(root: str, block_size: int = 4096) -> tuple:
+    blocks = 0
+    inodes = 1
+    seen_inodes = set()
+    stack = [root]
+    while stack:
+        dir_path = stack.pop()
+        dir_bytes = 24  # . and ..
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                dir_bytes += 8 + (len(entry.name.encode()) + 3) // 4 * 4
+                entry_stat = entry.stat(follow_symlinks=False)
+                if entry_stat.st_ino in seen_inodes:
+                    continue
+                if entry_stat.st_nlink > 1:
+                    seen_inodes.add(entry_stat.st_ino)
+                inodes += 1
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif stat.S_ISREG(entry_stat.st_mode):
+                    blocks += -(-entry_stat.st_size // block_size)
+                elif stat.S_ISLNK(entry_stat.st_mode) and entry_stat.st_size >= 60:  # short targets fit into the inode
+                    blocks += 1
+        dir_blocks = -(-dir_bytes // block_size)
+        blocks += dir_blocks + (1 if dir_blocks > 1 else 0)  # big directories get an htree index block
+    return blocks, inodes
+
+
+@profiled
+def write_esp(image: str) -> None:
+    print_status("Writing ESP partition")
+    bash(f"mkfs.vfat -F 32 -n ESP --offset {ESP_PART_OFFSET // 512} {image} {ESP_PART_SIZE // 1024}")
+    entries = [shlex.quote(entry.path) for entry in os.scandir(f"{rootfs_dir}/boot")]
+    if entries:
+        # mtools accesses the filesystem at an offset in the image (@@), without mounting it
+        bash(f"mcopy -s -p -m -i {image}@@{ESP_PART_OFFSET} {' '.join(entries)} ::/")
+    rmdir(f"{rootfs_dir}/boot")  # /boot is only the mount point of the ESP in the rootfs
+
+
+# Create the rootfs filesystem from the staging directory at the offset of the rootfs partition.
+# Returns the size of the filesystem
+@profiled
+def write_rootfs_partition(image: str) -> int:
+    print_status("Writing rootfs partition")
+    data_blocks, inodes = get_tree_usage(rootfs_dir)
+    inodes += inodes // 4 + 16384  # room for new files after the first boot
+    # inode tables (256 bytes per inode) and the journal (64mb for filesystems between 1 and 16gb)
+    metadata_blocks = inodes * 256 // 4096 + 16384
+    # group descriptors, bitmaps and the blocks reserved for online resizing are a few percent of the filesystem.
+    # 5% of the filesystem are reserved for root.
+    fs_size = int(((data_blocks + metadata_blocks) * 4096 * 1.02 + ROOTFS_FS_HEADROOM) / 0.95)
+    for _ in range(4):
+        fs_size = -(-fs_size // 1048576) * 1048576
+        result = run_command(f"mkfs.ext4 -q -F -b 4096 -N {inodes} -E offset={ROOTFS_PART_OFFSET},nodiscard "
+                             f"-d {rootfs_dir} {image} {fs_size // 1024}k", check=False)
+        if result.returncode == 0:
+            print_status(f"Rootfs filesystem: {fs_size / 1048576:.0f}mb for {data_blocks * 4096 / 1048576:.0f}mb "
+                         f"of data and {inodes} inodes")
+            return fs_size
+        if "Could not allocate" not in result.stderr:
+            raise subprocess.CalledProcessError(result.returncode, result.command, output=result.stdout,
+                                                stderr=result.stderr)
+        # the estimate was too small -> try again with more space
+        print_warning(f"Rootfs doesn't fit into {fs_size / 1048576:.0f}mb, retrying with more space")
+        fs_size = int(fs_size * 1.1)
+    raise RuntimeError(f"Rootfs doesn't fit into a {fs_size / 1048576:.0f}mb filesystem")
+
+
+# Write all partitions into a new image file and add the partition table
+@profiled
+def assemble_image(root_partuuid: str) -> None:
+    print_status("Assembling image")
+    image = f"{image_name}.bin"
+    rmfile(image)
+    bash(f"truncate --size={ROOTFS_PART_OFFSET} {image}")
+    for offset in KERNEL_PART_OFFSETS:
+        flash_kernel(image, offset)
+    write_esp(image)
+    rootfs_size = write_rootfs_partition(image)
+    image_size = ROOTFS_PART_OFFSET + rootfs_size + IMAGE_TAIL_SIZE
+    bash(f"truncate --size={image_size} {image}")
+    # format as per depthcharge requirements, but with a boot partition for uefi. Same layout as prepare_image()
+    write_gpt(image, [
+        {"name": "Kernel", "type": GPT_TYPE_CHROMEOS_KERNEL, "start": KERNEL_PART_OFFSETS[0], "size": KERNEL_PART_SIZE,
+         "attributes": get_chromeos_kernel_attributes(priority=15, tries=5, successful=True)},
+        {"name": "Kernel", "type": GPT_TYPE_CHROMEOS_KERNEL, "start": KERNEL_PART_OFFSETS[1], "size": KERNEL_PART_SIZE,
+         "attributes": get_chromeos_kernel_attributes(priority=1, tries=5, successful=True)},
+        {"name": "ESP", "type": GPT_TYPE_EFI, "start": ESP_PART_OFFSET, "size": ESP_PART_SIZE},
+        {"name": "Root", "type": GPT_TYPE_LINUX, "start": ROOTFS_PART_OFFSET, "size": rootfs_size,
+         "guid": root_partuuid},
+    ])
+    print_image_usage("assembly")
+    rmdir(rootfs_dir, keep_dir=False)  # everything is in the image now
+
+
+#######################################################################################
+#                                 DNF TRANSACTIONS                                    #
+#######################################################################################
+# configs/packages.json declares all package operations of the build in order. Every dnf transaction resolves
+# dependencies, reads the repo metadata and rewrites the rpm database, so the operations are merged into as few
+# transactions as possible and run with dnf shell.
+
+# All builds on a host share one dnf cache directory, which is bind mounted into the chroot while packages are
+# installed. dnf is told to keep the downloaded packages and verifies the checksum of every cached package against
+# the repo metadata before using it.
+OFFLINE_REPO_MOUNT = "/var/lib/eupneaos-offline-repo"
+
+
+# Remove truncated packages left behind by interrupted builds
+def check_package_cache(cache_dir: str) -> None:
+    for rpm in Path(cache_dir).glob("*/packages/*.rpm"):
+        with open(rpm, "rb") as file:
+            lead = file.read(4)
+        if lead != b"\xed\xab\xee\xdb":  # every rpm starts with this magic
+            print_warning(f"Removing broken package from cache: {rpm.name}")
+            rpm.unlink()
+
+
+# Get the installed packages of the rootfs as name-version-release.arch, which is how dnf names the cached rpms
+def get_installed_packages() -> set:
+    result = chroot_session.run("rpm -qa --queryformat '%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}\\n'")
+    return set(result.stdout.splitlines())
+
+
+# Mark the cached packages that are installed in the rootfs as used. rpm only reads them, and with relatime the atime
+# is updated at most once a day -> the mtime is the time of last use. Returns the number of marked packages
+def mark_used_packages(cache_dir: str, installed: set) -> int:
+    used_rpms = [rpm for rpm in Path(cache_dir).glob("*/packages/*.rpm") if rpm.name.removesuffix(".rpm") in installed]
+    for rpm in used_rpms:
+        os.utime(rpm)
+    return len(used_rpms)
+
+
+# Delete the least recently used packages until the cache fits into its size limit again, see mark_used_packages()
+def evict_package_cache(cache_dir: str, max_size: int) -> None:
+    rpms = [(rpm, rpm.stat()) for rpm in Path(cache_dir).glob("*/packages/*.rpm")]
+    total_size = sum(rpm_stat.st_size for _, rpm_stat in rpms)
+    for rpm, rpm_stat in sorted(rpms, key=lambda entry: entry[1].st_mtime):
+        if total_size <= max_size:
+            break
+        rpm.unlink()
+        total_size -= rpm_stat.st_size
+    print_status(f"Package cache: {total_size / 1048576:.0f}mb")
+
+
+@contextlib.contextmanager
+def package_cache(cache_dir: str, max_size: int):
+    mkdir(cache_dir, create_parents=True)
+    mkdir(f"{rootfs_dir}/var/cache/dnf", create_parents=True)
+    # dnf only locks the cache against other dnf processes in the same root -> parallel builds take turns
+    with open(f"{cache_dir}/.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        check_package_cache(cache_dir)
+        bash(f"mount --bind {cache_dir} {rootfs_dir}/var/cache/dnf")
+        try:
+            yield
+            mark_used_packages(cache_dir, get_installed_packages())
+        finally:
+            # unmount before anything can snapshot or clean /var/cache
+            bash(f"umount {rootfs_dir}/var/cache/dnf")
+            evict_package_cache(cache_dir, max_size)
+
+
+# Bind mount a pre-synced local repo into the chroot and install only from it
+@contextlib.contextmanager
+def offline_repo(repo_dir: str):
+    check_offline_repo(repo_dir)
+    mkdir(f"{rootfs_dir}{OFFLINE_REPO_MOUNT}", create_parents=True)
+    bash(f"mount --bind {get_full_path(repo_dir)} {rootfs_dir}{OFFLINE_REPO_MOUNT}")
+    try:
+        yield
+    finally:
+        bash(f"umount {rootfs_dir}{OFFLINE_REPO_MOUNT}")
+        rmdir(f"{rootfs_dir}{OFFLINE_REPO_MOUNT}", keep_dir=False)
+
+
+# dnf only finds out that a local repo has no metadata when it resolves the first transaction -> fail early
+def check_offline_repo(repo_dir: str) -> None:
+    if not path_exists(f"{repo_dir}/repodata/repomd.xml"):
+        raise FileNotFoundError(f"{repo_dir} is not a repo, run createrepo_c on it first")
+
+
+# In offline mode, .repo files and rpms referenced by url are expected in the root of the offline repo
+def get_offline_path(url: str) -> str:
+    if args.offline_repo is None or "://" not in url:
+        return url
+    return f"{OFFLINE_REPO_MOUNT}/{url.split('/')[-1]}"
+
+
+def get_dnf_options(transaction: dict) -> str:
+    options = transaction["options"] + ["--setopt=keepcache=True"]
+    if args.offline_repo is not None:
+        # packages from the offline repo were signature checked when the repo was synced
+        options += ["--disablerepo=*", f"--repofrompath=eupneaos-offline,{OFFLINE_REPO_MOUNT}",
+                    "--enablerepo=eupneaos-offline", "--setopt=eupneaos-offline.gpgcheck=False"]
+    return " ".join(options)
+
+
+# Merge the operations of the manifest into transactions while keeping the order constraints:
+# - add-repo operations run before the transaction they end up in
+# - operations with "adds_repos" (repo release rpms) end their transaction, because packages from the new repos can
+#   only be resolved once the repos are installed
+def plan_dnf_transactions(manifest: list) -> list:
+    transactions = []
+    current = {"repos": [], "operations": [], "options": []}
+    for operation in manifest:
+        if operation["action"] == "add-repo":
+            current["repos"].append(operation["repo"])
+            continue
+        if operation["action"] == "upgrade" and any(op["action"] == "upgrade" for op in current["operations"]):
+            continue  # only one system upgrade per transaction is needed
+        current["operations"].append(operation)
+        for option in operation.get("options", []):
+            if option not in current["options"]:
+                current["options"].append(option)
+        if operation.get("adds_repos", False):
+            transactions.append(current)
+            current = {"repos": [], "operations": [], "options": []}
+    if current["operations"] or current["repos"]:
+        transactions.append(current)
+    return transactions
+
+
+def get_dnf_shell_script(transaction: dict) -> str:
+    script = ""
+    for operation in transaction["operations"]:
+        packages = " ".join(shlex.quote(get_offline_path(package)) for package in operation.get("packages", []))
+        script += {"install": f"install {packages}\n",
+                   "group-install": f"group install {packages}\n",
+                   "remove": f"remove {packages}\n",
+                   "upgrade": "upgrade\n"}[operation["action"]]
+    return script + "run\n"
+
+
+# Record when dnf reaches the end of each phase of a transaction and collect its errors. Only the end of the output
+# is kept, the errors could be anywhere in it
+def track_dnf_output(phase_times: dict, errors: list):
+    def track_line(line: str, stream: str) -> None:
+        if stream == "stderr" and line.startswith("Error"):
+            errors.append(line.rstrip("\n"))
+        for phase, marker in [("resolved", "Dependencies resolved."), ("downloaded", "Running transaction check"),
+                              ("installed", "Complete!")]:
+            if phase not in phase_times and line.startswith(marker):
+                phase_times[phase] = perf_counter()
+
+    return track_line
+
+
+def run_dnf_transaction(transaction: dict) -> None:
+    for repo in transaction["repos"]:
+        chroot(f"dnf config-manager --add-repo {get_offline_path(repo)}")
+    if not transaction["operations"]:
+        return
+    with open(f"{rootfs_dir}/tmp/dnf-transaction", "w") as script:
+        script.write(get_dnf_shell_script(transaction))
+    phase_times = {"start": perf_counter()}
+    errors = []
+    result = chroot_session.run(f"dnf shell -y {get_dnf_options(transaction)} /tmp/dnf-transaction",
+                                line_callback=track_dnf_output(phase_times, errors), capture=False)
+    phase_times["end"] = perf_counter()
+    rmfile(f"{rootfs_dir}/tmp/dnf-transaction")
+    # dnf shell exits with 0 even if a command or the transaction failed -> check for errors in the output
+    if errors:
+        print_error("\n".join(errors))
+        raise subprocess.CalledProcessError(1, "dnf shell", output=result.stdout, stderr=result.stderr)
+
+    # phases dnf didn't print a marker for are counted towards the next phase
+    resolved = phase_times.get("resolved", phase_times["start"])
+    downloaded = phase_times.get("downloaded", resolved)
+    print_status(f"dnf transaction ({len(transaction['operations'])} operations): "
+                 f"resolve {resolved - phase_times['start']:.1f}s, download {downloaded - resolved:.1f}s, "
+                 f"install {phase_times['end'] - downloaded:.1f}s")
+
+
+@profiled
+def install_packages(manifest: list) -> None:
+    transactions = plan_dnf_transactions(manifest)
+    print_status(f"Installing packages in {len(transactions)} dnf transactions")
+    with contextlib.ExitStack() as mounts:
+        mounts.enter_context(package_cache(args.package_cache, args.package_cache_size * 1024 ** 3))
+        if args.offline_repo is not None:
+            print_status(f"Installing packages from offline repo {args.offline_repo}")
+            mounts.enter_context(offline_repo(args.offline_repo))
+        for transaction in transactions:
+            run_dnf_transaction(transaction)
 
 
 # Make a bootable rootfs
+@profiled
 def bootstrap_rootfs() -> None:
-    bash("tar xfp /tmp/eupneaos-build/rootfs.tar.xz -C /mnt/eupneaos --checkpoint=.10000")
+    print_status("Extracting rootfs")
+    extract_file(f"{work_dir}/rootfs.tar.xz", rootfs_dir)
     # Create a temporary resolv.conf for internet inside the chroot
-    mkdir("/mnt/eupneaos/run/systemd/resolve", create_parents=True)  # dir doesnt exist coz systemd didn't run
+    mkdir(f"{rootfs_dir}/run/systemd/resolve", create_parents=True)  # dir doesnt exist coz systemd didn't run
     cpfile("/etc/resolv.conf",
-           "/mnt/eupneaos/run/systemd/resolve/stub-resolv.conf")  # copy hosts resolv.conf to chroot
+           f"{rootfs_dir}/run/systemd/resolve/stub-resolv.conf")  # copy hosts resolv.conf to chroot
 
+    # Install all packages, including the mainline eupnea kernel, see configs/packages.json. KDE is installed by
+    # install_kde()
     # TODO: Replace generic repos with own EupneaOS repos
-    chroot("dnf install --releasever=37 --allowerasing -y generic-logos generic-release generic-release-common")
-    # Add eupnea repo
-    chroot("dnf config-manager --add-repo https://eupnea-linux.github.io/rpm-repo/eupnea.repo")
-    # Add RPMFusion repos
-    chroot("dnf install -y https://download1.rpmfusion.org/nonfree/fedora/rpmfusion-nonfree-release-37.noarch.rpm")
-    chroot("dnf install -y https://download1.rpmfusion.org/free/fedora/rpmfusion-free-release-37.noarch.rpm")
-    chroot("dnf update --refresh -y")  # update repos
-    chroot("dnf upgrade -y")  # upgrade the whole system
-
-    # Install hardware support packages
-    chroot("dnf group install -y 'Hardware Support'")
-    chroot("dnf group install -y 'Common NetworkManager Submodules'")
-    chroot("dnf install -y linux-firmware")
-    chroot("dnf install -y eupnea-utils eupnea-system")  # install eupnea packages
+    with open("configs/packages.json", "r") as manifest:
+        install_packages(json.load(manifest))
 
 
+@profiled
 def configure_rootfs() -> None:
     # copy previously downloaded firmware
     print_status("Copying google firmware")
-    cpdir("linux-firmware", "/mnt/eupneaos/lib/firmware")
+    cpdir("linux-firmware", f"{rootfs_dir}/lib/firmware", exclude=[".git"])
 
     print_status("Configuring liveuser")
     chroot("useradd --create-home --shell /bin/bash liveuser")  # add user
     chroot("usermod -aG wheel liveuser")  # add user to wheel
     chroot('echo "liveuser:eupneaos" | chpasswd')  # set password to eupneaos
-    # set up automatic login on boot for temp-user
-    with open("/mnt/eupneaos/etc/sddm.conf", "a") as sddm_conf:
-        sddm_conf.write("\n[Autologin]\nUser=liveuser\nSession=plasma.desktop\n")
-
     # copy preset eupnea settings file for postinstall scripts
-    cpfile("configs/eupnea.json", "/mnt/eupneaos/etc/eupnea.json")
+    cpfile("configs/eupnea.json", f"{rootfs_dir}/etc/eupnea.json")
 
     print_status("Fixing sleep")
     # disable hibernation aka S4 sleep, READ: https://eupnea-linux.github.io/docs/chromebook/bootlock
     # TODO: Fix S4 sleep
-    mkdir("/mnt/eupneaos/etc/systemd/")  # just in case systemd path doesn't exist
-    with open("/mnt/eupneaos/etc/systemd/sleep.conf", "a") as conf:
+    mkdir(f"{rootfs_dir}/etc/systemd/")  # just in case systemd path doesn't exist
+    with open(f"{rootfs_dir}/etc/systemd/sleep.conf", "a") as conf:
         conf.write("SuspendState=freeze\nHibernateState=freeze\n")
 
-    # Remove stock fedora kernel
-    chroot("dnf remove kernel -y")
-
-    # Install eupnea kernel, modules and headers are installed automatically as dependencies
-    chroot("dnf install -y eupnea-mainline-kernel")
-
     # systemd-resolved.service needed to create /etc/resolv.conf link. Not enabled by default for some reason
     chroot("systemctl enable systemd-resolved")
 
-    # Append lines to fstab
-    with open("/mnt/eupneaos/etc/fstab", "a") as fstab:
-        fstab.write(f"PARTUUID={uuids[1]} / ext4 rw,relatime 0 1")
-
     # Install systemd-bootd
     # bootctl needs some paths mounted, arch-chroot does that automatically
-    bash('arch-chroot /mnt/eupneaos bash -c "bootctl install --esp-path=/boot"')
-    # Configure loader
-    with open("configs/sysdboot-eupnea.conf", "r") as conf:
-        temp_conf = conf.read().replace("insert_partuuid", uuids[1])
-    with open("configs/sysdboot-eupnea.conf", "w") as conf:
-        conf.write(temp_conf)
-    cpfile("configs/sysdboot-eupnea.conf", "/mnt/eupneaos/boot/loader/entries/eupnea.conf")
-    with open("/mnt/eupneaos/boot/loader/loader.conf", "w") as conf:
+    # With --staging-dir, /boot is a plain directory that only becomes the ESP in assemble_image() -> relax the checks
+    bash(f'arch-chroot {rootfs_dir} bash -c "SYSTEMD_RELAX_ESP_CHECKS=1 bootctl install --esp-path=/boot"')
+    with open(f"{rootfs_dir}/boot/loader/loader.conf", "w") as conf:
         conf.write("default eupnea")
 
 
-def customize_kde() -> None:
-    # Install KDE
-    chroot("dnf group install -y 'KDE Plasma Workspaces'")
+# KDE is only installed into the variants that use it, see configs/kde-packages.json. Cached as a variant layer
+@profiled
+def install_kde() -> None:
+    with open("configs/kde-packages.json", "r") as manifest:
+        install_packages(json.load(manifest))
+    # set up automatic login on boot for temp-user
+    with open(f"{rootfs_dir}/etc/sddm.conf", "a") as sddm_conf:
+        sddm_conf.write("\n[Autologin]\nUser=liveuser\nSession=plasma.desktop\n")
+
     # Set system to boot to gui
     chroot("systemctl set-default graphical.target")
 
+
+# Runs in every KDE variant, even if KDE was restored from the layer cache
+@profiled
+def customize_kde() -> None:
     # Set kde ui settings
     print_status("Setting General UI settings")
-    mkdir("/mnt/eupneaos/home/liveuser/.config")
-    cpfile("configs/kde-configs/kwinrc", "/mnt/eupneaos/home/liveuser/.config/kwinrc")  # set general kwin settings
-    cpfile("configs/kde-configs/kcminputrc", "/mnt/eupneaos/home/liveuser/.config/kcminputrc")  # set touchpad settings
+    mkdir(f"{rootfs_dir}/home/liveuser/.config")
+    cpfile("configs/kde-configs/kwinrc", f"{rootfs_dir}/home/liveuser/.config/kwinrc")  # set general kwin settings
+    cpfile("configs/kde-configs/kcminputrc", f"{rootfs_dir}/home/liveuser/.config/kcminputrc")  # set touchpad settings
     chroot("chown -R liveuser:liveuser /home/liveuser/.config")  # set permissions
 
     print_status("Installing global kde theme")
     # Installer needs to be run from within chroot
-    cpdir("eupneaos-theme", "/mnt/eupneaos/tmp/eupneaos-theme")
+    cpdir("eupneaos-theme", f"{rootfs_dir}/tmp/eupneaos-theme", exclude=[".git"])
     # run installer script for global kde theme from chroot
     chroot("cd /tmp/eupneaos-theme && bash /tmp/eupneaos-theme/install.sh")
 
     # apply global dark theme
 
 
-def relabel_files() -> None:
-    # Fedora requires all files to be relabeled for SELinux to work
-    # If this is not done, SELinux will prevent users from logging in
-    print_status("Relabeling files for SELinux")
+# The base rootfs comes with the mainline kernel -> other kernels replace it in one dnf transaction
+@profiled
+def install_kernel(kernel_type: str) -> None:
+    if kernel_type == "mainline":
+        return
+    print_status(f"Replacing mainline kernel with {kernel_type} kernel")
+    install_packages([{"action": "remove", "packages": [KERNELS["mainline"]["package"]]},
+                      {"action": "install", "packages": [KERNELS[kernel_type]["package"]]}])
+
+
+# Everything that changes with every build, even if the rootfs layers were restored from the cache:
+# the kernel in the ESP and the PARTUUID of the rootfs partition
+@profiled
+def finalize_rootfs(root_partuuid: str) -> None:
+    cpfile(f"{kernel_dir}/bzImage", f"{rootfs_dir}/boot/vmlinuz-eupnea")  # Copy kernel to /boot for uefi
+
+    # Append lines to fstab
+    with open(f"{rootfs_dir}/etc/fstab", "a") as fstab:
+        fstab.write(f"PARTUUID={root_partuuid} / ext4 rw,relatime 0 1")
+
+    # Configure loader
+    with open("configs/sysdboot-eupnea.conf", "r") as conf:
+        temp_conf = conf.read().replace("insert_partuuid", root_partuuid)
+    with open(f"{rootfs_dir}/boot/loader/entries/eupnea.conf", "w") as conf:
+        conf.write(temp_conf)
+
+
+#######################################################################################
+#                                  SELINUX LABELS                                     #
+#######################################################################################
+# Fedora requires all files to be labeled for SELinux to work. If this is not done, SELinux will prevent users from
+# logging in. The labels are applied by the image's own setfiles with the image's file_contexts, inside the chroot.
+# Every rootfs layer is labeled before it is snapshotted, so restored layers are already labeled and each build only
+# labels what changed since the last labeled state. That state is a manifest of relative path -> [inode, ctime].
+# Mtimes are not enough: rpm sets them from the package headers, so a reinstalled file keeps its old mtime.
+# Any write, rename over, chmod or xattr change updates the ctime or the inode, and neither can be set from userspace.
+
+# Read the policy type from the selinux config of the rootfs
+def get_file_contexts() -> str:
+    policy_type = "targeted"
+    with open(f"{rootfs_dir}/etc/selinux/config", "r") as file:
+        for line in file:
+            if line.startswith("SELINUXTYPE="):
+                policy_type = line.strip().split("=", 1)[1]
+    return f"/etc/selinux/{policy_type}/contexts/files/file_contexts"
 
-    # copy /proc files needed for fixfiles
-    mkdir("/mnt/eupneaos/proc/self")
-    cpfile("configs/selinux/mounts", "/mnt/eupneaos/proc/self/mounts")
-    open("/mnt/eupneaos/proc/self/mountinfo", "w").close()  # create empty /proc/self/mountinfo
 
-    # copy /sys files needed for fixfiles
-    # mkdir("/mnt/eupneaos/sys/fs/selinux/initial_contexts/", create_parents=True)
-    # cpfile("configs/selinux/unlabeled", "/mnt/eupneaos/sys/fs/selinux/initial_contexts/unlabeled")
+# Mount points in the rootfs are not labeled, e.g. the esp is vfat and mounted at /boot while the layers are built
+def get_label_excludes() -> list:
+    return [entry.name for entry in os.scandir(rootfs_dir)
+            if entry.is_dir(follow_symlinks=False) and os.path.ismount(entry.path)]
 
-    # Backup original selinux
-    cpfile("/mnt/eupneaos/usr/sbin/fixfiles", "/mnt/eupneaos/usr/sbin/fixfiles.bak")
-    # Copy patched fixfiles script
-    cpfile("configs/selinux/fixfiles", "/mnt/eupneaos/usr/sbin/fixfiles")
 
-    chroot("/sbin/fixfiles restore")
+def get_label_manifest(excludes: list) -> dict:
+    entries = {}
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(f"{rootfs_dir}/{rel_dir}") as dir_entries:
+            for entry in dir_entries:
+                rel_path = f"{rel_dir}{entry.name}"
+                entry_stat = entry.stat(follow_symlinks=False)
+                is_dir = entry.is_dir(follow_symlinks=False)
+                entries[rel_path] = [entry_stat.st_ino, entry_stat.st_ctime_ns, is_dir]
+                if is_dir and rel_path not in excludes:
+                    stack.append(f"{rel_path}/")
+    return {"entries": entries, "excludes": excludes}
 
-    # Restore original fixfiles script
-    cpfile("/mnt/eupneaos/usr/sbin/fixfiles.bak", "/mnt/eupneaos/usr/sbin/fixfiles")
-    rmfile("/mnt/eupneaos/usr/sbin/fixfiles.bak")
+
+# Get the paths that have to be labeled again. setfiles labels directories recursively -> new directories are
+# labeled as a whole and their children are skipped
+def get_changed_paths(previous: dict, current: dict) -> list:
+    changed = []
+    new_dir = None
+    # sorted by components, so that the children of a directory directly follow it
+    for rel_path in sorted(current["entries"], key=lambda path: path.split("/")):
+        inode, ctime, is_dir = current["entries"][rel_path]
+        if (new_dir is not None and rel_path.startswith(new_dir)) or rel_path in current["excludes"]:
+            continue
+        old = previous["entries"].get(rel_path)
+        if old is None or old[0] != inode or rel_path in previous["excludes"]:
+            changed.append(rel_path)
+            if is_dir:
+                new_dir = f"{rel_path}/"
+        elif old[1] != ctime and not is_dir:
+            # a directory's ctime changes with its entries, but its own label only depends on its path
+            changed.append(rel_path)
+    return changed
+
+
+@profiled
+def relabel_rootfs(previous_manifest: dict = None) -> dict:
+    start = perf_counter()
+    excludes = get_label_excludes()
+    manifest = get_label_manifest(excludes)
+    file_contexts = get_file_contexts()
+    exclude_options = "".join(f" -e /{exclude}" for exclude in excludes)
+    # -F resets the whole context, -T 0 labels with one thread per cpu
+    setfiles = f"setfiles -F -T 0{exclude_options} {file_contexts}"
+
+    changed = None if previous_manifest is None else get_changed_paths(previous_manifest, manifest)
+    # new file contexts can change the label of any file
+    contexts_dir = os.path.dirname(file_contexts)[1:]
+    if changed is None or any(path.startswith(contexts_dir) for path in changed):
+        print_status("Relabeling all files for SELinux")
+        chroot(f"{setfiles} /")
+        labeled_paths = len(manifest["entries"])
+    elif changed:
+        print_status(f"Relabeling {len(changed)} changed paths for SELinux")
+        # setfiles reads one path per line -> the rare name with a newline is labeled through its parent directory
+        paths = sorted({"/" + "/".join(itertools.takewhile(lambda part: "\n" not in part, path.split("/")))
+                        for path in changed})
+        with open(f"{rootfs_dir}/tmp/relabel-paths", "w") as file:
+            file.write("".join(f"{path}\n" for path in paths))
+        chroot(f"{setfiles} -f /tmp/relabel-paths")
+        rmfile(f"{rootfs_dir}/tmp/relabel-paths")
+        labeled_paths = len(paths)
+    else:
+        print_status("SELinux labels are up to date")
+        return manifest
+    manifest = get_label_manifest(excludes)  # labeling changed the ctimes
+    print_status(f"Labeled {labeled_paths} paths in {perf_counter() - start:.1f}s")
+    return manifest
+
+
+# Check all labels against the file contexts without changing them
+@profiled
+def verify_labels() -> None:
+    print_status("Verifying SELinux labels")
+    exclude_options = "".join(f" -e /{exclude}" for exclude in get_label_excludes())
+    result = chroot_session.run(f"setfiles -n -v -F -T 0{exclude_options} {get_file_contexts()} /")
+    mismatches = [line for line in (result.stdout + result.stderr).splitlines()
+                  if line.startswith(("Would relabel", "Relabeled"))]
+    if mismatches:
+        print("\n".join(mismatches[:20]))
+        print_error(f"{len(mismatches)} files have wrong SELinux labels")
+        raise RuntimeError("SELinux label verification failed")
+    print_status("All SELinux labels are correct")
+
+
+#######################################################################################
+#                                ROOTFS LAYER CACHE                                   #
+#######################################################################################
+# Every build step below is cached as a snapshot of the whole rootfs (including the mounted ESP). The key of a layer
+# is a hash of the previous layer key, the source of the step function and of all functions it calls (i.e. all
+# commands it runs) and all host files the step reads. Package updates from the repos don't change the key -> use
+# --no-layer-cache to pick them up. Layers that weren't used for the longest are evicted, see evict_layer_cache().
+# The variant layers are built on top of the last base layer, only in the variants that need them.
+# The rootfs lives on the loop mounted image, so the snapshots can't be reflinks into the cache and are tarballs.
+# Bump the version when the snapshot contents change for all layers. Since version 2 the snapshots are labeled
+LAYER_VERSION = 2
+ROOTFS_LAYERS = [
+    (bootstrap_rootfs, ["{work_dir}/rootfs.tar.xz", "configs/packages.json"]),
+    (configure_rootfs, ["linux-firmware", "configs/eupnea.json"]),
+]
+KDE_LAYER = (install_kde, ["configs/kde-packages.json"])
+
+
+# Add a file or a whole directory to a layer hash. name replaces the path in the hash
+def hash_layer_input(sha256, path: Path, name: str = None) -> None:
+    sha256.update((name or path.as_posix()).encode())
+    if path.joinpath(".git").exists():
+        # hashing git checkouts like linux-firmware would take longer than needed -> use the commit + local changes
+        sha256.update(bash(f"git -C {path} rev-parse HEAD").encode())
+        sha256.update(bash(f"git -C {path} status --porcelain").encode())
+    elif path.is_dir():
+        for child in sorted(path.iterdir()):
+            hash_layer_input(sha256, child)
+    else:
+        with open(path, "rb") as file:
+            while chunk := file.read(1048576):
+                sha256.update(chunk)
+
+
+# Get the source of a step and of every function of the build scripts it calls, directly or through other functions
+def get_step_sources(step) -> list:
+    sources = {}
+    pending = [step]
+    while pending:
+        function = inspect.unwrap(pending.pop())  # the function itself, not the @profiled wrapper
+        name = f"{function.__module__}.{function.__qualname__}"
+        if name in sources:
+            continue
+        sources[name] = inspect.getsource(function)
+        # nested functions and lambdas have their own code objects
+        codes = [function.__code__]
+        while codes:
+            code = codes.pop()
+            codes += [const for const in code.co_consts if inspect.iscode(const)]
+            for global_name in code.co_names:
+                value = function.__globals__.get(global_name)
+                if inspect.isfunction(value) and value.__module__ in [__name__, "functions"]:
+                    pending.append(value)
+    return [sources[name] for name in sorted(sources)]
+
+
+def get_layer_key(parent_key: str, step, inputs: list) -> str:
+    sha256 = hashlib.sha256(parent_key.encode())
+    for source in get_step_sources(step):
+        sha256.update(source.encode())
+    for step_input in inputs:
+        # inputs in the work dir are hashed by their unresolved path -> builds with different work dirs share layers
+        hash_layer_input(sha256, Path(step_input.format(work_dir=work_dir)), name=step_input)
+    return sha256.hexdigest()
+
+
+@profiled
+def save_layer(cache_dir: str, key: str) -> None:
+    start = perf_counter()
+    # parallel builds can reach the same layer at the same time -> only one of them writes it, the lock also makes
+    # the temp file safe to share. A temp file left behind by a killed build is overwritten by the next one
+    with open(f"{cache_dir}/{key}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if path_exists(f"{cache_dir}/{key}.tar.zst"):
+            print_status(f"Rootfs layer {key[:12]} was saved by another build")
+            return
+        # write to a temp file first, so that an interrupted snapshot is never restored
+        bash(f"tar -C {rootfs_dir} --xattrs --xattrs-include='*' --acls --numeric-owner -I 'zstd -T0 -3' "
+             f"-cpf {cache_dir}/{key}.tar.zst.tmp .")
+        os.replace(f"{cache_dir}/{key}.tar.zst.tmp", f"{cache_dir}/{key}.tar.zst")
+    print_status(f"Saved rootfs layer {key[:12]} in {perf_counter() - start:.1f}s")
+
+
+@profiled
+def restore_layer(cache_dir: str, key: str) -> None:
+    start = perf_counter()
+    os.utime(f"{cache_dir}/{key}.tar.zst")  # mark the layer as used for evict_layer_cache()
+    bash(f"tar -C {rootfs_dir} --xattrs --xattrs-include='*' --acls --numeric-owner -I 'zstd -T0' "
+         f"-xpf {cache_dir}/{key}.tar.zst")
+    print_status(f"Restored rootfs layer {key[:12]} in {perf_counter() - start:.1f}s")
+
+
+# Remove everything from the rootfs before a variant layer is restored onto it, so that files that were removed while
+# the layer was built are gone too. /boot may be the mounted ESP -> only its contents are removed
+def clear_rootfs() -> None:
+    with os.scandir(rootfs_dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                rmdir(entry.path, keep_dir=entry.name == "boot")
+            else:
+                rmfile(entry.path, force=True)
+
+
+# Delete the least recently used layers until the cache fits into its size limit again
+def evict_layer_cache(cache_dir: str, max_size: int) -> None:
+    layers = [(layer, layer.stat()) for layer in Path(cache_dir).glob("*.tar.zst")]
+    total_size = sum(layer_stat.st_size for _, layer_stat in layers)
+    for layer, layer_stat in sorted(layers, key=lambda entry: entry[1].st_mtime):
+        if total_size <= max_size:
+            break
+        print_status(f"Evicting rootfs layer {layer.name[:12]}")
+        layer.unlink(missing_ok=True)  # a build that is restoring it keeps reading the open file
+        total_size -= layer_stat.st_size
+    print_status(f"Layer cache: {total_size / 1048576:.0f}mb")
+
+
+# Run the rootfs build steps, starting after the newest layer that is already cached.
+# Returns the key of the last layer and the label manifest of the rootfs, see relabel_rootfs()
+def build_rootfs_layers(cache_dir: str, use_cache: bool) -> tuple:
+    mkdir(cache_dir, create_parents=True)
+    keys = []
+    key = f"v{LAYER_VERSION}"
+    for step, inputs in ROOTFS_LAYERS:
+        key = get_layer_key(key, step, inputs)
+        keys.append(key)
+
+    # every key includes all previous keys -> the newest cached layer already contains all steps before it
+    first_step = 0
+    label_manifest = None
+    if use_cache:
+        for index in reversed(range(len(keys))):
+            if path_exists(f"{cache_dir}/{keys[index]}.tar.zst"):
+                restore_layer(cache_dir, keys[index])
+                # snapshots are labeled -> the restored rootfs is the last labeled state
+                label_manifest = get_label_manifest(get_label_excludes())
+                first_step = index + 1
+                break
+    for index in range(len(ROOTFS_LAYERS)):
+        step = ROOTFS_LAYERS[index][0]
+        if index < first_step:
+            print_status(f"Skipping {step.__name__}, restored from layer cache")
+            continue
+        step()
+        label_manifest = relabel_rootfs(label_manifest)
+        save_layer(cache_dir, keys[index])
+    return keys[-1], label_manifest
+
+
+# Run a variant step on the base rootfs or restore its snapshot. Returns the label manifest of the rootfs
+def build_variant_layer(cache_dir: str, use_cache: bool, parent_key: str, step, inputs: list,
+                        label_manifest: dict) -> dict:
+    key = get_layer_key(parent_key, step, inputs)
+    if use_cache and path_exists(f"{cache_dir}/{key}.tar.zst"):
+        clear_rootfs()
+        restore_layer(cache_dir, key)
+        return get_label_manifest(get_label_excludes())
+    step()
+    label_manifest = relabel_rootfs(label_manifest)
+    save_layer(cache_dir, key)
+    return label_manifest
+
+
+# Consumes the chunks of the raw image in its own thread. Subclasses implement write() and optionally close()
+class ArtifactWriter(abc.ABC):
+    def __init__(self, name: str):
+        self.name = name
+        self.sha256 = hashlib.sha256()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+        self.error = None
+        self._queue = queue.Queue(maxsize=ARTIFACT_QUEUE_CHUNKS)
+        self._thread = Thread(target=self._consume, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def put(self, chunk) -> None:  # None marks the end of the image
+        self._queue.put(chunk)
+
+    def join(self) -> None:
+        self._thread.join()
+
+    @abc.abstractmethod
+    def write(self, chunk: bytes) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def _consume(self) -> None:
+        start = perf_counter()
+        while (chunk := self._queue.get()) is not None:
+            if self.error is not None:
+                continue  # keep draining the queue after a failure, otherwise the reader would block forever
+            try:
+                self.write(chunk)
+                self.bytes_in += len(chunk)
+            except Exception as error:
+                self.error = error
+        try:
+            self.close()
+        except Exception as error:
+            # a failing compressor shows up as a broken pipe first, its exit status is the more useful error
+            if self.error is None or isinstance(self.error, BrokenPipeError):
+                self.error = error
+        self.seconds = perf_counter() - start
+
+
+# Hashes the raw image itself
+class ChecksumWriter(ArtifactWriter):
+    def write(self, chunk: bytes) -> None:
+        self.sha256.update(chunk)
+
+
+# Pipes the raw image into a compressor. If the compressor writes the archive to stdout, it is hashed on the fly,
+# otherwise the finished archive is hashed after the compressor exits
+class CompressorWriter(ArtifactWriter):
+    def __init__(self, name: str, command: str, to_stdout: bool = True, header: bytes = b"", trailer: bytes = b""):
+        super().__init__(name)
+        self.command = command
+        self.to_stdout = to_stdout
+        self.header = header
+        self.trailer = trailer
+        self._process = None
+        self._reader = None
+
+    def start(self) -> None:
+        rmfile(self.name)  # rar would add to an existing archive instead of replacing it
+        self._process = subprocess.Popen(self.command, shell=True, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE if self.to_stdout else subprocess.DEVNULL)
+        if self.to_stdout:
+            self._reader = Thread(target=self._read_archive, daemon=True)
+            self._reader.start()
+        self._process.stdin.write(self.header)
+        super().start()
+
+    def write(self, chunk: bytes) -> None:
+        self._process.stdin.write(chunk)
+
+    def close(self) -> None:
+        with contextlib.suppress(BrokenPipeError):
+            if self.error is None:
+                self._process.stdin.write(self.trailer)
+            self._process.stdin.close()
+        if self._reader is not None:
+            self._reader.join()
+        if self._process.wait() != 0:
+            raise subprocess.CalledProcessError(self._process.returncode, self.command)
+        if not self.to_stdout:
+            with open(self.name, "rb") as archive:
+                while data := archive.read(ARTIFACT_CHUNK_SIZE):
+                    self.sha256.update(data)
+                    self.bytes_out += len(data)
+
+    def _read_archive(self) -> None:
+        with open(self.name, "wb") as archive:
+            while data := self._process.stdout.read(ARTIFACT_CHUNK_SIZE):
+                self.sha256.update(data)
+                archive.write(data)
+                self.bytes_out += len(data)
+
+
+# Splits the raw image into content defined chunks for delta updates, see delta_image.py. Only chunks that are not in
+# the store yet are added, so a store shared between builds grows by the changed chunks of every build
+class ChunkIndexWriter(ArtifactWriter):
+    def __init__(self, name: str, store: str):
+        super().__init__(name)
+        self._indexer = ChunkIndexer(store)
+
+    def write(self, chunk: bytes) -> None:
+        self._indexer.feed(chunk)
+
+    def close(self) -> None:
+        manifest = json.dumps(self._indexer.finish()).encode()
+        with open(self.name, "wb") as file:
+            file.write(manifest)
+        self.sha256.update(manifest)
+        self.bytes_out = len(manifest)
+
+
+# Writes the raw image as seekable zstd without a tar around it, see flash_image.py
+class SeekableZstdWriter(ArtifactWriter):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._compressor = SeekableZstdCompressor(name)
+        self.sha256 = self._compressor.sha256
+
+    def write(self, chunk: bytes) -> None:
+        self._compressor.feed(chunk)
+
+    def close(self) -> None:
+        self._compressor.finish()
+        self.bytes_out = self._compressor.compressed_size
+
+
+# Build the tar framing around the image, so that xz can be fed the image directly without running tar
+def get_tar_framing(image_path: str) -> tuple:
+    image_stat = os.stat(image_path)
+    tar_info = tarfile.TarInfo("./" + Path(image_path).name)
+    tar_info.size = image_stat.st_size
+    tar_info.mtime = int(image_stat.st_mtime)
+    tar_info.mode = 0o644
+    header = tar_info.tobuf(format=tarfile.GNU_FORMAT)
+    # pad the image to a full tar block and end the archive with 2 empty blocks
+    trailer = bytes(-image_stat.st_size % tarfile.BLOCKSIZE) + bytes(2 * tarfile.BLOCKSIZE)
+    # tar archives are always padded to a full record
+    trailer += bytes(-(len(header) + image_stat.st_size + len(trailer)) % tarfile.RECORDSIZE)
+    return header, trailer
+
+
+# Read the image only once and fan out every chunk to all artifact writers, which run in parallel
+def write_artifacts(image_path: str, writers: list) -> None:
+    start = perf_counter()
+    for writer in writers:
+        writer.start()
+    with open(image_path, "rb") as image:
+        while chunk := image.read(ARTIFACT_CHUNK_SIZE):
+            for writer in writers:
+                writer.put(chunk)
+    for writer in writers:
+        writer.put(None)
+    for writer in writers:
+        writer.join()
+
+    for writer in writers:
+        speed = writer.bytes_in / 1048576 / max(writer.seconds, 0.001)
+        print_status(f"{writer.name}: {writer.bytes_in / 1048576:.0f}mb in, {writer.bytes_out / 1048576:.0f}mb out, "
+                     f"{writer.seconds:.1f}s, {speed:.1f}mb/s")
+    print_status(f"All artifacts written in {perf_counter() - start:.1f}s")
+    for writer in writers:
+        if writer.error is not None:
+            print_error(f"Failed to write {writer.name}")
+            raise writer.error
 
 
 # Shrink image to actual size
-def compress_image(img_mnt: str) -> None:
+@profiled
+def shrink_image(img_mnt: str) -> None:
     print_status("Shrinking image")
     bash(f"e2fsck -fpv {img_mnt}p4")  # Force check filesystem for errors
     bash(f"resize2fs -f -M {img_mnt}p4")
@@ -220,77 +1106,321 @@ def compress_image(img_mnt: str) -> None:
     # EFI partition is always the same size -> sector amount: 1024000 * 512 => 524288000 bytes
     actual_fs_in_bytes += 524288000
     actual_fs_in_bytes += 20971520  # add 20mb for linux to be able to boot properly
-    bash(f"truncate --size={actual_fs_in_bytes} ./eupneaos.bin")
+    bash(f"truncate --size={actual_fs_in_bytes} ./{image_name}.bin")
+    # the root partition still ends at the old end of the image and the backup gpt was cut off -> shrink the partition
+    # to the filesystem and write the backup gpt to the new end
+    resize_gpt_partition(f"{image_name}.bin", 4, -(-block_count * 4096 // 1048576) * 1048576)
+    print_image_usage("shrinking")
+
 
-    # compress image to tar. Tars are smaller but the native file manager on chromeos cant uncompress them
-    # These are stored as backups in the GitHub releases
-    bash("tar -cv -I 'xz -9 -T0' -f ./eupneaos.bin.tar.xz ./eupneaos.bin")
+@profiled
+def compress_image() -> None:
+    print_status("Compressing image and calculating sha256sums")
+    tar_header, tar_trailer = get_tar_framing(f"{image_name}.bin")
+    image_formats = args.image_formats.split(",")
+    writers = [ChecksumWriter(f"{image_name}.bin")]
+    if "tar.xz" in image_formats:
+        # Tars are smaller but the native file manager on chromeos cant uncompress them
+        # These are stored as backups in the GitHub releases
+        writers.append(CompressorWriter(f"{image_name}.bin.tar.xz", "xz -9 -T0", header=tar_header,
+                                        trailer=tar_trailer))
+    if "rar" in image_formats:
+        # Rar archives are bigger, but natively supported by the ChromeOS file manager
+        # These are uploaded as artifacts and then manually uploaded to a cloud storage
+        # rar can't write archives to stdout -> the finished archive is hashed afterwards
+        writers.append(CompressorWriter(f"{image_name}.bin.rar", f"rar a -m5 -si{image_name}.bin {image_name}.bin.rar",
+                                        to_stdout=False))
+    if "zst" in image_formats:
+        # Independent frames, decompressed in parallel by flash_image.py and by far the fastest to decompress
+        writers.append(SeekableZstdWriter(f"{image_name}.bin.zst"))
+    if "xz" in image_formats:
+        # Independent xz blocks, decompressed in parallel by xz 5.4+ and pixz
+        writers.append(CompressorWriter(f"{image_name}.bin.xz", "xz -9 -T0 --block-size=16MiB"))
+    # Chunk manifest + store: users with an older image only download the changed chunks
+    writers.append(ChunkIndexWriter(f"{image_name}.bin.chunks.json", args.chunk_store))
+    write_artifacts(f"{image_name}.bin", writers)
+    if args.chunk_store is not None:
+        store_size = evict_chunk_store(args.chunk_store, args.chunk_store_size * 1024 ** 3)
+        print_status(f"Chunk store: {store_size / 1048576:.0f}mb")
 
-    # Rar archives are bigger, but natively supported by the ChromeOS file manager
-    # These are uploaded as artifacts and then manually uploaded to a cloud storage
-    bash("rar a eupneaos.bin.rar -m5 eupneaos.bin")
+    # same format as sha256sum, so that the file can still be checked with sha256sum -c
+    with open(f"{image_name}.sha256", "w") as file:
+        file.write("".join(f"{writer.sha256.hexdigest()}  {writer.name}\n" for writer in writers))
 
-    print_status("Calculating sha256sums")
-    # Calculate sha256sum sums
-    with open("eupneaos.sha256", "w") as file:
-        file.write(bash("sha256sum eupneaos.bin eupneaos.bin.tar.xz "
-                        "eupneaos.bin.rar"))
+
+# Block hashes and merkle roots of every partition, for checking a flashed device or a download with
+# "flash_image.py check" and locating a corruption
+@profiled
+def write_block_manifest() -> None:
+    print_status("Hashing image blocks")
+    manifest = build_block_manifest(f"{image_name}.bin")
+    with open(f"{image_name}.bin.blocks.json", "w") as file:
+        json.dump(manifest, file)
+    for partition in manifest["partitions"]:
+        print_status(f"Partition {partition['index']} ({partition['name']}): {len(partition['leaves'])} blocks, "
+                     f"root {partition['root']}")
 
 
 def chroot(command: str) -> None:
-    bash(f'chroot /mnt/eupneaos /bin/bash -c "{command}"')  # always print output
+    chroot_session.run(command, capture=False)  # always print output
+
+
+#######################################################################################
+#                                    BUILD STEPS                                      #
+#######################################################################################
+
+# A variant is a kernel type, optionally with "-nokde" for an image without KDE, e.g. "stable-nokde"
+def parse_variant(name: str) -> dict:
+    kernel_type, _, suffix = name.partition("-")
+    if kernel_type not in KERNELS or suffix not in ["", "nokde"]:
+        raise ValueError(f"Unknown image variant: {name}")
+    return {"name": name, "kernel": kernel_type, "kde": suffix != "nokde"}
+
+
+# Build the rootfs layers that all variants share. One shell inside the chroot runs all chroot commands
+def build_base_rootfs() -> dict:
+    global chroot_session, base_layer_key
+    with ChrootSession(rootfs_dir) as chroot_session:
+        base_layer_key, label_manifest = build_rootfs_layers(args.layer_cache, use_cache=not args.no_layer_cache)
+    evict_layer_cache(args.layer_cache, args.layer_cache_size * 1024 ** 3)
+    return label_manifest
+
+
+# Customize, finalize and label the base rootfs for one variant
+def build_variant_rootfs(variant: dict, root_partuuid: str, label_manifest: dict = None) -> None:
+    global chroot_session
+    if label_manifest is None:  # a clone of the base image -> its labels are up to date
+        label_manifest = get_label_manifest(get_label_excludes())
+    with ChrootSession(rootfs_dir) as chroot_session:
+        if variant["kde"]:  # KDE doesn't depend on the kernel -> all KDE variants share one layer
+            label_manifest = build_variant_layer(args.layer_cache, not args.no_layer_cache, base_layer_key,
+                                                 *KDE_LAYER, label_manifest)
+            evict_layer_cache(args.layer_cache, args.layer_cache_size * 1024 ** 3)
+        install_kernel(variant["kernel"])
+        if variant["kde"]:
+            customize_kde()
+        finalize_rootfs(root_partuuid)
+        if args.staging_dir is None:
+            print_image_usage("customization")
+            # unmount boot before relabeling, so that the /boot mount point is labeled too
+            bash(f"umount -f {rootfs_dir}/boot")
+        relabel_rootfs(label_manifest)
+        if args.verify_labels:
+            verify_labels()
+
+
+# Identical files under /usr share their data, e.g. firmware from the linux-firmware package and the linux-firmware
+# checkout, or theme files. Runs after labeling, only files with the same label are linked
+@profiled
+def dedup_rootfs() -> None:
+    if args.no_dedup:
+        return
+    print_status("Deduplicating rootfs")
+    start = perf_counter()
+    replaced_files, saved_bytes = dedup_tree(f"{rootfs_dir}/usr")
+    print_status(f"Replaced {replaced_files} duplicate files with hardlinks, saved {saved_bytes / 1048576:.0f}mb "
+                 f"in {perf_counter() - start:.1f}s")
+
+
+# Clean image of temporary files and unmount it
+def clean_rootfs() -> None:
+    rmdir(f"{rootfs_dir}/tmp")
+    rmdir(f"{rootfs_dir}/var/tmp")
+    rmdir(f"{rootfs_dir}/var/cache")
+    rmdir(f"{rootfs_dir}/proc")
+    rmdir(f"{rootfs_dir}/run")
+    rmdir(f"{rootfs_dir}/sys")
+    rmdir(f"{rootfs_dir}/lost+found")
+    rmdir(f"{rootfs_dir}/dev")
+    rmfile(f"{rootfs_dir}/.stop_progress")
+    # the files of the finished rootfs, to compare builds with tree_manifest.py diff
+    entry_count, total_size = write_tree_manifest(rootfs_dir, f"{image_name}.files.jsonl")
+    print_status(f"Rootfs contains {entry_count} entries, {total_size / 1048576:.0f}mb of files")
+    if args.staging_dir is not None:  # nothing is mounted, assemble_image() reads the directory
+        return
+
+    bash("sync")  # write all pending changes to image
+    # Discard freed blocks -> the loop device punches holes into the image instead of keeping deleted data around
+    bash(f"fstrim -v {rootfs_dir}")
+    print_image_usage("cleanup")
+
+    # Force unmount image
+    bash(f"umount -f {rootfs_dir}")
+    sleep(5)  # wait for umount to finish
+
+
+# Release the loop device once the artifacts are written
+def detach_image(img_mnt: str) -> None:
+    bash(f"losetup -d {img_mnt}")
+
+
+# Leave no mounts or loop devices behind if the build fails
+def teardown_image() -> None:
+    if os.path.ismount(f"{rootfs_dir}/boot"):
+        bash(f"umount -l {rootfs_dir}/boot")
+    if os.path.ismount(rootfs_dir):
+        bash(f"umount -l {rootfs_dir}")
+    # the loop device may have been attached before prepare_image() failed -> look it up by the image
+    for line in bash(f"losetup -j {image_name}.bin").splitlines():
+        bash(f"losetup -d {line.split(':')[0]}")
+
+
+# Unmount the finished base rootfs of a matrix build, so that it can be cloned for the variants
+def detach_base_image(img_mnt: str) -> None:
+    bash(f"umount -f {rootfs_dir}/boot")
+    bash(f"fstrim -v {rootfs_dir}")  # keep the clones sparse
+    bash(f"umount -f {rootfs_dir}")
+    bash(f"losetup -d {img_mnt}")
+
+
+# Clone the base image and build a variant from it in its own process with its own mount and loop device.
+# With a staging directory, the variant process clones the base rootfs itself
+@profiled
+def build_variant_image(variant: dict) -> None:
+    variant_image = f"eupneaos-{variant['name']}"
+    print_status(f"Building {variant_image}")
+    command = [sys.executable, os.path.abspath(__file__), "--variant", variant["name"],
+               f"--package-cache={args.package_cache}", f"--package-cache-size={args.package_cache_size}",
+               f"--layer-cache={args.layer_cache}", f"--layer-cache-size={args.layer_cache_size}",
+               f"--base-layer-key={base_layer_key}",
+               f"--profile-dir={args.profile_dir}/{variant['name']}", f"--image-formats={args.image_formats}"]
+    if args.dev_build:
+        command.append("--dev")
+    if args.verify_labels:
+        command.append("--verify-labels")
+    if args.no_dedup:
+        command.append("--no-dedup")
+    if args.no_layer_cache:
+        command.append("--no-layer-cache")
+    if args.chunk_store is not None:
+        command += [f"--chunk-store={args.chunk_store}", f"--chunk-store-size={args.chunk_store_size}"]
+    if args.offline_repo is not None:
+        command.append(f"--offline-repo={args.offline_repo}")
+    if args.staging_dir is not None:
+        command += [f"--staging-dir={args.staging_dir}", f"--base-image={rootfs_dir}"]
+    else:
+        # reflinks share all blocks with the base image on btrfs or xfs, other filesystems get a sparse copy
+        bash(f"cp --reflink=auto --sparse=always {image_name}.bin {variant_image}.bin")
+    # the output of parallel builds would be interleaved -> every variant logs to its own file
+    with open(f"{variant_image}.log", "w") as log:
+        result = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT)
+    if result.returncode != 0:
+        print_error(f"Building {variant_image} failed, see {variant_image}.log")
+        raise subprocess.CalledProcessError(result.returncode, command)
+    print_status(f"Built {variant_image}")
+
+
+def add_base_steps(graph: BuildGraph, root_partuuid: str) -> None:
+    graph.add_step("download_rootfs", download_rootfs, outputs=["rootfs.tar.xz"])
+    if args.staging_dir is not None:
+        graph.add_step("prepare_staging", prepare_staging, outputs=["rootfs dir"])
+    else:
+        # the image is sized from the rootfs tarball
+        graph.add_step("prepare_image", lambda: prepare_image(root_partuuid), inputs=["rootfs.tar.xz"],
+                       outputs=["loop device", "rootfs dir"])
+    graph.add_step("build_base_rootfs", build_base_rootfs, inputs=["rootfs dir", "rootfs.tar.xz"],
+                   outputs=["base rootfs"])
+
+
+# Turn the base rootfs into the finished image of one variant. image_step attached the loop device
+def add_variant_steps(graph: BuildGraph, variant: dict, root_partuuid: str, image_step: str = None) -> None:
+    graph.add_step("download_kernel", lambda: download_kernel(variant["kernel"]), outputs=["bzImage"])
+    graph.add_step("write_kernel_flags", lambda: write_kernel_flags(root_partuuid), outputs=["kernel.flags"])
+    graph.add_step("sign_kernel", sign_kernel, inputs=["bzImage", "kernel.flags"], outputs=["bzImage.signed"])
+    graph.add_step("build_variant_rootfs",
+                   lambda: build_variant_rootfs(variant, root_partuuid, graph.results.get("build_base_rootfs")),
+                   inputs=["base rootfs", "bzImage"], outputs=["rootfs"])
+    graph.add_step("dedup_rootfs", dedup_rootfs, inputs=["rootfs"], outputs=["deduplicated rootfs"])
+    graph.add_step("clean_rootfs", clean_rootfs, inputs=["deduplicated rootfs"], outputs=["unmounted rootfs"])
+    graph.add_step("compress_image", compress_image, inputs=["image"], outputs=["artifacts"])
+    graph.add_step("write_block_manifest", write_block_manifest, inputs=["image"], outputs=["block manifest"])
+    if args.staging_dir is not None:
+        graph.add_step("assemble_image", lambda: assemble_image(root_partuuid),
+                       inputs=["unmounted rootfs", "bzImage.signed"], outputs=["image"])
+        return
+    graph.add_step("flash_kernel_p1", lambda: flash_kernel(f"{graph.results[image_step]}p1"),
+                   inputs=["loop device", "bzImage.signed"], outputs=["kernel partition"])
+    graph.add_step("flash_kernel_p2", lambda: flash_kernel(f"{graph.results[image_step]}p2"),  # reserve kernel
+                   inputs=["loop device", "bzImage.signed"], outputs=["reserve kernel partition"])
+    graph.add_step("shrink_image", lambda: shrink_image(graph.results[image_step]),
+                   inputs=["unmounted rootfs", "kernel partition", "reserve kernel partition"], outputs=["image"])
+    graph.add_step("detach_image", lambda: detach_image(graph.results[image_step]),
+                   inputs=["artifacts", "block manifest"])
+
+
+# Build the base rootfs once, then all variants in parallel from clones of the base image
+def add_matrix_steps(graph: BuildGraph, variants: list) -> None:
+    add_base_steps(graph, str(uuid.uuid4()))
+    if args.staging_dir is not None:  # the variants clone the base rootfs directory itself
+        graph.add_step("detach_base_image", lambda: None, inputs=["base rootfs"], outputs=["base image"])
+    else:
+        graph.add_step("detach_base_image", lambda: detach_base_image(graph.results["prepare_image"]),
+                       inputs=["base rootfs"], outputs=["base image"])
+    for variant in variants:
+        graph.add_step(f"build_{variant['name']}", lambda variant=variant: build_variant_image(variant),
+                       inputs=["base image"], outputs=[f"{variant['name']} image"])
+    graph.add_step("remove_base_image",
+                   lambda: rmdir(rootfs_dir, keep_dir=False) if args.staging_dir else rmfile(f"{image_name}.bin"),
+                   inputs=[f"{variant['name']} image" for variant in variants])
 
 
 if __name__ == "__main__":
     args = process_args()  # process args
+    if args.compare_profiles:
+        compare_profiles(*args.compare_profiles)
+        exit(0)
     set_verbose(True)  # increase verbosity
+    # record where the build spends its time, also written if the build fails
+    set_profiling(True)
+    mkdir(args.profile_dir, create_parents=True)
+    atexit.register(write_profile, f"{args.profile_dir}/build-profile.json", f"{args.profile_dir}/build-trace.json")
 
     # parse arguments
-    kernel_type = "mainline"
     if args.dev_build:
         print_warning("Using dev release")
     if args.stable:
         print_warning("Using stable chromes kernel")
-        kernel_type = "stable"
-
-    # prepare mount
-    mkdir("/mnt/eupneaos", create_parents=True)
-
-    image_props = prepare_image()
-    uuids = get_uuids(image_props)
 
     # # Bind mount directories
     # print_status("Bind-mounting directories")
-    # mkdir("/mnt/eupneaos/dev")
-    # bash("mount --rbind /dev /mnt/eupneaos/dev")
-    # bash("mount --make-rslave /mnt/eupneaos/dev")
-
-    bootstrap_rootfs()
-    configure_rootfs()
-    customize_kde()
-
-    # unmount boot before relabeling
-    bash("umount -f /mnt/eupneaos/boot")
-    relabel_files()
-
-    # Clean image of temporary files
-    rmdir("/mnt/eupneaos/tmp")
-    rmdir("/mnt/eupneaos/var/tmp")
-    rmdir("/mnt/eupneaos/var/cache")
-    rmdir("/mnt/eupneaos/proc")
-    rmdir("/mnt/eupneaos/run")
-    rmdir("/mnt/eupneaos/sys")
-    rmdir("/mnt/eupneaos/lost+found")
-    rmdir("/mnt/eupneaos/dev")
-    rmfile("/mnt/eupneaos/.stop_progress")
-
-    bash("sync")  # write all pending changes to image
+    # mkdir(f"{rootfs_dir}/dev")
+    # bash(f"mount --rbind /dev {rootfs_dir}/dev")
+    # bash(f"mount --make-rslave {rootfs_dir}/dev")
 
-    # Force unmount image
-    bash("umount -f /mnt/eupneaos")
-    sleep(5)  # wait for umount to finish
-    compress_image(image_props)
+    # independent steps like the downloads or signing the kernel run concurrently
+    build_graph = BuildGraph()
+    if args.matrix:
+        image_name = "eupneaos-base"
+        rootfs_dir = "/mnt/eupneaos-base"
+    elif args.variant:
+        image_name = f"eupneaos-{args.variant}"
+        rootfs_dir = f"/mnt/{image_name}"
+    if args.staging_dir is not None:
+        rootfs_dir = f"{get_full_path(args.staging_dir)}/{image_name}"
+        # parallel builds use different staging dirs -> their downloads and kernels must not share a directory either
+        work_dir = f"{get_full_path(args.staging_dir)}/{image_name}-work"
+    kernel_dir = f"{work_dir}/{image_name}"
 
-    bash(f"losetup -d {image_props}")  # unmount image
+    if args.matrix:
+        add_matrix_steps(build_graph, [parse_variant(name) for name in args.matrix.split(",")])
+    elif args.variant:  # started by a matrix build on a clone of the base image
+        root_partuuid = str(uuid.uuid4())
+        base_layer_key = args.base_layer_key
+        if args.staging_dir is not None:
+            build_graph.add_step("clone_base_rootfs", lambda: clone_base_rootfs(args.base_image),
+                                 outputs=["base rootfs"])
+        else:
+            build_graph.add_step("attach_image", lambda: attach_image(root_partuuid),
+                                 outputs=["loop device", "base rootfs"])
+        add_variant_steps(build_graph, parse_variant(args.variant), root_partuuid, "attach_image")
+    else:
+        root_partuuid = str(uuid.uuid4())
+        add_base_steps(build_graph, root_partuuid)
+        add_variant_steps(build_graph, parse_variant("stable" if args.stable else "mainline"), root_partuuid,
+                          "prepare_image")
+    if args.staging_dir is None:  # the staging directory is kept for debugging failed builds
+        build_graph.add_teardown(teardown_image)
+    build_graph.run()
+    build_graph.print_critical_path()
 
     print_header("Image creation completed successfully!")
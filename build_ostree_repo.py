@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# Compose the EupneaOS rpm-ostree commit from configs/fedora-eupneaos.yaml into an archive ostree repo.
+# The package cache, the ostree config checkout and the state of the last compose are kept in the cache directory, so
+# that a run only composes when the treefile or the resolved package set changed. With --unified-core, unchanged
+# packages are reused from the package cache and every commit builds on the previous one. A static delta from the
+# previous commit is generated for every new commit.
+#   build_ostree_repo.py --repo=./
+#   build_ostree_repo.py --repo=/tmp/test-repo --offline-repo=/srv/fedora-mirror  # everything from a local repo
+
+import argparse
+import configparser
+import io
+import re
+from time import perf_counter
+
+from functions import *
+
+OSTREE_CONFIG_REPO = "https://pagure.io/workstation-ostree-config.git"
+# Bump the version when the compose itself changes in a way that isn't covered by the treefile or the packages
+COMPOSE_VERSION = 1
+# "  kernel-6.5.6-300.fc39.x86_64 (updates)" in the transaction rpm-ostree prints for --dry-run
+_PACKAGE_LINE = re.compile(r"^\s+(\S+) \(([^)]+)\)$")
+
+
+def process_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repo", dest="repo", default="./", help="Archive ostree repo to commit to.")
+    parser.add_argument("--cache-dir", dest="cache_dir", default="/var/cache/eupneaos-ostree",
+                        help="Directory for the package cache, the ostree config checkout and the compose state.")
+    parser.add_argument("--treefile", dest="treefile", default="configs/fedora-eupneaos.yaml",
+                        help="Treefile of the EupneaOS commit.")
+    parser.add_argument("--config-branch", dest="config_branch", default="f39",
+                        help="Branch of workstation-ostree-config with the treefiles it includes.")
+    parser.add_argument("--config-dir", dest="config_dir", default=None,
+                        help="Use this local workstation-ostree-config checkout instead of fetching it.")
+    parser.add_argument("--offline-repo", dest="offline_repo", default=None,
+                        help="Install all packages from this local repo directory instead of the online repos.")
+    parser.add_argument("--no-unified-core", dest="no_unified_core", action="store_true", default=False,
+                        help="Compose without --unified-core, i.e. without reusing packages from the package cache.")
+    parser.add_argument("--no-deltas", dest="no_deltas", action="store_true", default=False,
+                        help="Don't generate a static delta from the previous commit.")
+    parser.add_argument("--force", dest="force", action="store_true", default=False,
+                        help="Compose even if the treefile and the packages are unchanged.")
+    return parser.parse_args()
+
+
+# Show the whole output of the long running commands, the other commands only print errors
+def print_sink(line: str, stream: str) -> None:
+    print(line, file=sys.stderr if stream == "stderr" else sys.stdout, flush=True)
+
+
+def install_dependencies() -> None:
+    if not all(shutil.which(tool) for tool in ["ostree", "rpm-ostree", "git"]):
+        print_status("Installing ostree, rpm-ostree and git")
+        bash("dnf install -y ostree rpm-ostree git")
+    # rpm-ostree will throw errors about /proc and /sys not being mounted -> mount them
+    if not os.path.ismount("/proc"):
+        bash("mount -t proc proc /proc")
+    if not os.path.ismount("/sys"):
+        bash("mount -t sysfs sys /sys")
+
+
+# Copy the ostree configs with the eupneaos treefile into a fresh directory, the checkout itself is never modified
+def prepare_treefile(work_dir: str) -> str:
+    config_dir = args.config_dir
+    if config_dir is None:
+        config_dir = f"{args.cache_dir}/workstation-ostree-config"
+        if not path_exists(f"{config_dir}/.git"):
+            print_status("Cloning workstation-ostree-config")
+            bash(f"git clone --branch={args.config_branch} --depth=1 {OSTREE_CONFIG_REPO} {config_dir}")
+        elif args.offline_repo is None:
+            print_status("Updating workstation-ostree-config")
+            bash(f"git -C {config_dir} fetch --depth=1 origin {args.config_branch}")
+            bash(f"git -C {config_dir} reset --hard FETCH_HEAD")
+    rmdir(work_dir, keep_dir=False)
+    cpdir(config_dir, work_dir, exclude=[".git"])
+    treefile = f"{work_dir}/{Path(args.treefile).name}"
+    cpfile(args.treefile, treefile)
+    if args.offline_repo is not None:
+        use_offline_repo(work_dir, get_full_path(args.offline_repo))
+    return treefile
+
+
+# Point every repo of the treefiles to the local repo. rpm-ostree reads the .repo files next to the treefile
+def use_offline_repo(work_dir: str, repo_dir: str) -> None:
+    for repo_file in Path(work_dir).glob("*.repo"):
+        repo_file.write_text(get_offline_repo_config(repo_file.read_text(), repo_dir))
+
+
+# Rewrite the contents of a .repo file, so that all its repos are read from repo_dir
+def get_offline_repo_config(repo_config: str, repo_dir: str) -> str:
+    repos = configparser.ConfigParser(interpolation=None)
+    repos.read_string(repo_config)
+    for section in repos.sections():
+        for option in ["metalink", "mirrorlist"]:
+            repos.remove_option(section, option)
+        repos.set(section, "baseurl", f"file://{repo_dir}")
+        # packages from the offline repo were signature checked when the repo was synced
+        repos.set(section, "gpgcheck", "0")
+    output = io.StringIO()
+    repos.write(output)
+    return output.getvalue()
+
+
+def get_compose_options(treefile: str) -> str:
+    options = f"--repo={args.repo} --cachedir={args.cache_dir}/pkgcache"
+    if not args.no_unified_core:
+        options += " --unified-core"
+    return f"{options} {treefile}"
+
+
+# Get the ref of the treefile and the package set rpm-ostree resolves for it, without downloading any packages
+def resolve_treefile(treefile: str) -> tuple:
+    print_status("Resolving packages")
+    expanded_treefile = json.loads(bash(f"rpm-ostree compose tree --print-only {treefile}"))
+    packages = parse_dry_run(bash(f"rpm-ostree compose tree --dry-run {get_compose_options(treefile)}"))
+    return expanded_treefile, packages
+
+
+# Get the sorted packages of the transaction from the output of rpm-ostree compose tree --dry-run
+def parse_dry_run(output: str) -> list:
+    return sorted(match.group(1) for line in output.splitlines() if (match := _PACKAGE_LINE.match(line)))
+
+
+# The treefile with all includes, the packages and rpm-ostree itself decide what the commit contains
+def get_compose_key(expanded_treefile: dict, packages: list, rpm_ostree_version: str) -> str:
+    sha256 = hashlib.sha256(f"v{COMPOSE_VERSION}".encode())
+    sha256.update(rpm_ostree_version.encode())
+    sha256.update(json.dumps(expanded_treefile, sort_keys=True).encode())
+    sha256.update("\n".join(packages).encode())
+    return sha256.hexdigest()
+
+
+def get_commit(ref: str) -> str:
+    result = run_command(f"ostree rev-parse --repo={args.repo} {ref}", sinks=[], capture=True, check=False)
+    return result.stdout if result.returncode == 0 else None
+
+
+def read_state(state_path: str) -> dict:
+    if not path_exists(state_path):
+        return {}
+    with open(state_path) as file:
+        return json.load(file)
+
+
+# A compose is only skipped if the last one had the same key and its commit is still the head of the ref.
+# Without a key, i.e. if the packages couldn't be resolved, it always composes
+def is_up_to_date(state: dict, compose_key: str, commit: str) -> bool:
+    return compose_key is not None and state.get("key") == compose_key and state.get("commit") == commit
+
+
+# One line per run, to follow compose times and delta sizes over time
+def append_history(history_path: str, report: dict, timestamp: int) -> None:
+    with open(history_path, "a") as file:
+        file.write(json.dumps({"time": timestamp, **report}) + "\n")
+
+
+# Count added, removed and updated packages by name
+def diff_packages(old_packages: list, new_packages: list) -> dict:
+    old_versions = {package.rsplit("-", 2)[0]: package for package in old_packages}
+    new_versions = {package.rsplit("-", 2)[0]: package for package in new_packages}
+    return {"added": len(new_versions.keys() - old_versions.keys()),
+            "removed": len(old_versions.keys() - new_versions.keys()),
+            "updated": sum(1 for name in new_versions.keys() & old_versions.keys()
+                           if new_versions[name] != old_versions[name])}
+
+
+# Compose a new commit. Returns None if rpm-ostree found no changes itself
+def compose(treefile: str) -> str:
+    print_status("Composing tree")
+    compose_json = f"{args.cache_dir}/compose.json"
+    changed_file = f"{args.cache_dir}/compose.changed"
+    rmfile(compose_json)
+    rmfile(changed_file)
+    run_command(f"rpm-ostree compose tree --write-composejson-to={compose_json} --touch-if-changed={changed_file} "
+                f"{get_compose_options(treefile)}", sinks=[print_sink])
+    if not path_exists(changed_file):  # rpm-ostree skips the commit if its input hash didn't change
+        return None
+    with open(compose_json) as file:
+        return json.load(file)["ostree-commit"]
+
+
+# Generate a static delta between two commits and get its size
+def generate_delta(from_commit: str, to_commit: str) -> int:
+    print_status(f"Generating static delta {from_commit[:12]} -> {to_commit[:12]}")
+    deltas_dir = f"{args.repo}/deltas"
+    mkdir(deltas_dir)
+    old_files = {path for path, entry, _, _ in walk_tree(deltas_dir) if entry.is_file(follow_symlinks=False)}
+    run_command(f"ostree static-delta generate --repo={args.repo} --from={from_commit} --to={to_commit}",
+                sinks=[print_sink])
+    return sum(entry.stat(follow_symlinks=False).st_size for path, entry, _, _ in walk_tree(deltas_dir)
+               if entry.is_file(follow_symlinks=False) and path not in old_files)
+
+
+def build_ostree_repo() -> None:
+    start = perf_counter()
+    if not path_exists(f"{args.repo}/config"):
+        print_status(f"Initializing ostree repo {args.repo}")
+        mkdir(args.repo, create_parents=True)
+        bash(f"ostree --repo={args.repo} init --mode=archive")
+
+    treefile = prepare_treefile(f"{args.cache_dir}/treefile")
+    expanded_treefile, packages = resolve_treefile(treefile)
+    ref = expanded_treefile["ref"]
+    state_path = f"{args.cache_dir}/state-{ref.replace('/', '_')}.json"
+    state = read_state(state_path)
+    parent_commit = get_commit(ref)
+    if packages:
+        compose_key = get_compose_key(expanded_treefile, packages, bash("rpm-ostree --version"))
+    else:
+        print_warning("Couldn't read the resolved packages from rpm-ostree, composing without checking for changes")
+        compose_key = None
+    report = {"ref": ref, "packages": len(packages), "parent": parent_commit,
+              "package_changes": diff_packages(state.get("packages", []), packages)}
+
+    if not args.force and is_up_to_date(state, compose_key, parent_commit):
+        print_header(f"{ref} is up to date at {parent_commit[:12]}, treefile and packages are unchanged")
+        report.update({"commit": parent_commit, "composed": False})
+    else:
+        compose_start = perf_counter()
+        commit = compose(treefile)
+        report["compose_seconds"] = round(perf_counter() - compose_start, 1)
+        if commit is None:
+            commit = parent_commit
+            print_status("rpm-ostree found no changes, no new commit")
+        report.update({"commit": commit, "composed": commit != parent_commit})
+        if report["composed"] and parent_commit is not None and not args.no_deltas:
+            report["delta_size"] = generate_delta(parent_commit, commit)
+        # clients use the summary to find the new commit and its delta
+        bash(f"ostree summary --repo={args.repo} --update")
+        with open(f"{state_path}.tmp", "w") as file:
+            json.dump({"key": compose_key, "commit": commit, "packages": packages}, file)
+        os.replace(f"{state_path}.tmp", state_path)
+
+    report["seconds"] = round(perf_counter() - start, 1)
+    append_history(f"{args.cache_dir}/compose-history.jsonl", report, int(time.time()))
+    changes = report["package_changes"]
+    print_status(f"Packages: {len(packages)}, {changes['added']} added, {changes['removed']} removed, "
+                 f"{changes['updated']} updated")
+    if "compose_seconds" in report:
+        print_status(f"Compose time: {report['compose_seconds']:.1f}s")
+    if "delta_size" in report:
+        print_status(f"Static delta size: {report['delta_size'] / 1048576:.1f}mb")
+    print_header(f"{ref}: {report['commit']} in {report['seconds']:.1f}s")
+
+
+if __name__ == "__main__":
+    args = process_args()
+    install_dependencies()
+    mkdir(args.cache_dir, create_parents=True)
+    # the package cache and the state can't be shared by two composes at the same time
+    with open(f"{args.cache_dir}/.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        build_ostree_repo()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# Delta updates for images: build_image.py writes a chunk manifest of every image and, with --chunk-store, adds its
+# chunks to a store.
+# A new image is then assembled from an old local image and the new manifest, only the missing chunks are fetched.
+#   delta_image.py index eupneaos.bin --store eupneaos-chunks
+#   delta_image.py apply eupneaos.bin.chunks.json --seed old-eupneaos.bin --store eupneaos-chunks --output eupneaos.bin
+# The manifest and the store can be local paths or urls.
+
+import argparse
+from time import perf_counter
+
+from functions import *
+
+READ_SIZE = 4 * 1024 ** 2
+
+
+def process_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    index_parser = subparsers.add_parser("index", help="Write the chunk manifest of an image.")
+    index_parser.add_argument("image", help="Image to index.")
+    index_parser.add_argument("--store", dest="store", default=None, help="Add the chunks of the image to this store.")
+    index_parser.add_argument("--manifest", dest="manifest", default=None,
+                              help="Path of the manifest. Default: <image>.chunks.json")
+    apply_parser = subparsers.add_parser("apply", help="Assemble an image from a seed image and a chunk store.")
+    apply_parser.add_argument("manifest", help="Chunk manifest of the new image.")
+    apply_parser.add_argument("--seed", dest="seed", required=True, help="Old image to take unchanged chunks from.")
+    apply_parser.add_argument("--store", dest="store", required=True, help="Chunk store with the new chunks.")
+    apply_parser.add_argument("--output", dest="output", required=True, help="Path of the new image.")
+    apply_parser.add_argument("--jobs", dest="jobs", type=int, default=8, help="Parallel chunk downloads.")
+    return parser.parse_args()
+
+
+def read_location(location: str) -> bytes:
+    if "://" in location:
+        with urlopen(location) as response:
+            return response.read()
+    with open(location, "rb") as file:
+        return file.read()
+
+
+# Chunk a whole file, the chunks are hashed in parallel while the file is read
+def index_file(path: str, store: str = None) -> dict:
+    indexer = ChunkIndexer(store)
+    with open(path, "rb") as file:
+        while data := file.read(READ_SIZE):
+            indexer.feed(data)
+    return indexer.finish()
+
+
+def index_image(image: str, store: str, manifest_path: str) -> None:
+    start = perf_counter()
+    manifest = index_file(image, store)
+    with open(manifest_path, "w") as file:
+        json.dump(manifest, file)
+    unique_chunks = len({digest for digest, _ in manifest["chunks"]})
+    print_status(f"Indexed {manifest['size'] / 1048576:.0f}mb into {len(manifest['chunks'])} chunks "
+                 f"({unique_chunks} unique) in {perf_counter() - start:.1f}s")
+
+
+def fetch_chunk(store: str, digest: str) -> tuple:
+    compressed = read_location(get_chunk_path(store, digest))
+    data = zlib.decompress(compressed)
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError(f"Chunk {digest} from {store} is corrupted")
+    return data, len(compressed)
+
+
+def apply_delta(manifest_location: str, seed: str, store: str, output: str, jobs: int) -> None:
+    start = perf_counter()
+    manifest = json.loads(read_location(manifest_location))
+    if manifest["block_size"] != CHUNK_BLOCK_SIZE:
+        raise ValueError(f"Manifest was chunked with {manifest['block_size']} byte blocks, not {CHUNK_BLOCK_SIZE}")
+
+    # the seed is chunked the same way -> unchanged regions produce the same chunks, even if they moved
+    print_status(f"Indexing seed image {seed}")
+    seed_chunks = {}
+    seed_offset = 0
+    for digest, size in index_file(seed)["chunks"]:
+        seed_chunks.setdefault(digest, seed_offset)
+        seed_offset += size
+
+    # offsets of every chunk in the new image, a chunk can appear more than once
+    chunk_offsets = {}
+    chunk_sizes = {}
+    offset = 0
+    for digest, size in manifest["chunks"]:
+        chunk_offsets.setdefault(digest, []).append(offset)
+        chunk_sizes[digest] = size
+        offset += size
+    # empty chunks stay holes in the sparse image
+    zero_digests = {hashlib.sha256(bytes(size)).hexdigest() for size in set(chunk_sizes.values())}
+
+    stats = {"seed": 0, "zero": 0, "fetched": 0, "downloaded": 0}
+    temp_output = f"{output}.tmp"
+    with open(temp_output, "wb") as image, open(seed, "rb") as seed_image:
+        image.truncate(manifest["size"])
+
+        def write_chunk(digest: str, data: bytes) -> None:
+            for chunk_offset in chunk_offsets[digest]:
+                os.pwrite(image.fileno(), data, chunk_offset)
+
+        def copy_seed_chunks() -> None:
+            for digest in chunk_offsets:
+                if digest in zero_digests:
+                    stats["zero"] += chunk_sizes[digest] * len(chunk_offsets[digest])
+                elif digest in seed_chunks:
+                    write_chunk(digest, os.pread(seed_image.fileno(), chunk_sizes[digest], seed_chunks[digest]))
+                    stats["seed"] += chunk_sizes[digest] * len(chunk_offsets[digest])
+
+        # write fetched chunks in the order they arrive
+        def write_fetched_chunks(pending: dict) -> None:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fetch in done:
+                digest = pending.pop(fetch)
+                data, downloaded = fetch.result()
+                write_chunk(digest, data)
+                stats["fetched"] += len(data) * len(chunk_offsets[digest])
+                stats["downloaded"] += downloaded
+
+        missing = [digest for digest in chunk_offsets if digest not in zero_digests and digest not in seed_chunks]
+        print_status(f"Fetching {len(missing)} of {len(chunk_offsets)} chunks from {store}")
+        # the seed is copied while the chunks are fetched
+        with ThreadPoolExecutor(max_workers=1) as seed_pool, ThreadPoolExecutor(max_workers=jobs) as pool:
+            seed_copy = seed_pool.submit(copy_seed_chunks)
+            pending = {}  # fetch -> digest
+            for digest in missing:
+                # keep the pool busy, but only keep a few fetched chunks in memory
+                while len(pending) >= jobs * 2:
+                    write_fetched_chunks(pending)
+                pending[pool.submit(fetch_chunk, store, digest)] = digest
+            while pending:
+                write_fetched_chunks(pending)
+            seed_copy.result()
+
+    print_status("Verifying new image")
+    sha256 = hashlib.sha256()
+    with open(temp_output, "rb") as image:
+        while data := image.read(READ_SIZE):
+            sha256.update(data)
+    if sha256.hexdigest() != manifest["sha256"]:
+        rmfile(temp_output)
+        raise ValueError("Checksum of the assembled image doesn't match the manifest")
+    os.replace(temp_output, output)
+
+    print_status(f"From seed: {stats['seed'] / 1048576:.0f}mb, empty: {stats['zero'] / 1048576:.0f}mb, "
+                 f"fetched: {stats['fetched'] / 1048576:.0f}mb ({stats['downloaded'] / 1048576:.0f}mb downloaded)")
+    print_header(f"Assembled {output} in {perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    args = process_args()
+    if args.command == "index":
+        index_image(args.image, args.store, args.manifest or f"{args.image}.chunks.json")
+    else:
+        apply_delta(args.manifest, args.seed, args.store, args.output, args.jobs)
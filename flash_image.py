@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# Flash an image to a usb drive or sd card and verify it. Seekable zstd images (.bin.zst) are decompressed in
+# parallel, one zstd process per frame. Other images (.bin.xz, .bin.tar.xz, .bin) are streamed through the fastest
+# available decompressor.
+# Zero regions of the image are not written: block devices get them zeroed with BLKZEROOUT, which most devices do
+# without transferring the zeros, image files are left sparse.
+#   flash_image.py flash eupneaos.bin.zst /dev/sdX
+#   flash_image.py verify eupneaos.bin.zst /dev/sdX
+# The block manifest of an image (eupneaos.bin.blocks.json) checks a device or an image without the image itself and
+# locates a corruption to a block of a partition:
+#   flash_image.py check eupneaos.bin.blocks.json /dev/sdX
+
+import argparse
+import tarfile
+from time import perf_counter
+
+from functions import *
+
+READ_SIZE = 4 * 1024 ** 2
+# Zero regions are detected in blocks of this size
+ZERO_BLOCK_SIZE = 64 * 1024
+_ZERO_BLOCK = bytes(ZERO_BLOCK_SIZE)
+_BLKZEROOUT = 0x127F  # ioctls from linux/fs.h
+_BLKGETSIZE64 = 0x80081272
+
+
+def process_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command, help_text in [("flash", "Write an image to a device or file."),
+                               ("verify", "Compare a device or file with an image.")]:
+        command_parser = subparsers.add_parser(command, help=help_text)
+        command_parser.add_argument("image", help="Image to flash: .bin.zst, .bin.xz, .bin.tar.xz or .bin")
+        command_parser.add_argument("target", help="Device or file to write to.")
+        command_parser.add_argument("--jobs", dest="jobs", type=int, default=os.cpu_count() or 1,
+                                    help="Frames of seekable zstd images that are decompressed in parallel.")
+    manifest_parser = subparsers.add_parser("manifest", help="Write the block manifest of a raw image.")
+    manifest_parser.add_argument("image", help="Raw image with a gpt.")
+    manifest_parser.add_argument("--output", dest="output", default=None,
+                                 help="Path of the manifest. Default: <image>.blocks.json")
+    check_parser = subparsers.add_parser("check", help="Check a device or raw image against a block manifest.")
+    check_parser.add_argument("manifest", help="Block manifest of the image.")
+    check_parser.add_argument("target", help="Device or raw image to check.")
+    check_parser.add_argument("--all", dest="all", action="store_true", default=False,
+                              help="Report all bad blocks instead of stopping at the first one.")
+    for command_parser in [manifest_parser, check_parser]:
+        command_parser.add_argument("--jobs", dest="jobs", type=int, default=os.cpu_count() or 1,
+                                    help="Blocks that are hashed in parallel.")
+    subparsers.choices["flash"].add_argument("--verify", dest="verify", action="store_true", default=False,
+                                             help="Verify the target after flashing.")
+    return parser.parse_args()
+
+
+# Get the uncompressed size of an image if it is known without decompressing it
+def get_image_size(path: str) -> int:
+    with contextlib.suppress(ValueError):
+        frames = read_zstd_seek_table(path)
+        return frames[-1][2] + frames[-1][3] if frames else 0
+    if get_compression(path) == "none" and not path.endswith(".tar"):
+        return os.path.getsize(path)
+    return None
+
+
+# Yield the uncompressed image as (offset, data) in order
+def read_image(path: str, jobs: int):
+    try:
+        frames = read_zstd_seek_table(path)
+    except ValueError:
+        yield from read_image_stream(path)
+        return
+    yield from read_seekable_image(path, frames, jobs)
+
+
+# Decompress the frames of a seekable zstd image in parallel, but hand them out in order
+def read_seekable_image(path: str, frames: list, jobs: int):
+    with open(path, "rb") as image, ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        for compressed_offset, compressed_size, offset, size in frames:
+            if len(pending) >= jobs * 2:
+                yield pending[0][0], pending.popleft()[1].result()
+            compressed = os.pread(image.fileno(), compressed_size, compressed_offset)
+            pending.append((offset, pool.submit(decompress_zstd_frame, compressed)))
+        while pending:
+            yield pending[0][0], pending.popleft()[1].result()
+
+
+def read_image_stream(path: str):
+    decompressor = get_decompressor(path)
+    with open(path, "rb") as image:
+        process = subprocess.Popen(decompressor, stdin=image, stdout=subprocess.PIPE) if decompressor else None
+        stream = process.stdout if process else image
+        try:
+            # the release archives wrap the image in a tar, see get_tar_framing() in build_image.py
+            if path.endswith((".tar", ".tar.xz", ".tar.zst", ".tar.gz")):
+                with tarfile.open(fileobj=stream, mode="r|") as tar:
+                    yield from _read_chunks(tar.extractfile(tar.next()))
+            else:
+                yield from _read_chunks(stream)
+        finally:
+            if process:
+                process.stdout.close()
+                process.kill()  # only has an effect if the reader stopped early
+                process.wait()
+    if process and process.returncode not in [0, -signal.SIGKILL]:
+        raise subprocess.CalledProcessError(process.returncode, decompressor)
+
+
+def _read_chunks(stream):
+    offset = 0
+    while data := stream.read(READ_SIZE):
+        yield offset, data
+        offset += len(data)
+
+
+class FlashTarget:
+    def __init__(self, path: str):
+        self.path = path
+        self.written_bytes = 0
+        self.zeroed_bytes = 0
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        self.is_block_device = stat.S_ISBLK(os.fstat(self._fd).st_mode)
+        if not self.is_block_device:
+            os.ftruncate(self._fd, 0)  # zero regions stay holes
+
+    def get_size(self) -> int:
+        if not self.is_block_device:
+            return None
+        size = bytearray(8)
+        fcntl.ioctl(self._fd, _BLKGETSIZE64, size)
+        return struct.unpack("<Q", size)[0]
+
+    def write(self, offset: int, data: bytes) -> None:
+        # split the data into runs of zero and non-zero blocks
+        run_start = 0
+        run_is_zero = None
+        for block_start in range(0, len(data), ZERO_BLOCK_SIZE):
+            block = data[block_start:block_start + ZERO_BLOCK_SIZE]
+            is_zero = block == _ZERO_BLOCK[:len(block)]
+            if run_is_zero is not None and is_zero != run_is_zero:
+                self._write_run(offset + run_start, data[run_start:block_start], run_is_zero)
+                run_start = block_start
+            run_is_zero = is_zero
+        if run_is_zero is not None:
+            self._write_run(offset + run_start, data[run_start:], run_is_zero)
+
+    def close(self, size: int) -> None:
+        if not self.is_block_device:
+            os.ftruncate(self._fd, size)  # the image may end with zeros
+        os.fsync(self._fd)
+        os.close(self._fd)
+
+    def _write_run(self, offset: int, data: bytes, is_zero: bool) -> None:
+        if is_zero:
+            self.zeroed_bytes += len(data)
+            if not self.is_block_device:
+                return
+            # BLKZEROOUT only takes ranges aligned to 512 byte sectors
+            if offset % 512 == 0 and len(data) % 512 == 0:
+                with contextlib.suppress(OSError):  # not supported, e.g. by some usb bridges
+                    fcntl.ioctl(self._fd, _BLKZEROOUT, struct.pack("<QQ", offset, len(data)))
+                    return
+        else:
+            self.written_bytes += len(data)
+        written = 0
+        while written < len(data):
+            written += os.pwrite(self._fd, data[written:], offset + written)
+
+
+def _print_flash_progress(action: str, done: int, total: int, seconds: float) -> None:
+    speed = done / 1048576 / max(seconds, 0.001)
+    total_text = f" / {total / 1048576:.0f}mb" if total else ""
+    print(f"\r{action}: {done / 1048576:.0f}mb{total_text}, {speed:.0f}mb/s", end="", flush=True)
+
+
+def flash_image(image: str, target_path: str, jobs: int) -> None:
+    start = perf_counter()
+    image_size = get_image_size(image)
+    target = FlashTarget(target_path)
+    target_size = target.get_size()
+    if image_size is not None and target_size is not None and target_size < image_size:
+        print_error(f"{target_path} is too small: {target_size / 1048576:.0f}mb, image: {image_size / 1048576:.0f}mb")
+        exit(1)
+    print_status(f"Flashing {image} to {target_path}")
+    end = 0
+    last_report = 0
+    for offset, data in read_image(image, jobs):
+        target.write(offset, data)
+        end = offset + len(data)
+        if not no_extract_progress and time.monotonic() - last_report > 0.5:
+            last_report = time.monotonic()
+            _print_flash_progress("Flashing", end, image_size, perf_counter() - start)
+    if not no_extract_progress:
+        print()
+    print_status("Syncing")
+    target.close(end)
+    seconds = perf_counter() - start
+    print_status(f"Wrote {target.written_bytes / 1048576:.0f}mb, zeroed {target.zeroed_bytes / 1048576:.0f}mb "
+                 f"without writing it")
+    print_header(f"Flashed {end / 1048576:.0f}mb in {seconds:.1f}s ({end / 1048576 / seconds:.0f}mb/s)")
+
+
+def verify_image(image: str, target_path: str, jobs: int) -> bool:
+    start = perf_counter()
+    print_status(f"Verifying {target_path} against {image}")
+    with open(target_path, "rb") as target:
+        # drop cached pages of the target, so that the data is read back from the device itself
+        os.posix_fadvise(target.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        end = 0
+        for offset, data in read_image(image, jobs):
+            if os.pread(target.fileno(), len(data), offset) != data:
+                print_error(f"{target_path} differs from {image} between byte {offset} and {offset + len(data)}")
+                return False
+            end = offset + len(data)
+    print_header(f"Verified {end / 1048576:.0f}mb in {perf_counter() - start:.1f}s")
+    return True
+
+
+def write_manifest(image: str, manifest_path: str, jobs: int) -> None:
+    start = perf_counter()
+    manifest = build_block_manifest(image, max_workers=jobs)
+    with open(manifest_path, "w") as file:
+        json.dump(manifest, file)
+    for partition in manifest["partitions"]:
+        print_status(f"Partition {partition['index']} ({partition['name']}): {partition['size'] / 1048576:.0f}mb, "
+                     f"root {partition['root']}")
+    print_header(f"Hashed {manifest['size'] / 1048576:.0f}mb in {perf_counter() - start:.1f}s")
+
+
+def check_manifest(manifest_path: str, target_path: str, stop_early: bool, jobs: int) -> bool:
+    start = perf_counter()
+    with open(manifest_path) as file:
+        manifest = json.load(file)
+    print_status(f"Checking {target_path} against {manifest_path}")
+    with open(target_path, "rb") as target:
+        # read back from the device itself, not from the page cache
+        os.posix_fadvise(target.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    bad_blocks = verify_block_manifest(target_path, manifest, stop_early=stop_early, max_workers=jobs)
+    for bad_block in bad_blocks:
+        if bad_block["block"] is None:
+            print_error(f"{target_path} ends {bad_block['size']} bytes before the end of partition "
+                        f"{bad_block['partition']} ({bad_block['name']})")
+        else:
+            print_error(f"Block {bad_block['block']} of partition {bad_block['partition']} ({bad_block['name']}) is "
+                        f"corrupted: bytes {bad_block['offset']} to {bad_block['offset'] + bad_block['size']}")
+    if bad_blocks:
+        return False
+    print_header(f"Checked {len(manifest['partitions'])} partitions in {perf_counter() - start:.1f}s")
+    return True
+
+
+if __name__ == "__main__":
+    args = process_args()
+    if args.command == "flash":
+        flash_image(args.image, args.target, args.jobs)
+        if args.verify and not verify_image(args.image, args.target, args.jobs):
+            exit(1)
+    elif args.command == "manifest":
+        write_manifest(args.image, args.output or f"{args.image}.blocks.json", args.jobs)
+    elif args.command == "check":
+        if not check_manifest(args.manifest, args.target, not args.all, args.jobs):
+            exit(1)
+    elif not verify_image(args.image, args.target, args.jobs):
+        exit(1)
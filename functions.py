@@ -1,40 +1,138 @@
+import bisect
+import codecs
 import contextlib
+import csv
+import ctypes
+import errno
+import fcntl
+import fnmatch
+import functools
+import hashlib
+import json
+import mmap
+import os
+import queue
+import re
+import resource
+import select
+import selectors
+import shutil
+import signal
+import stat
+import struct
 import subprocess
 import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 from threading import Thread
 from time import sleep
-from urllib.request import urlopen, urlretrieve
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
 
 #######################################################################################
 #                               PATHLIB FUNCTIONS                                     #
 #######################################################################################
 # unlink all files in a directory and remove the directory
-def rmdir(rm_dir: str, keep_dir: bool = True) -> None:
-    def unlink_files(path_to_rm: Path) -> None:
-        try:
-            for file in path_to_rm.iterdir():
-                if file.is_file():
-                    file.unlink()
-                else:
-                    unlink_files(path_to_rm)
-        except FileNotFoundError:
-            print(f"Couldn't remove non existent directory: {path_to_rm}, ignoring")
-
-    # convert string to Path object
-    rm_dir_as_path = Path(rm_dir)
+# Everything is opened relative to the directory fd with O_NOFOLLOW, so symlinks are removed but never followed.
+# First all non-directories are unlinked by a pool, one task per directory: unlinks in the same directory serialize
+# on its lock in the kernel anyway. Then the empty directories are removed bottom-up.
+def rmdir(rm_dir: str, keep_dir: bool = True) -> tuple:
+    try:
+        root_fd = os.open(rm_dir, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    except FileNotFoundError:
+        print(f"Couldn't remove non existent directory: {rm_dir}, ignoring")
+        return 0, 0
+    removed_files = 0
+    freed_bytes = 0
     try:
-        unlink_files(rm_dir_as_path)
-    except RecursionError:  # python doesn't work for folders with a lot of subfolders
-        print(f"Failed to remove {rm_dir} with python, using bash")
-        bash(f"rm -rf {rm_dir_as_path.absolute().as_posix()}/*")
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as pool:
+            pending = {pool.submit(_unlink_dir_files, root_fd, ())}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for task in done:
+                    files, size, subdirs = task.result()
+                    removed_files += files
+                    freed_bytes += size
+                    pending.update(pool.submit(_unlink_dir_files, root_fd, subdir) for subdir in subdirs)
+        files, size = _remove_tree(root_fd)  # also catches files created in the meantime
+        removed_files += files
+        freed_bytes += size
+    finally:
+        os.close(root_fd)
     # Remove emtpy directory
     if not keep_dir:
+        os.rmdir(rm_dir)
+    if verbose:
+        print(f"Removed {removed_files} files, {freed_bytes / 1048576:.0f}mb from {rm_dir}", flush=True)
+    return removed_files, freed_bytes
+
+
+# Open a directory below root_fd one component at a time, never following symlinks
+def _open_dir_nofollow(root_fd: int, parts: tuple) -> int:
+    dir_fd = os.dup(root_fd)
+    for part in parts:
         try:
-            rm_dir_as_path.rmdir()
-        except FileNotFoundError:  # Directory doesn't exist, because bash was used
-            return
+            child_fd = os.open(part, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=dir_fd)
+        finally:
+            os.close(dir_fd)
+        dir_fd = child_fd
+    return dir_fd
+
+
+# Get the bytes that are actually freed when an entry is removed: shared hardlinks free nothing
+def _get_freed_bytes(entry_stat: os.stat_result) -> int:
+    return entry_stat.st_blocks * 512 if entry_stat.st_nlink == 1 else 0
+
+
+# Unlink all non-directories in one directory, return the counts and the subdirectories for the next tasks
+def _unlink_dir_files(root_fd: int, parts: tuple) -> tuple:
+    removed_files = 0
+    freed_bytes = 0
+    subdirs = []
+    dir_fd = _open_dir_nofollow(root_fd, parts)
+    try:
+        with os.scandir(dir_fd) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(parts + (entry.name,))
+                    continue
+                freed_bytes += _get_freed_bytes(entry.stat(follow_symlinks=False))
+                os.unlink(entry.name, dir_fd=dir_fd)
+                removed_files += 1
+    finally:
+        os.close(dir_fd)
+    return removed_files, freed_bytes, subdirs
+
+
+# Remove everything below root_fd bottom-up with an explicit stack, without recursion
+def _remove_tree(root_fd: int) -> tuple:
+    removed_files = 0
+    freed_bytes = 0
+    root_fd = os.dup(root_fd)
+    stack = [(root_fd, os.scandir(root_fd), None)]  # directory fd, its entries, its name in the parent
+    while stack:
+        dir_fd, entries, dir_name = stack[-1]
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                child_fd = os.open(entry.name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=dir_fd)
+                stack.append((child_fd, os.scandir(child_fd), entry.name))
+                break  # continue with this directory once the child is removed
+            freed_bytes += _get_freed_bytes(entry.stat(follow_symlinks=False))
+            os.unlink(entry.name, dir_fd=dir_fd)
+            removed_files += 1
+        else:  # all entries are gone
+            entries.close()
+            os.close(dir_fd)
+            stack.pop()
+            if stack:
+                os.rmdir(dir_name, dir_fd=stack[-1][0])
+    return removed_files, freed_bytes
 
 
 # remove a single file
@@ -61,49 +159,137 @@ def get_full_path(path_str: str) -> str:
     return Path(path_str).absolute().as_posix()
 
 
-# recursively copy files from a dir into another dir
-def cpdir(src_as_str: str, dst_as_string: str) -> None:  # dst_dir must be a full path, including the new dir name
-    def copy_files(src: Path, dst: Path) -> None:
-        # create dst dir if it doesn't exist
-        if verbose:
-            print(f"Copying {src} to {dst}")
-        mkdir(dst.absolute().as_posix(), create_parents=True)
-        for src_file in src.iterdir():
-            if src_file.is_file():
-                dst_file = dst.joinpath(src_file.stem + src_file.suffix)
-                dst_file.write_bytes(src_file.read_bytes())
-            elif src_file.is_dir():
-                if src_file.exists():
-                    new_dst = dst.joinpath(src_file.stem + src_file.suffix)
-                    copy_files(src_file, new_dst)
-                else:
-                    raise FileNotFoundError(f"No such file or directory: {src_file.absolute().as_posix()}")
-
-    src_as_path = Path(src_as_str)
-    dst_as_path = Path(dst_as_string)
-    if src_as_path.exists():
-        if not dst_as_path.exists():
-            mkdir(dst_as_string)
-        # TODO: Fix python copy dir
-        '''
+# Copy the data of a regular file without passing it through python
+def _copy_file_data(src_fd: int, dst_fd: int, size: int) -> None:
+    # reflink: both files share the same data blocks until one of them is modified (btrfs, xfs)
+    with contextlib.suppress(OSError):
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+        return
+    copied = 0
+    try:
+        # copies inside the kernel, can also use server side copies or reflinks on its own
+        while copied < size:
+            chunk_size = os.copy_file_range(src_fd, dst_fd, size - copied)
+            if chunk_size == 0:  # source got shorter
+                return
+            copied += chunk_size
+        return
+    except OSError:  # not supported between these filesystems -> continue with sendfile
+        pass
+    while copied < size:
+        chunk_size = os.sendfile(dst_fd, src_fd, copied, size - copied)
+        if chunk_size == 0:
+            return
+        copied += chunk_size
+
+
+# Copy mode, timestamps, xattrs (e.g. SELinux labels) and optionally the owner of a file, dir or symlink
+def _copy_metadata(src: str, dst: str, src_stat: os.stat_result, preserve_owner: bool) -> None:
+    is_link = stat.S_ISLNK(src_stat.st_mode)
+    # filesystems like vfat don't support owners, modes or xattrs -> keep what is supported, like cp does
+    if preserve_owner:
+        with contextlib.suppress(PermissionError):
+            os.chown(dst, src_stat.st_uid, src_stat.st_gid, follow_symlinks=False)
+    if not is_link:  # mode of symlinks can't be changed on linux
+        with contextlib.suppress(PermissionError):
+            os.chmod(dst, stat.S_IMODE(src_stat.st_mode))  # after chown, as chown clears setuid bits
+    with contextlib.suppress(OSError):
+        for attribute in os.listxattr(src, follow_symlinks=False):
+            with contextlib.suppress(OSError):
+                os.setxattr(dst, attribute, os.getxattr(src, attribute, follow_symlinks=False),
+                            follow_symlinks=False)
+    with contextlib.suppress(PermissionError):
+        os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns), follow_symlinks=False)
+
+
+# Copy a single non-directory entry, replacing an existing destination
+def _copy_entry(src: str, dst: str, src_stat: os.stat_result, preserve_owner: bool) -> None:
+    if stat.S_ISREG(src_stat.st_mode):
+        if os.path.islink(dst):
+            os.unlink(dst)  # don't write through an existing symlink
+        src_fd = os.open(src, os.O_RDONLY)
         try:
-            copy_files(src_as_path, dst_as_path)
-        except RecursionError:
-            print("\033[93m" + f"Failed to copy {root_src} to {root_dst}, using bash" + "\033[0m")
-            bash(f"cp -rp {src_as_path.absolute().as_posix()} {dst_as_path.absolute().as_posix()}")
-        '''
-        bash(f"cp -rp {src_as_path.absolute().as_posix()}/* {dst_as_path.absolute().as_posix()}")
+            # an existing file is overwritten in place, like cp does
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                _copy_file_data(src_fd, dst_fd, src_stat.st_size)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
     else:
-        raise FileNotFoundError(f"No such directory: {src_as_path.absolute().as_posix()}")
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        if stat.S_ISLNK(src_stat.st_mode):
+            os.symlink(os.readlink(src), dst)
+        else:  # device nodes, fifos and sockets
+            os.mknod(dst, src_stat.st_mode, src_stat.st_rdev)
+    _copy_metadata(src, dst, src_stat, preserve_owner)
 
 
-def cpfile(src_as_str: str, dst_as_str: str) -> None:  # "/etc/resolv.conf", "/var/some_config/resolv.conf"
+def _copy_entries(entries: list) -> None:
+    for entry in entries:
+        _copy_entry(*entry)
+
+
+# recursively copy the contents of a dir into another dir, like cp -rp src/. dst, but including xattrs
+# dst_dir must be a full path, including the new dir name
+def cpdir(src_as_str: str, dst_as_string: str, exclude: list = None) -> None:
+    src_as_path = Path(src_as_str)
+    dst_as_path = Path(dst_as_string)
+    if not src_as_path.is_dir():
+        raise FileNotFoundError(f"No such directory: {src_as_path.absolute().as_posix()}")
+    if verbose:
+        print(f"Copying {src_as_path.absolute().as_posix()} to {dst_as_path.absolute().as_posix()}")
+    exclude = set(exclude or [])  # names to skip at any depth, e.g. .git
+    with profile_step(f"cpdir {src_as_str} {dst_as_string}", "copy"):
+        mkdir(dst_as_string, create_parents=True)
+        copied_dirs = []
+        copies = []
+        # walk the tree iteratively in this thread, the files are copied by the pool in the meantime
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as pool:
+            pending_dirs = [(src_as_path.as_posix(), dst_as_path.as_posix())]
+            while pending_dirs:
+                src_dir, dst_dir = pending_dirs.pop()
+                batch = []
+                with os.scandir(src_dir) as entries:
+                    for entry in entries:
+                        if entry.name in exclude:
+                            continue
+                        dst_path = os.path.join(dst_dir, entry.name)
+                        entry_stat = entry.stat(follow_symlinks=False)
+                        if stat.S_ISDIR(entry_stat.st_mode):
+                            if not os.path.isdir(dst_path):
+                                os.mkdir(dst_path, 0o700)
+                            pending_dirs.append((entry.path, dst_path))
+                            copied_dirs.append((entry.path, dst_path, entry_stat))
+                            continue
+                        batch.append((entry.path, dst_path, entry_stat, True))
+                        # hand out files in batches, a task per small file would cost more than the copy itself
+                        if len(batch) == 64:
+                            copies.append(pool.submit(_copy_entries, batch))
+                            batch = []
+                if batch:
+                    copies.append(pool.submit(_copy_entries, batch))
+            for copy in copies:
+                copy.result()  # raises the error of a failed copy
+        # copying files into the dirs changes their timestamps -> set the dir metadata last, deepest dirs first
+        for src_dir, dst_dir, dir_stat in reversed(copied_dirs):
+            _copy_metadata(src_dir, dst_dir, dir_stat, preserve_owner=True)
+
+
+# copy a file with its mode, timestamps and xattrs. The owner is only kept if requested, as files from the repo would
+# otherwise end up owned by the build user in the image
+# e.g. cpfile("/etc/resolv.conf", "/var/some_config/resolv.conf")
+def cpfile(src_as_str: str, dst_as_str: str, preserve_owner: bool = False) -> None:
     src_as_path = Path(src_as_str)
     dst_as_path = Path(dst_as_str)
     if verbose:
         print(f"Copying {src_as_path.absolute().as_posix()} to {dst_as_path.absolute().as_posix()}")
     if src_as_path.exists():
-        dst_as_path.write_bytes(src_as_path.read_bytes())
+        with profile_step(f"cpfile {src_as_str} {dst_as_str}", "copy"):
+            # follow symlinks like before, i.e. copy the file a symlink points to
+            _copy_entry(src_as_path.as_posix(), dst_as_path.as_posix(), os.stat(src_as_path), preserve_owner)
     else:
         raise FileNotFoundError(f"No such file: {src_as_path.absolute().as_posix()}")
 
@@ -112,18 +298,543 @@ def cpfile(src_as_str: str, dst_as_str: str) -> None:  # "/etc/resolv.conf", "/v
 #                               BASH FUNCTIONS                                        #
 #######################################################################################
 
+# Only the last lines of every stream are kept in memory, unless the whole output is captured
+COMMAND_TAIL_LINES = 200
+# Lines longer than this are split, so that output without newlines can't fill the memory either
+COMMAND_MAX_LINE_LENGTH = 64 * 1024
+
+
 # return the output of a command
-def bash(command: str) -> str:
-    output = subprocess.check_output(command, shell=True, text=True).strip()
-    if verbose:
-        print(output, flush=True)
-    return output
+def bash(command: str, sinks: list = None, timeout: float = None, cancel_event: threading.Event = None) -> str:
+    result = run_command(command, [console_sink] if sinks is None else sinks, timeout=timeout,
+                         cancel_event=cancel_event, capture=True)
+    return result.stdout
+
+
+def run_command(command: str, sinks: list = None, timeout: float = None, cancel_event: threading.Event = None,
+                capture: bool = False, check: bool = True, tail_lines: int = COMMAND_TAIL_LINES) -> "CommandResult":
+    """
+    Run a shell command and stream its output line by line to sinks while it runs.
+
+    :param command: A string representing the shell command.
+    :param sinks: A list of functions called with every line of output and "stdout" or "stderr".
+        Default: console_sink.
+    :param timeout: Seconds after which the command and all its children are killed and TimeoutExpired is raised.
+    :param cancel_event: A threading.Event. If it is set, the command is killed and CommandCancelledError is raised.
+    :param capture: Keep the whole output. Otherwise only the last tail_lines lines of each stream are kept.
+    :param check: Raise CalledProcessError if the command fails.
+    :param tail_lines: Number of lines per stream that are kept if the output isn't captured.
+    :return: A CommandResult with the exit code, output, duration and resource usage of the command.
+    """
+    if sinks is None:
+        sinks = [console_sink]
+    # only commands that can be killed get their own process group. Otherwise they stay in the group of the
+    # terminal, so that Ctrl+C still reaches them.
+    killable = timeout is not None or cancel_event is not None
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with profile_step(command, "bash") as record:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   start_new_session=killable)
+        stdout = _CommandOutput("stdout", sinks, capture, tail_lines)
+        stderr = _CommandOutput("stderr", sinks, capture, tail_lines)
+        outputs = {process.stdout.fileno(): stdout, process.stderr.fileno(): stderr}
+        try:
+            with selectors.DefaultSelector() as selector:
+                for fd in outputs:
+                    os.set_blocking(fd, False)
+                    selector.register(fd, selectors.EVENT_READ)
+                while selector.get_map():
+                    _check_command_cancelled(command, timeout, deadline, cancel_event, outputs)
+                    for key, _ in selector.select(0.1 if killable else None):
+                        data = os.read(key.fd, 65536)
+                        if data:
+                            outputs[key.fd].feed(data)
+                        else:  # stream closed
+                            selector.unregister(key.fd)
+                            outputs[key.fd].flush()
+            # wait4 instead of wait to get the resource usage of this command only
+            while True:
+                pid, status, rusage = os.wait4(process.pid, os.WNOHANG if killable else 0)
+                if pid:
+                    break
+                _check_command_cancelled(command, timeout, deadline, cancel_event, outputs)
+                sleep(0.05)
+        except BaseException:
+            _kill_command(process, killable)
+            raise
+        finally:
+            process.stdout.close()
+            process.stderr.close()
+        process.returncode = os.waitstatus_to_exitcode(status)
+        record.update({"cpu_seconds": rusage.ru_utime + rusage.ru_stime, "peak_rss_kb": rusage.ru_maxrss})
+    result = CommandResult(command, process.returncode, stdout.get_text(), stderr.get_text(),
+                           time.perf_counter() - start, rusage)
+    if check and result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, command, output=result.stdout, stderr=result.stderr)
+    return result
+
+
+class CommandCancelledError(subprocess.SubprocessError):
+    pass
+
+
+# Print stdout in verbose mode and stderr always, like before output was streamed
+def console_sink(line: str, stream: str) -> None:
+    if stream == "stderr":
+        print(line, file=sys.stderr, flush=True)
+    elif verbose:
+        print(line, flush=True)
+
+
+class LogFileSink:
+    """
+    A sink that appends every line of output to a log file, stderr lines are marked.
+
+    with LogFileSink("dnf.log") as log:
+        run_command("dnf upgrade -y", sinks=[console_sink, log])
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "a", buffering=1)  # line buffered -> the log can be followed while it's written
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __call__(self, line: str, stream: str) -> None:
+        with self._lock:  # one log can be shared by commands that run in parallel
+            self._file.write(f"{line}\n" if stream == "stdout" else f"[stderr] {line}\n")
+
+    def close(self) -> None:
+        self._file.close()
+
+
+# Split the output of one stream into lines, pass them to the sinks and keep the tail or the whole output
+class _CommandOutput:
+    def __init__(self, stream: str, sinks: list, capture: bool, tail_lines: int):
+        self.stream = stream
+        self.sinks = sinks
+        self.lines = [] if capture else deque(maxlen=tail_lines)
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._pending = ""
+
+    def feed(self, data: bytes) -> None:
+        self._pending += self._decoder.decode(data)
+        *lines, self._pending = self._pending.split("\n")
+        while len(self._pending) > COMMAND_MAX_LINE_LENGTH:
+            lines.append(self._pending[:COMMAND_MAX_LINE_LENGTH])
+            self._pending = self._pending[COMMAND_MAX_LINE_LENGTH:]
+        for line in lines:
+            self._add_line(line)
+
+    def flush(self) -> None:
+        self._pending += self._decoder.decode(b"", final=True)
+        if self._pending:
+            self._add_line(self._pending)
+            self._pending = ""
+
+    def get_text(self) -> str:
+        return "\n".join(self.lines).strip()
+
+    def _add_line(self, line: str) -> None:
+        self.lines.append(line)
+        for sink in self.sinks:
+            sink(line, self.stream)
+
+
+def _check_command_cancelled(command: str, timeout: float, deadline: float, cancel_event: threading.Event,
+                             outputs: dict) -> None:
+    if deadline is not None and time.monotonic() > deadline:
+        stdout, stderr = (output.get_text() for output in outputs.values())
+        raise subprocess.TimeoutExpired(command, timeout, output=stdout, stderr=stderr)
+    if cancel_event is not None and cancel_event.is_set():
+        raise CommandCancelledError(f"Command was cancelled: {command}")
+
+
+# Stop a command with SIGTERM, then SIGKILL if it doesn't exit within 5 seconds
+def _kill_command(process: subprocess.Popen, killable: bool) -> None:
+    if process.poll() is not None:
+        return
+    # killable commands run in their own process group -> their children are stopped as well
+    send_signal = functools.partial(os.killpg, process.pid) if killable else process.send_signal
+    with contextlib.suppress(ProcessLookupError):
+        send_signal(signal.SIGTERM)
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            send_signal(signal.SIGKILL)
+            process.wait()
 
 
 def chroot(command: str) -> str:
     return bash(f'chroot /mnt/depthboot /bin/bash -c "{command}"')
 
 
+class CommandResult:
+    def __init__(self, command: str, returncode: int, stdout: str, stderr: str, seconds: float,
+                 rusage: resource.struct_rusage = None):
+        self.command = command
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.seconds = seconds
+        self.rusage = rusage  # None for chroot session commands, they are children of the session shell
+
+
+class ChrootSession:
+    """
+    A single long-lived bash inside a chroot, which runs the commands it receives over a pipe.
+    Every command runs in a subshell with stdin from /dev/null -> cd, exit or reading stdin can't break the session.
+    bash is only started on the first command, so the session can be opened before the rootfs is extracted.
+
+    with ChrootSession("/mnt/eupneaos") as session:
+        session.run("dnf upgrade -y")
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.history = []  # (command, exit status, seconds) of every command, outputs are not kept
+        self._process = None
+        self._line_callback = None
+        self._marker = f"__chroot_session_{uuid.uuid4().hex}_"
+        self._lines = queue.Queue()  # ("stdout" or "stderr", line) from both reader threads
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    # line_callback is called from the reader threads with every line of output and "stdout" or "stderr" as soon as it
+    # arrives. Without capture only the last lines of each stream are kept.
+    def run(self, command: str, check: bool = True, line_callback=None, capture: bool = True) -> CommandResult:
+        if self._process is None:
+            self._start()
+        self._line_callback = line_callback
+        with profile_step(command, "chroot") as record:
+            # the commands are children of the shell -> their cpu time and io are accounted to it, not to us
+            start_io = _read_proc_io(self._process.pid)
+            start_cpu = _read_proc_cpu_seconds(self._process.pid)
+            start = time.perf_counter()
+            # the exit status is appended to the end marker on stdout, stderr only gets the marker
+            self._process.stdin.write(
+                f'( {command}\n) < /dev/null\necho "{self._marker}$?"\necho "{self._marker}" >&2\n')
+            self._process.stdin.flush()
+            outputs = {stream: [] if capture else deque(maxlen=COMMAND_TAIL_LINES) for stream in ["stdout", "stderr"]}
+            status = self._collect_output(outputs)
+            self._line_callback = None
+            end_io = _read_proc_io(self._process.pid)
+            record.update({"external": True, "cpu_seconds": _read_proc_cpu_seconds(self._process.pid) - start_cpu,
+                           "read_bytes": end_io["read_bytes"] - start_io["read_bytes"],
+                           "write_bytes": end_io["write_bytes"] - start_io["write_bytes"],
+                           "read_chars": end_io["rchar"] - start_io["rchar"],
+                           "write_chars": end_io["wchar"] - start_io["wchar"],
+                           "peak_rss_kb": None})
+        result = CommandResult(command, int(status), "".join(outputs["stdout"]).strip(),
+                               "".join(outputs["stderr"]).strip(), time.perf_counter() - start)
+        self.history.append((command, result.returncode, result.seconds))
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, command, output=result.stdout,
+                                                stderr=result.stderr)
+        return result
+
+    def close(self) -> None:
+        if self._process is None:
+            return
+        # the shell keeps the chroot busy -> it has to exit before the rootfs can be unmounted
+        with contextlib.suppress(BrokenPipeError):
+            self._process.stdin.write("exit\n")
+            self._process.stdin.close()
+        self._process.wait()
+        self._process = None
+        if verbose and self.history:
+            print_status("Time spent per chroot command:")
+            for command, returncode, seconds in sorted(self.history, key=lambda entry: entry[2], reverse=True):
+                print(f"{seconds:8.1f}s  exit {returncode}  {command}", flush=True)
+
+    def _start(self) -> None:
+        self._process = subprocess.Popen(["chroot", self.root, "/bin/bash", "--noprofile", "--norc"],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                         text=True, bufsize=1)
+        Thread(target=self._read_stream, args=(self._process.stdout, "stdout", sys.stdout), daemon=True).start()
+        Thread(target=self._read_stream, args=(self._process.stderr, "stderr", sys.stderr), daemon=True).start()
+
+    # Print the output live and pass it on to run(). Runs in its own thread for stdout and stderr each
+    def _read_stream(self, stream, name: str, console) -> None:
+        for line in stream:
+            visible_line = line.split(self._marker, 1)[0]
+            if verbose and visible_line:
+                print(visible_line, end="" if visible_line.endswith("\n") else "\n", file=console, flush=True)
+            if self._line_callback is not None and visible_line:
+                self._line_callback(visible_line, name)
+            self._lines.put((name, line))
+        self._lines.put((name, None))  # shell exited
+
+    # Both streams are collected at the same time until each has its end marker -> lines of one stream never pile up
+    # while the other one is read. Returns the exit status of the command
+    def _collect_output(self, outputs: dict) -> str:
+        status = None
+        ended_streams = 0
+        while ended_streams < 2:
+            stream, line = self._lines.get()
+            if line is None:
+                raise ChildProcessError(f"Shell in chroot {self.root} exited unexpectedly")
+            if self._marker in line:
+                # output without a trailing newline ends up on the same line as the marker
+                line, stream_status = line.split(self._marker, 1)
+                ended_streams += 1
+                if stream == "stdout":  # stderr only gets the marker
+                    status = stream_status.strip()
+            if line:
+                outputs[stream].append(line)
+        return status
+
+
+#######################################################################################
+#                                    PROFILING                                        #
+#######################################################################################
+# Every bash(), chroot command, cpfile() and cpdir() call and every function decorated with @profiled is recorded
+# while profiling is enabled: wall time, cpu time, bytes read/written (/proc/<pid>/io) and peak rss.
+# Records of nested calls are kept too, e.g. a step and all commands it ran.
+# The cpu/io counters of a process include its reaped children, which covers bash() commands. Commands in a chroot
+# session are measured on the session shell and added to the steps that ran them.
+# The counters are per process -> records of steps that run at the same time in different threads overlap.
+
+def set_profiling(new_state: bool) -> None:
+    global profiling, profile_start
+    profiling = new_state
+    profile_start = time.perf_counter()
+    profile_timeline.clear()
+
+
+def _read_proc_io(pid="self") -> dict:
+    with open(f"/proc/{pid}/io", "r") as file:
+        return {key: int(value) for key, value in (line.split(": ") for line in file.read().splitlines())}
+
+
+# cpu time of a process and all of its reaped children
+def _read_proc_cpu_seconds(pid="self") -> float:
+    with open(f"/proc/{pid}/stat", "r") as file:
+        proc_stat = file.read()
+    fields = proc_stat[proc_stat.rindex(")") + 2:].split()  # the process name can contain spaces
+    # utime, stime, cutime, cstime
+    return sum(int(field) for field in fields[11:15]) / os.sysconf("SC_CLK_TCK")
+
+
+def _get_own_cpu_seconds() -> float:
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+
+
+@contextlib.contextmanager
+def profile_step(name: str, category: str = "step"):
+    """
+    Record a block of code. The yielded dict can be updated with more exact measurements, which are kept as they are.
+
+    :param name: A string representing the name of the step or the command.
+    :param category: A string representing the kind of the step, e.g. "step", "bash", "chroot" or "copy".
+    :return: The record of the step
+    """
+    if not profiling:
+        yield {}
+        return
+    if not hasattr(_profile_threads, "stack"):
+        _profile_threads.stack = []
+    stack = _profile_threads.stack
+    record = {"name": name, "category": category, "thread": threading.get_ident(), "depth": len(stack),
+              "nested": {"cpu_seconds": 0.0, "read_bytes": 0, "write_bytes": 0, "read_chars": 0, "write_chars": 0,
+                         "peak_rss_kb": 0}}
+    start_io = _read_proc_io()
+    start_cpu = _get_own_cpu_seconds()
+    start = time.perf_counter()
+    stack.append(record)
+    try:
+        yield record
+    except BaseException:
+        record["failed"] = True
+        raise
+    finally:
+        stack.pop()
+        end_io = _read_proc_io()
+        nested = record.pop("nested")
+        measured = {"start": start - profile_start, "seconds": time.perf_counter() - start,
+                    "cpu_seconds": _get_own_cpu_seconds() - start_cpu + nested["cpu_seconds"],
+                    "read_bytes": end_io["read_bytes"] - start_io["read_bytes"] + nested["read_bytes"],
+                    "write_bytes": end_io["write_bytes"] - start_io["write_bytes"] + nested["write_bytes"],
+                    "read_chars": end_io["rchar"] - start_io["rchar"] + nested["read_chars"],
+                    "write_chars": end_io["wchar"] - start_io["wchar"] + nested["write_chars"],
+                    "peak_rss_kb": nested["peak_rss_kb"] or None}
+        for key, value in measured.items():
+            record.setdefault(key, value)
+        # pass measurements the parent steps can't see themselves on to them
+        external = record.pop("external", False)
+        for parent in stack:
+            if external:
+                for key in ["cpu_seconds", "read_bytes", "write_bytes", "read_chars", "write_chars"]:
+                    parent["nested"][key] += record[key]
+            parent["nested"]["peak_rss_kb"] = max(parent["nested"]["peak_rss_kb"], record["peak_rss_kb"] or 0)
+        with _profile_lock:
+            profile_timeline.append(record)
+
+
+# Decorator to record a whole function as a step
+def profiled(function):
+    @functools.wraps(function)
+    def profiled_function(*args, **kwargs):
+        with profile_step(function.__name__):
+            return function(*args, **kwargs)
+
+    return profiled_function
+
+
+# Write the recorded timeline as json and as a trace file for chrome://tracing or https://ui.perfetto.dev
+def write_profile(json_path: str, trace_path: str) -> None:
+    with _profile_lock:
+        records = sorted(profile_timeline, key=lambda entry: entry["start"])
+    with open(json_path, "w") as file:
+        json.dump({"created": time.time(), "records": records}, file, indent=2)
+    trace_events = [{"name": record["name"][:200], "cat": record["category"], "ph": "X", "pid": os.getpid(),
+                     "tid": record["thread"], "ts": record["start"] * 1000000, "dur": record["seconds"] * 1000000,
+                     "args": {key: value for key, value in record.items()
+                              if key not in ["name", "category", "thread", "start", "seconds"]}}
+                    for record in records]
+    with open(trace_path, "w") as file:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, file)
+
+
+# Print the time difference of every step and command between two json timelines, biggest differences first
+def compare_profiles(old_json_path: str, new_json_path: str, max_rows: int = 40) -> None:
+    def sum_durations(json_path: str) -> tuple:
+        durations = {}
+        total = 0.0
+        with open(json_path, "r") as file:
+            for record in json.load(file)["records"]:
+                key = (record["category"], record["name"])
+                durations[key] = durations.get(key, 0.0) + record["seconds"]
+                if record["depth"] == 0:
+                    total += record["seconds"]
+        return durations, total
+
+    old_durations, old_total = sum_durations(old_json_path)
+    new_durations, new_total = sum_durations(new_json_path)
+    keys = set(old_durations) | set(new_durations)
+    rows = sorted(keys, key=lambda key: abs(new_durations.get(key, 0.0) - old_durations.get(key, 0.0)), reverse=True)
+    print_header(f"{'old':>9} {'new':>9} {'diff':>9}  name")
+    for category, name in rows[:max_rows]:
+        old_seconds = old_durations.get((category, name), 0.0)
+        new_seconds = new_durations.get((category, name), 0.0)
+        print(f"{old_seconds:8.1f}s {new_seconds:8.1f}s {new_seconds - old_seconds:+8.1f}s  [{category}] {name[:100]}")
+    print_header(f"{old_total:8.1f}s {new_total:8.1f}s {new_total - old_total:+8.1f}s  total")
+
+
+#######################################################################################
+#                                    BUILD GRAPH                                      #
+#######################################################################################
+
+class BuildGraph:
+    """
+    Build steps with declared inputs and outputs. A step depends on the steps that produce its inputs and starts as
+    soon as they are done -> independent steps run concurrently in a thread pool. The steps mostly wait for
+    subprocesses, so threads are enough.
+    If a step fails, no new steps are started. Running steps can't be interrupted safely and are waited for, then the
+    teardown functions run in reverse order and the error is raised.
+    """
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers
+        self.steps = {}
+        self.results = {}  # step name -> return value of the step
+        self.timings = {}  # step name -> (start, end) in seconds since run() was called
+        self._teardowns = []
+
+    def add_step(self, name: str, function, inputs: list = None, outputs: list = None) -> None:
+        self.steps[name] = {"function": function, "inputs": inputs or [], "outputs": outputs or []}
+
+    def add_teardown(self, function) -> None:
+        self._teardowns.append(function)
+
+    def get_dependencies(self) -> dict:
+        producers = {}
+        for name, step in self.steps.items():
+            for output in step["outputs"]:
+                if output in producers:
+                    raise ValueError(f"{output} is produced by {producers[output]} and {name}")
+                producers[output] = name
+        dependencies = {}
+        for name, step in self.steps.items():
+            missing = [step_input for step_input in step["inputs"] if step_input not in producers]
+            if missing:
+                raise ValueError(f"No step produces {', '.join(missing)} for {name}")
+            dependencies[name] = {producers[step_input] for step_input in step["inputs"]}
+        # every step has to become ready at some point, otherwise there is a cycle
+        ordered = set()
+        while len(ordered) < len(dependencies):
+            ready = {name for name, deps in dependencies.items() if name not in ordered and deps <= ordered}
+            if not ready:
+                raise ValueError(f"Dependency cycle between {', '.join(sorted(set(dependencies) - ordered))}")
+            ordered |= ready
+        return dependencies
+
+    def run(self) -> None:
+        dependencies = self.get_dependencies()
+        self._start = time.perf_counter()
+        pending = set(self.steps)
+        done = set()
+        running = {}  # future -> step name
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while True:
+                if error is None:
+                    for name in sorted(pending):
+                        if dependencies[name] <= done:
+                            pending.remove(name)
+                            running[pool.submit(self._run_step, name)] = name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(name)
+                    except BaseException as step_error:
+                        print_error(f"Build step {name} failed, waiting for {len(running)} running steps")
+                        error = error or step_error
+        if error is not None:
+            for teardown in reversed(self._teardowns):
+                try:
+                    teardown()
+                except Exception as teardown_error:
+                    print_error(f"Teardown {teardown.__name__} failed: {teardown_error}")
+            raise error
+
+    def _run_step(self, name: str) -> None:
+        start = time.perf_counter() - self._start
+        try:
+            self.results[name] = self.steps[name]["function"]()
+        finally:
+            self.timings[name] = (start, time.perf_counter() - self._start)
+
+    def print_critical_path(self) -> None:
+        # walk back from the last step through the dependency that finished last -> the chain that set the wall time
+        dependencies = self.get_dependencies()
+        path = [max(self.timings, key=lambda name: self.timings[name][1])]
+        while dependencies[path[-1]]:
+            path.append(max(dependencies[path[-1]], key=lambda name: self.timings[name][1]))
+        wall_time = max(end for _, end in self.timings.values())
+        step_time = sum(end - start for start, end in self.timings.values())
+        print_header(f"Critical path: {wall_time:.1f}s wall time, {step_time:.1f}s in all steps "
+                     f"({step_time / max(wall_time, 0.001):.1f}x parallel)")
+        for name in reversed(path):
+            start, end = self.timings[name]
+            print_status(f"{start:8.1f}s {end - start:8.1f}s  {name}")
+
+
 #######################################################################################
 #                                    MISC STUFF                                       #
 #######################################################################################
@@ -148,209 +859,1531 @@ def __prevent_idle():
 # TO AVOID ISSUES: Sync all repos before calling package manager functions
 # The functions below, will start a thread to monitor the progress of their respective package managers
 
-def track_apt(path_to_log: str) -> None:
-    Thread(target=_track_apt, args=(path_to_log,), daemon=True).start()
-
-
-def track_dnf(path_to_log) -> None:
-    Thread(target=_track_dnf, args=(path_to_log,), daemon=True).start()
-
-
-def track_pacman(path_to_log) -> None:
-    # The actual start of this function is at the bottom
-    def _track_pacman() -> None:
-        # As funny as it may sound in python, this function is optimized for performance, due to the huge amount of
-        # disk I/O Therefore some functions could be shorter, but that might increase the already relatively huge load.
-        # wait for install to start
-        while not path_exists(path_to_log):
-            sleep(0.1)
-        # wait for total package amount to appear in log
-        stop = False
-        while not stop:
-            sleep(1)
-            with open(path_to_log, "r") as file:
-                log = file.readlines()
-                for line in log:
-                    if "Old Version  New Version             Net Change  Download Size" in line:
-                        total_packages = int(line.strip().split(" ")[1][1:-1])
-                        stop = True
-                        break
-
-        # wait and find line where packages start to download
-        # Pacman might be resolving dependencies, so we need to wait for that to finish
-        stop = False
-        while not stop:
-            sleep(1)
-            with open(path_to_log, "r") as file:
-                log = file.readlines()
-                for line in log:
-                    if ":: Retrieving packages..." in line:
-                        download_start_index = log.index(line) + 1
-                        stop = True
-                        break
-
-        # Print download progress
-        stop = False
-        downloaded_functions = []
-        while not stop:
-            sleep(1)
-            with open(path_to_log, "r") as file:
-                log = file.readlines()
-                for line in log[download_start_index:]:  # check lines after the start index to increase performance
-                    if ":: Processing package changes..." in line:  # pacman is preparing to install packages
-                        install_start_index = log.index(line) + 1
-                        stop = True
-                        break
-                    package = line.strip()[:-15]
-                    if package not in downloaded_functions:
-                        print(f"Downloading {package}, ({len(downloaded_functions)}/{total_packages})", end="\r",
-                              flush=True)
-                        downloaded_functions.append(package)
-
-        # Print install progress
-        stop = False
-        installed_packages = []
-        while not stop:
-            sleep(1)
-            with open(path_to_log, "r") as file:
-                log = file.readlines()
-                for line in log[
-                            install_start_index:]:  # only check lines after the install start to increase performance
-                    if ":: Running post-transaction hooks..." in line:  # pacman is preparing to run post install hooks
-                        post_install_start_index = log.index(line) + 1
-                        stop = True
-                        break
-                    if "installing " in line:
-                        package = line.strip()[11:-3]
-                        if package not in installed_packages:
-                            print(f"Installing package {package}, ({len(installed_packages)}/{total_packages})",
-                                  end="\r",
-                                  flush=True)
-                            installed_packages.append(package)
-
-        # Monitor postinstall hooks
-        # Don't print the full output, as it might include "scary"-ish messages
-        stop = False
-        while not stop:
-            sleep(1)
-            with open(path_to_log, "r") as file:
-                log = file.readlines()
-                for line in log[post_install_start_index:]:
-                    # pacman has no final success message, so we have to manually check if the install is finished
-                    if not line.startswith("("):  # if the line doesn't start with a number, it's not relevant for us
-                        continue
-                    temp_line = line.strip().split(" ")[0]
-                    # check if this is the last line by comparing the numbers inside the brackets
-                    if temp_line[1:-1].split("/")[0] == temp_line[1:-1].split("/")[1]:
-                        print("Installation finished", flush=True)
-                        stop = True
-                        break
-                    print(f"Running postinstall hooks: {temp_line}", end="\r", flush=True)
-                    installed_packages.append(package)
-
-    Thread(target=_track_pacman, daemon=True).start()
-
-
-# Track progress of apt/apt-get
-def _track_apt(path_to_log) -> None:
-    pass
+# The trackers run a LogFollower in a thread, which waits for new data with inotify (or reads a pipe, if we own the
+# output of the package manager) and never re-reads what it already parsed. A parser per package manager turns the log
+# lines into progress events, which are printed to the terminal and, if a metrics path is given, appended to it as
+# json lines:
+# {"event": "resolved", "packages": 120, "download_size": 157286400, "time": ...}
+# {"event": "downloaded", "package": "...", "count": 3, "total": 120, "bytes": 3145728, "bytes_per_second": ..., ...}
+# {"event": "installed", "package": "...", "count": 3, "total": 120, "time": ...}
+# {"event": "hook", "count": 3, "total": 10, "time": ...}
+# {"event": "complete", "time": ...}
+# The trackers return their LogFollower, call stop() on it if the package manager fails before it completes.
 
+def track_apt(path_to_log: str, metrics_path: str = None):
+    return track_package_manager("apt", path_to_log, metrics_path)
 
-# Track progress of dnf
-def _track_dnf(path_to_log) -> None:
-    pass
+
+def track_dnf(path_to_log: str, metrics_path: str = None):
+    return track_package_manager("dnf", path_to_log, metrics_path)
+
+
+def track_pacman(path_to_log: str, metrics_path: str = None):
+    return track_package_manager("pacman", path_to_log, metrics_path)
+
+
+# package_manager is a key of LOG_PARSERS
+def track_package_manager(package_manager: str, path_to_log: str, metrics_path: str = None):
+    parser = LOG_PARSERS[package_manager]()
+    return LogFollower(parser, path_to_log=path_to_log, metrics_path=metrics_path).start()
+
+
+# inotify flags from sys/inotify.h
+_IN_MODIFY = 0x2
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+
+
+# Watch a directory for created and modified files. Returns None if inotify is not available
+def _inotify_watch(dir_path: str):
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if inotify_fd < 0:
+        return None
+    if libc.inotify_add_watch(inotify_fd, dir_path.encode(),
+                              _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE) < 0:
+        os.close(inotify_fd)
+        return None
+    return inotify_fd
+
+
+class LogFollower:
+    """
+    Follow a log file or a pipe in a thread and pass every line to a parser.
+
+    Memory use doesn't depend on the size of the log: the input is read in fixed size chunks and only the last
+    incomplete line is kept. Without inotify, the file is checked twice per second instead.
+
+    :param parser: An object with a parse(line: str) -> list method, that returns the progress events of a line.
+    :param path_to_log: A string representing the path to a log file. The file doesn't have to exist yet.
+    :param stream: A binary file object to read instead of a log file, e.g. the stdout of the package manager.
+    :param metrics_path: A string representing the path to a file, that the events are appended to as json lines.
+    """
+    _chunk_size = 65536
+    _max_line_length = 65536
+
+    def __init__(self, parser, path_to_log: str = None, stream=None, metrics_path: str = None):
+        self.parser = parser
+        self.path_to_log = path_to_log
+        self.stream = stream
+        self.metrics_path = metrics_path
+        self.completed = False
+        self._partial_line = ""
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._metrics_file = None
+        self._stop_read, self._stop_write = os.pipe()  # written to by stop() to wake up the thread
+        # the thread closes the pipe when it ends -> stop() must not write to the fd after that, it could be reused
+        self._stop_lock = threading.Lock()
+        self._stop_closed = False
+        self._thread = Thread(target=self._follow, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        with self._stop_lock:
+            if not self._stop_closed:
+                os.write(self._stop_write, b"x")
+
+    def join(self, timeout: float = None) -> None:
+        self._thread.join(timeout)
+
+    def _follow(self) -> None:
+        if self.metrics_path is not None:
+            self._metrics_file = open(self.metrics_path, "a")
+        try:
+            if self.stream is not None:
+                self._follow_stream()
+            else:
+                self._follow_file()
+        finally:
+            if self._metrics_file is not None:
+                self._metrics_file.close()
+            with self._stop_lock:
+                self._stop_closed = True
+                os.close(self._stop_read)
+                os.close(self._stop_write)
+
+    def _follow_stream(self) -> None:
+        stream_fd = self.stream.fileno()
+        while True:
+            readable = select.select([stream_fd, self._stop_read], [], [])[0]
+            if self._stop_read in readable:
+                return
+            chunk = os.read(stream_fd, self._chunk_size)
+            if not chunk or self._feed(chunk):  # end of output or package manager finished
+                return
+
+    def _follow_file(self) -> None:
+        # watch the directory, so that the creation of the log is noticed too
+        inotify_fd = _inotify_watch(get_full_path(str(Path(self.path_to_log).parent)))
+        log_file = None
+        try:
+            while True:
+                if log_file is None and path_exists(self.path_to_log):
+                    log_file = open(self.path_to_log, "rb")
+                if log_file is not None:
+                    while chunk := log_file.read(self._chunk_size):
+                        if self._feed(chunk):
+                            return
+                # wait for the next write to the log or for stop()
+                wait_fds = [self._stop_read] if inotify_fd is None else [self._stop_read, inotify_fd]
+                readable = select.select(wait_fds, [], [], 0.5 if inotify_fd is None else None)[0]
+                if self._stop_read in readable:
+                    return
+                if inotify_fd in readable:
+                    with contextlib.suppress(BlockingIOError):
+                        while os.read(inotify_fd, 4096):  # discard the events, the file offset tells what's new
+                            pass
+        finally:
+            if log_file is not None:
+                log_file.close()
+            if inotify_fd is not None:
+                os.close(inotify_fd)
+
+    # Parse all complete lines of a chunk. Returns True when the package manager has finished
+    def _feed(self, chunk: bytes) -> bool:
+        # dnf and apt redraw progress bars with carriage returns -> treat them as line ends too
+        lines = (self._partial_line + self._decoder.decode(chunk)).replace("\r", "\n").split("\n")
+        self._partial_line = lines.pop()[-self._max_line_length:]
+        for line in lines:
+            for event in self.parser.parse(line):
+                event["time"] = time.time()
+                _print_progress_event(event)
+                if self._metrics_file is not None:
+                    self._metrics_file.write(json.dumps(event) + "\n")
+                    self._metrics_file.flush()
+                if event["event"] == "complete":
+                    self.completed = True
+                    return True
+        return False
+
+
+def _print_progress_event(event: dict) -> None:
+    if event["event"] == "resolved":
+        print(f"Resolved {event['packages']} packages", flush=True)
+    elif event["event"] == "downloaded":
+        speed = f", {event['bytes_per_second'] / 1048576:.1f}mb/s" if event.get("bytes_per_second") else ""
+        print(f"Downloading {event['package']}, ({event['count']}/{event['total']}){speed}", end="\r", flush=True)
+    elif event["event"] == "installed":
+        print(f"Installing package {event['package']}, ({event['count']}/{event['total']})", end="\r", flush=True)
+    elif event["event"] == "hook":
+        print(f"Running postinstall hooks: ({event['count']}/{event['total']})", end="\r", flush=True)
+    elif event["event"] == "complete":
+        print("Installation finished", flush=True)
+
+
+class PacmanLogParser:
+    def __init__(self):
+        self.stage = "resolving"
+        self.total_packages = 0
+        self.downloaded_packages = set()
+        self.installed_packages = set()
+
+    def parse(self, line: str) -> list:
+        if self.stage == "resolving":
+            # wait for total package amount to appear in log
+            if "Old Version  New Version             Net Change  Download Size" in line:
+                self.total_packages = int(line.strip().split(" ")[1][1:-1])
+                return [{"event": "resolved", "packages": self.total_packages, "download_size": None}]
+            # Pacman might be resolving dependencies, so we need to wait for the download to start
+            if ":: Retrieving packages..." in line:
+                self.stage = "downloading"
+        elif self.stage == "downloading":
+            if ":: Processing package changes..." in line:  # pacman is preparing to install packages
+                self.stage = "installing"
+                return []
+            # the checks of the keyring and the packages are printed while downloading too
+            package = line.strip()[:-15] if line.rstrip().endswith(" downloading...") else ""
+            if package and package not in self.downloaded_packages:
+                self.downloaded_packages.add(package)
+                return [{"event": "downloaded", "package": package, "count": len(self.downloaded_packages),
+                         "total": self.total_packages}]
+        elif self.stage == "installing":
+            if ":: Running post-transaction hooks..." in line:  # pacman is preparing to run post install hooks
+                self.stage = "hooks"
+            elif "installing " in line:
+                package = line.strip()[11:-3]
+                if package not in self.installed_packages:
+                    self.installed_packages.add(package)
+                    return [{"event": "installed", "package": package, "count": len(self.installed_packages),
+                             "total": self.total_packages}]
+        elif self.stage == "hooks":
+            # Don't print the full output, as it might include "scary"-ish messages
+            # pacman has no final success message, so we have to manually check if the install is finished
+            if line.startswith("("):  # if the line doesn't start with a number, it's not relevant for us
+                current, total = line.strip().split(" ")[0][1:-1].split("/")
+                if current == total:
+                    return [{"event": "complete"}]
+                return [{"event": "hook", "count": int(current), "total": int(total)}]
+        return []
+
+
+class DnfLogParser:
+    # "(3/120): bash-5.2.15-1.fc37.x86_64.rpm      1.2 MB/s | 1.8 MB     00:01"
+    _download_line = re.compile(r"^\((\d+)/(\d+)\): (\S+)\s+.*\| +([\d.]+) +([kMG]?B) ")
+    # "  Installing       : bash-5.2.15-1.fc37.x86_64                      3/120"
+    _install_line = re.compile(r"^ +(Installing|Upgrading|Reinstalling|Downgrading) +: (\S+) +(\d+)/(\d+)")
+    # "Install  118 Packages" or "Upgrade    2 Packages" in the transaction summary
+    _summary_line = re.compile(r"^(Install|Upgrade|Remove|Downgrade|Reinstall) +(\d+) Packages?")
+    _units = {"B": 1, "kB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+
+    def __init__(self):
+        self.total_packages = 0
+        self.download_size = None
+        self.download_start = None
+        self.downloaded_bytes = 0
+        self.downloaded_packages = set()
+        self.installed_packages = set()
+
+    def parse(self, line: str) -> list:
+        if match := self._summary_line.match(line):
+            if match.group(1) in ["Install", "Upgrade", "Downgrade", "Reinstall"]:
+                self.total_packages += int(match.group(2))
+        elif line.startswith("Total download size:"):
+            size, unit = line.split(":")[1].split()
+            self.download_size = int(float(size) * self._units.get(unit + "B", 1))
+        elif line.startswith("Downloading Packages:"):
+            self.download_start = time.monotonic()
+            return [{"event": "resolved", "packages": self.total_packages, "download_size": self.download_size}]
+        elif match := self._download_line.match(line):
+            package = match.group(3)
+            if package not in self.downloaded_packages:
+                self.downloaded_packages.add(package)
+                self.downloaded_bytes += int(float(match.group(4)) * self._units[match.group(5)])
+                elapsed = time.monotonic() - (self.download_start or time.monotonic())
+                return [{"event": "downloaded", "package": package, "count": len(self.downloaded_packages),
+                         "total": int(match.group(2)), "bytes": self.downloaded_bytes,
+                         "bytes_per_second": self.downloaded_bytes / elapsed if elapsed else None}]
+        elif match := self._install_line.match(line):
+            package = match.group(2)
+            if package not in self.installed_packages:
+                self.installed_packages.add(package)
+                return [{"event": "installed", "package": package, "count": len(self.installed_packages),
+                         "total": int(match.group(4))}]
+        elif line.startswith("Complete!"):
+            return [{"event": "complete"}]
+        return []
+
+
+class AptLogParser:
+    # "Get:12 http://archive.ubuntu.com/ubuntu jammy/main amd64 bash amd64 5.1-6ubuntu1 [769 kB]"
+    _download_line = re.compile(r"^Get:\d+ \S+ \S+ (?:\S+ )?(\S+) \S+ \S+ \[([\d,.]+) ([kMG]?B)\]")
+    # "2 upgraded, 118 newly installed, 0 to remove and 3 not upgraded."
+    _summary_line = re.compile(r"^(\d+) upgraded, (\d+) newly installed")
+    _units = {"B": 1, "kB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3}  # apt uses SI units
+
+    def __init__(self):
+        self.total_packages = 0
+        self.download_size = None
+        self.download_start = None
+        self.downloaded_bytes = 0
+        self.downloaded_packages = set()
+        self.installed_packages = set()
+
+    def _to_bytes(self, size: str, unit: str) -> int:
+        return int(float(size.replace(",", "")) * self._units[unit])
+
+    def parse(self, line: str) -> list:
+        if match := self._summary_line.match(line):
+            self.total_packages = int(match.group(1)) + int(match.group(2))
+        elif line.startswith("Need to get "):
+            size, unit = line.split()[3:5]
+            self.download_size = self._to_bytes(size.split("/")[-1], unit)
+            self.download_start = time.monotonic()
+            return [{"event": "resolved", "packages": self.total_packages, "download_size": self.download_size}]
+        elif match := self._download_line.match(line):
+            package = match.group(1)
+            if package not in self.downloaded_packages:
+                self.downloaded_packages.add(package)
+                self.downloaded_bytes += self._to_bytes(match.group(2), match.group(3))
+                elapsed = time.monotonic() - (self.download_start or time.monotonic())
+                return [{"event": "downloaded", "package": package, "count": len(self.downloaded_packages),
+                         "total": self.total_packages, "bytes": self.downloaded_bytes,
+                         "bytes_per_second": self.downloaded_bytes / elapsed if elapsed else None}]
+        elif line.startswith("Setting up "):
+            package = line.split()[2]
+            if package not in self.installed_packages:
+                self.installed_packages.add(package)
+                events = [{"event": "installed", "package": package, "count": len(self.installed_packages),
+                           "total": self.total_packages}]
+                # apt has no final success message -> finished once every package is set up
+                if len(self.installed_packages) >= self.total_packages:
+                    events.append({"event": "complete"})
+                return events
+        return []
+
+
+# Parser for each supported package manager, used by the track_* functions
+LOG_PARSERS = {
+    "apt": AptLogParser,
+    "dnf": DnfLogParser,
+    "pacman": PacmanLogParser,
+}
 
 
 #######################################################################################
 #                              FILE PROGRESS MONITOR FUNCTIONS                        #
 #######################################################################################
 
-def extract_file(file: str, dest: str) -> None:
+# Magic bytes at the start of the supported compressed archives
+_ARCHIVE_MAGIC = {b"\xfd7zXZ\x00": "xz", b"\x28\xb5\x2f\xfd": "zstd", b"\x1f\x8b": "gz"}
+_EXTRACT_CHUNK_SIZE = 1024 ** 2
+
+
+def get_compression(file: str) -> str:
+    with open(file, "rb") as archive:
+        header = archive.read(6)
+    for magic, compression in _ARCHIVE_MAGIC.items():
+        if header.startswith(magic):
+            return compression
+    return "none"
+
+
+def get_decompressor(file: str) -> list:
     """
-    Extract a compressed file using tar and use pv to show progress if pv is installed.
+    Get the fastest available command that decompresses the archive from stdin to stdout.
+
+    :param file: A string representing the full path to the compressed file.
+    :return: A list with the command and its arguments, empty for uncompressed archives.
+    """
+    threads = str(os.cpu_count() or 1)
+    compression = get_compression(file)
+    if compression == "xz":
+        # only archives with multiple xz blocks can be decoded in parallel, the block count is in the xz index
+        # robot mode output is tab separated -> "totals streams blocks compressed uncompressed ..."
+        blocks = int(bash(f"xz --robot --list {file} | grep '^totals'").split("\t")[2])
+        if blocks < 2:
+            return ["xz", "-dc"]
+        if shutil.which("pixz"):
+            return ["pixz", "-d", "-p", threads]
+        return ["xz", "-dc", f"-T{threads}"]  # xz 5.4+ decodes blocks in parallel, older versions use one thread
+    if compression == "zstd":
+        # pzstd decodes multi frame archives in parallel
+        return ["pzstd", "-dc", "-p", threads] if shutil.which("pzstd") else ["zstd", "-dc"]
+    if compression == "gz":
+        return ["pigz", "-dc"] if shutil.which("pigz") else ["gzip", "-dc"]
+    return []
+
+
+def _print_extract_progress(done: int, total: int, seconds: float) -> None:
+    speed = done / 1048576 / max(seconds, 0.001)
+    print(f"\rExtracting: {done / 1048576:.0f}mb / {total / 1048576:.0f}mb, {speed:.0f}mb/s",
+          end="" if done < total else "\n", flush=True)
+
+
+def extract_file(file: str, dest: str, progress_callback=None) -> None:
+    """
+    Extract a compressed tar archive into a directory.
+    The archive is streamed through the fastest available decompressor straight into tar, see get_decompressor().
 
     :param file: A string representing the full path to the compressed file to be extracted.
     :param dest: A string representing the full destination directory where the extracted files will be extracted to.
+    :param progress_callback: A function called with the read compressed bytes, the archive size and the elapsed
+        seconds. Progress is printed by default if the terminal is interactive.
     :return: None
     """
-    if no_extract_progress:  # for non-interactive shells only
-        if file.endswith(".gz"):
-            # --warning=no-unknown-keyword is to supress a warning about unknown headers in the arch rootfs
-            bash(f"tar xfpz {file} --warning=no-unknown-keyword -C {dest}")
-        elif file.endswith(".xz"):
-            bash(f"tar xfpJ {file} -C {dest}")
-        return
+    if progress_callback is None and not no_extract_progress:
+        progress_callback = _print_extract_progress
+    decompressor = get_decompressor(file)
+    # --warning=no-unknown-keyword is to supress a warning about unknown headers in the arch rootfs
+    tar_command = ["tar", "xpf", "-", "--warning=no-unknown-keyword", "-C", dest]
+    total_size = os.path.getsize(file)
+    with profile_step(f"extract {file}", "extract") as record:
+        start = time.perf_counter()
+        if decompressor:
+            decoder = subprocess.Popen(decompressor, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            tar = subprocess.Popen(tar_command, stdin=decoder.stdout)
+            decoder.stdout.close()  # only tar reads the decompressed stream
+            processes = [decoder, tar]
+        else:
+            tar = subprocess.Popen(tar_command, stdin=subprocess.PIPE)
+            processes = [tar]
+        # feeding the archive from here costs little and tells how far the extraction is
+        done_size = 0
+        last_report = 0
+        try:
+            with open(file, "rb") as archive:
+                while chunk := archive.read(_EXTRACT_CHUNK_SIZE):
+                    processes[0].stdin.write(chunk)
+                    done_size += len(chunk)
+                    if progress_callback is not None and time.monotonic() - last_report > 0.5:
+                        last_report = time.monotonic()
+                        progress_callback(done_size, total_size, time.perf_counter() - start)
+            processes[0].stdin.close()
+        except BrokenPipeError:
+            # the exit status of the failed process is the more useful error
+            with contextlib.suppress(BrokenPipeError):
+                processes[0].stdin.close()
+        for process in processes:
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+        seconds = time.perf_counter() - start
+        if progress_callback is not None:
+            progress_callback(done_size, total_size, seconds)
+        record.update({"decompressor": " ".join(decompressor), "mb_per_second": total_size / 1048576 / seconds})
+
+
+def create_archive(src: str, archive: str, block_size: int = 64 * 1024 ** 2) -> None:
+    """
+    Create a tar archive of a directory that is compressed in independent blocks.
+    Block compressed archives are seekable and can be decompressed in parallel by extract_file().
 
-    if file.endswith(".gz"):
-        # --warning=no-unknown-keyword is to supress a warning about unknown headers in the arch rootfs
-        bash(f"pv {file} | tar xfpz - --warning=no-unknown-keyword -C {dest}")
-    elif file.endswith(".xz"):
-        bash(f"pv {file} | tar xfpJ - -C {dest}")
+    :param src: A string representing the full path to the directory to be archived.
+    :param archive: A string representing the full path to the archive, ending in .xz or .zst.
+    :param block_size: An int representing the uncompressed size of each xz block in bytes.
+    :return: None
+    """
+    threads = str(os.cpu_count() or 1)
+    if archive.endswith(".zst"):
+        # pzstd writes independent frames, zstd -T0 would write a single frame that can only be decoded serially
+        compressor = ["pzstd", "-p", threads, "-c"] if shutil.which("pzstd") else ["zstd", f"-T{threads}", "-c"]
+    elif archive.endswith(".xz"):
+        # the block offsets are stored in the xz index at the end of the archive
+        compressor = ["xz", f"-T{threads}", f"--block-size={block_size}", "-c"]
+    else:
+        raise ValueError(f"Unsupported archive format: {archive}")
+    with profile_step(f"archive {src}", "archive"):
+        # write to a temp file first, so that an interrupted run never leaves a truncated archive behind
+        with open(f"{archive}.tmp", "wb") as output:
+            tar = subprocess.Popen(["tar", "-C", src, "--xattrs", "--xattrs-include=*", "--acls", "--numeric-owner",
+                                    "-cpf", "-", "."], stdout=subprocess.PIPE)
+            encoder = subprocess.Popen(compressor, stdin=tar.stdout, stdout=output)
+            tar.stdout.close()
+            for process in [tar, encoder]:
+                if process.wait() != 0:
+                    raise subprocess.CalledProcessError(process.returncode, process.args)
+        os.replace(f"{archive}.tmp", archive)
+
+
+def download_file(url: str, path: str, sha256: str = None, progress_callback=None) -> None:
+    """
+    Download a file through the download cache and copy it to the destination.
 
+    :param url: A string representing the url of the file.
+    :param path: A string representing the full destination path of the downloaded file.
+    :param sha256: A string representing the expected sha256 of the file. The download fails if it doesn't match.
+    :param progress_callback: A function called with the downloaded bytes, the file size and the elapsed seconds.
+        Progress is printed by default if the terminal is interactive.
+    :return: None
+    """
+    if progress_callback is None and not no_download_progress:
+        progress_callback = _print_download_progress
+    cached_file = _download_to_cache(url, progress_callback)
+    # cached objects are named after their sha256, which was calculated while downloading
+    if sha256 is not None and cached_file.name != sha256.lower():
+        raise ValueError(f"Checksum mismatch for {url}: expected {sha256}, got {cached_file.name}")
+    shutil.copyfile(cached_file, path)
+
+
+def _print_download_progress(done: int, total: int, seconds: float) -> None:
+    speed = done / 1048576 / max(seconds, 0.001)
+    print(f"\rDownloading: {done / 1048576:.0f}mb / {total / 1048576:.0f}mb, {speed:.0f}mb/s",
+          end="" if done < total else "\n", flush=True)
+
+
+#######################################################################################
+#                                    DOWNLOAD CACHE                                   #
+#######################################################################################
+# Downloads are stored content-addressed in objects/<sha256>. index.json maps each url to its object and the
+# ETag/Last-Modified validators of the server, which are used to revalidate the cached file on the next download.
+# Interrupted downloads are kept in partial/ and resumed with a Range request.
+# Large files are downloaded in parallel Range segments into a preallocated partial file. The segments that are done
+# are recorded in partial/<hash>.segments, so that an interrupted segmented download resumes every segment.
+DOWNLOAD_SEGMENTS = 8
+DOWNLOAD_SEGMENT_MIN_SIZE = 16 * 1024 ** 2
 
-def download_file(url: str, path: str) -> None:
-    # start monitor in a separate thread
-    if no_download_progress:  # for non-interactive shells only
-        # start download
-        urlretrieve(url=url, filename=path)
-        return
 
-    # get total file size from server
-    total_file_size = int(urlopen(url).headers["Content-Length"])
-    Thread(target=_print_download_progress, args=(Path(path), total_file_size,), daemon=True).start()
+def set_download_cache(cache_dir: str, max_size: int) -> None:
+    global download_cache_dir, download_cache_max_size
+    download_cache_dir = Path(cache_dir)
+    download_cache_max_size = max_size
 
-    # start download
-    urlretrieve(url=url, filename=path)
 
-    # stop monitor
-    open(".stop_download_progress", "a").close()
-    print("\n", end="")
+def _read_cache_index() -> dict:
+    try:
+        with open(download_cache_dir / "index.json", "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_cache_index(index: dict) -> None:
+    # write to a temp file first, so that an interrupted write can't corrupt the index
+    temp_index = download_cache_dir / "index.json.tmp"
+    with open(temp_index, "w") as file:
+        json.dump(index, file, indent=2)
+    os.replace(temp_index, download_cache_dir / "index.json")
+
+
+# Delete the least recently used objects until the cache fits into its size limit again
+def _evict_cache(index: dict, keep_url: str) -> None:
+    total_size = sum(entry["size"] for entry in index.values())
+    for url in sorted(index, key=lambda key: index[key]["last_used"]):
+        if total_size <= download_cache_max_size:
+            break
+        if url == keep_url:  # never evict the file that is being downloaded right now
+            continue
+        entry = index.pop(url)
+        total_size -= entry["size"]
+        # two urls can point to the same content, only delete objects that are no longer referenced
+        if entry["sha256"] not in [other_entry["sha256"] for other_entry in index.values()]:
+            rmfile(str(download_cache_dir / "objects" / entry["sha256"]))
+
+
+# Raised when the file on the server changed while its segments were downloaded
+class _FileChangedError(Exception):
+    pass
+
 
+def _download_to_cache(url: str, progress_callback=None, allow_resume: bool = True) -> Path:
+    mkdir(str(download_cache_dir / "objects"), create_parents=True)
+    mkdir(str(download_cache_dir / "partial"), create_parents=True)
+    index = _read_cache_index()
+    entry = index.get(url)
+    if entry is not None and not (download_cache_dir / "objects" / entry["sha256"]).exists():
+        entry = None  # object was deleted manually
+
+    headers = {}
+    # revalidate cached file: the server only sends the body if it changed
+    if entry is not None:
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+    # resume a previously interrupted download, If-Range makes the server send the full file if it changed since
+    partial_file = download_cache_dir / "partial" / hashlib.sha256(url.encode()).hexdigest()
+    partial_validator_file = partial_file.with_suffix(".validator")
+    segments_file = partial_file.with_suffix(".segments")
+    if not allow_resume:
+        rmfile(str(partial_file))
+        rmfile(str(segments_file))
+    partial_size = partial_file.stat().st_size if partial_file.exists() else 0
+    # the partial file of a segmented download is preallocated -> its size says nothing about the progress
+    if partial_size and partial_validator_file.exists() and not segments_file.exists():
+        headers["Range"] = f"bytes={partial_size}-"
+        headers["If-Range"] = partial_validator_file.read_text()
 
-def _print_download_progress(file_path: Path, total_size) -> None:
-    while True:
-        if path_exists(".stop_download_progress"):
-            rmfile(".stop_download_progress")
+    try:
+        response = urlopen(Request(url, headers=headers))
+    except HTTPError as error:
+        if error.code == 304:  # cached file is still up-to-date
+            with _download_cache_lock:
+                index = _read_cache_index()  # another download may have changed it in the meantime
+                entry["last_used"] = time.time()
+                index[url] = entry
+                _write_cache_index(index)
+            return download_cache_dir / "objects" / entry["sha256"]
+        if error.code == 416 and "Range" in headers:  # partial file is broken -> download from scratch
+            return _download_to_cache(url, progress_callback, allow_resume=False)
+        raise
+
+    with response:
+        etag = response.headers["ETag"]
+        last_modified = response.headers["Last-Modified"]
+        # weak etags can't be used for range requests
+        validator = etag if etag and not etag.startswith("W/") else last_modified
+        if validator:
+            partial_validator_file.write_text(validator)
+        else:
+            rmfile(str(partial_validator_file))
+        # the size comes from the same response that streams the body
+        content_length = int(response.headers["Content-Length"] or 0)
+        if response.status == 206:
+            total_size = partial_size + content_length
+        else:
+            total_size = content_length
+            partial_size = 0
+
+        if (response.status == 200 and validator and response.headers["Accept-Ranges"] == "bytes"
+                and total_size >= DOWNLOAD_SEGMENT_MIN_SIZE * 2):
+            response.close()  # every segment requests its own range
+            try:
+                digest = _download_segments(url, partial_file, total_size, validator, progress_callback)
+            except _FileChangedError:
+                return _download_to_cache(url, progress_callback, allow_resume=False)
+            downloaded_size = total_size
+        else:
+            rmfile(str(segments_file))
+            digest, downloaded_size = _download_stream(response, partial_file, partial_size, total_size,
+                                                       progress_callback)
+
+    cached_file = download_cache_dir / "objects" / digest
+    os.replace(partial_file, cached_file)  # replaces identical content from another url too
+    rmfile(str(partial_validator_file))
+    with _download_cache_lock:
+        index = _read_cache_index()  # another download may have changed it in the meantime
+        index[url] = {"sha256": digest, "size": downloaded_size, "etag": etag, "last_modified": last_modified,
+                      "last_used": time.time()}
+        _evict_cache(index, keep_url=url)
+        _write_cache_index(index)
+    return cached_file
+
+
+# Download the body of a response in one stream, appending to the partial file if the download is resumed
+def _download_stream(response, partial_file: Path, partial_size: int, total_size: int, progress_callback) -> tuple:
+    sha256 = hashlib.sha256()
+    if partial_size:  # resuming -> hash the already downloaded part
+        with open(partial_file, "rb") as file:
+            while chunk := file.read(1048576):
+                sha256.update(chunk)
+    start = time.perf_counter()
+    downloaded_size = partial_size
+    last_report = 0
+    with open(partial_file, "ab" if partial_size else "wb") as file:
+        while chunk := response.read(1048576):
+            file.write(chunk)
+            sha256.update(chunk)
+            downloaded_size += len(chunk)
+            if progress_callback is not None and time.monotonic() - last_report > 0.5:
+                last_report = time.monotonic()
+                progress_callback(downloaded_size, total_size, time.perf_counter() - start)
+    if progress_callback is not None:
+        progress_callback(downloaded_size, total_size, time.perf_counter() - start)
+    if total_size and downloaded_size != total_size:
+        # keep the partial file, the next download will resume it
+        raise ConnectionError(f"Download of {response.url} ended after {downloaded_size} of {total_size} bytes")
+    return sha256.hexdigest(), downloaded_size
+
+
+# Get the end of the data that was downloaded without gaps from the start of the file
+def _get_contiguous_size(segments: list) -> int:
+    for segment_start, segment_end, done in segments:
+        if segment_start + done < segment_end:
+            return segment_start + done
+    return segments[-1][1]
+
+
+def _download_segments(url: str, partial_file: Path, total_size: int, validator: str, progress_callback) -> str:
+    segments_file = partial_file.with_suffix(".segments")
+    segments = None
+    if segments_file.exists() and partial_file.exists():
+        state = json.loads(segments_file.read_text())
+        if state["validator"] == validator and state["size"] == total_size:
+            segments = state["segments"]
+    if segments is None:
+        segment_size = max(DOWNLOAD_SEGMENT_MIN_SIZE, -(-total_size // DOWNLOAD_SEGMENTS))
+        segments = [[offset, min(offset + segment_size, total_size), 0]  # start, end, downloaded bytes
+                    for offset in range(0, total_size, segment_size)]
+        with open(partial_file, "wb") as file:
+            file.truncate(total_size)  # sparse, the segments fill it in any order
+
+    progress = threading.Condition()
+    failed = threading.Event()
+
+    def download_segment(segment: list) -> None:
+        if segment[0] + segment[2] >= segment[1]:
             return
+        # If-Range: the server sends the whole file instead of the range if it changed since the first request
+        request = Request(url, headers={"Range": f"bytes={segment[0] + segment[2]}-{segment[1] - 1}",
+                                        "If-Range": validator})
+        with urlopen(request) as response:
+            if response.status != 206:
+                raise _FileChangedError(url)
+            while not failed.is_set() and (chunk := response.read(1048576)):
+                os.pwrite(file_fd, chunk, segment[0] + segment[2])
+                with progress:
+                    segment[2] += len(chunk)
+                    progress.notify_all()
+        if segment[0] + segment[2] < segment[1] and not failed.is_set():
+            raise ConnectionError(f"Segment {segment[0]}-{segment[1]} of {url} ended early")
+
+    # the file is hashed in order while the segments are still downloading, the data is still in the page cache
+    sha256 = hashlib.sha256()
+    hashed_size = 0
+    start = time.perf_counter()
+    last_report = 0
+    file_fd = os.open(partial_file, os.O_RDWR)
+    try:
+        with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+            downloads = [pool.submit(download_segment, segment) for segment in segments]
+            try:
+                while hashed_size < total_size:
+                    with progress:
+                        while (contiguous_size := _get_contiguous_size(segments)) == hashed_size:
+                            if any(download.done() and download.exception() for download in downloads):
+                                raise next(download.exception() for download in downloads
+                                           if download.done() and download.exception())
+                            if all(download.done() for download in downloads):
+                                raise ConnectionError(f"Download of {url} ended early")
+                            progress.wait(0.5)
+                        done_size = sum(segment[2] for segment in segments)
+                    while hashed_size < contiguous_size:
+                        chunk = os.pread(file_fd, min(1048576, contiguous_size - hashed_size), hashed_size)
+                        sha256.update(chunk)
+                        hashed_size += len(chunk)
+                    if progress_callback is not None and time.monotonic() - last_report > 0.5:
+                        last_report = time.monotonic()
+                        progress_callback(done_size, total_size, time.perf_counter() - start)
+            except BaseException:
+                failed.set()  # stop the other segments, they are resumed with the next download
+                raise
+            finally:
+                for download in downloads:
+                    with contextlib.suppress(BaseException):
+                        download.result()
+                segments_file.write_text(json.dumps({"validator": validator, "size": total_size,
+                                                     "segments": segments}))
+    finally:
+        os.close(file_fd)
+    if progress_callback is not None:
+        progress_callback(total_size, total_size, time.perf_counter() - start)
+    rmfile(str(segments_file))
+    return sha256.hexdigest()
+
+
+#######################################################################################
+#                                    DEDUPLICATION                                    #
+#######################################################################################
+# Replace identical regular files in a tree with hardlinks (or reflinks) to one copy. Files are only compared if they
+# have the same size, mode, owner, mtime and xattrs (which includes the SELinux label), so a link never changes how a
+# file looks to the system or to rpm -V, apart from its link count. Candidates are narrowed down in rounds: first by
+# size and metadata, then by a hash of their first block, and only the files that still match are hashed completely.
+DEDUP_PREFIX_SIZE = 64 * 1024
+
+
+def dedup_tree(root: str, reflink: bool = False) -> tuple:
+    """
+    Link identical files in a directory tree to a single copy.
+
+    :param root: A string representing the directory to deduplicate.
+    :param reflink: Share the data with reflinks instead of hardlinks. Needs btrfs or xfs, every file keeps its inode.
+    :return: A tuple of the number of replaced files and the bytes saved.
+    """
+    # all paths of a file are collected, so that an inode that already has hardlinks is handled as one file
+    inodes = {}  # (dev, inode) -> [stat, paths]
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    entry_stat = entry.stat(follow_symlinks=False)
+                    if entry_stat.st_size > 0:  # empty files don't use any blocks
+                        inodes.setdefault((entry_stat.st_dev, entry_stat.st_ino), [entry_stat, []])[1].append(
+                            entry.path)
+    buckets = _group_files(inodes.values(), lambda file: (file[0].st_size, file[0].st_mode, file[0].st_uid,
+                                                          file[0].st_gid, file[0].st_mtime_ns))
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as pool:
+        buckets = _split_buckets(pool, buckets, lambda file: _get_xattrs(file[1][0]))
+        buckets = _split_buckets(pool, buckets, lambda file: _hash_file(file[1][0], DEDUP_PREFIX_SIZE))
+        # the prefix hash of files that fit into the prefix already is their full hash
+        buckets = [bucket for bucket in buckets if bucket[0][0].st_size <= DEDUP_PREFIX_SIZE] + _split_buckets(
+            pool, [bucket for bucket in buckets if bucket[0][0].st_size > DEDUP_PREFIX_SIZE],
+            lambda file: _hash_file(file[1][0]))
+
+    replaced_files = 0
+    saved_bytes = 0
+    for bucket in buckets:
+        # keep the file that already has the most links, fewer paths have to be replaced
+        bucket.sort(key=lambda file: (-len(file[1]), file[1][0]))
+        keeper = bucket[0][1][0]
+        for file_stat, paths in bucket[1:]:
+            for path in paths:
+                _replace_with_link(keeper, path, reflink)
+                replaced_files += 1
+            # the blocks are only freed once the last link is gone, links outside the tree keep them allocated
+            if file_stat.st_nlink == len(paths):
+                saved_bytes += file_stat.st_blocks * 512
+    if verbose:
+        print(f"Deduplicated {replaced_files} files in {root}, saved {saved_bytes / 1048576:.0f}mb", flush=True)
+    return replaced_files, saved_bytes
+
+
+# Group files by a key and drop the groups of single files, they have no duplicates
+def _group_files(files, get_key) -> list:
+    groups = {}
+    for file in files:
+        groups.setdefault(get_key(file), []).append(file)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+# Split the buckets further by a key that is computed in the pool, e.g. a hash of the file contents
+def _split_buckets(pool: ThreadPoolExecutor, buckets: list, get_key) -> list:
+    keys = [pool.map(get_key, bucket) for bucket in buckets]
+    split = []
+    for bucket, bucket_keys in zip(buckets, keys):
+        split += _group_files(zip(bucket_keys, bucket), lambda keyed_file: keyed_file[0])
+    return [[file for _, file in group] for group in split]
+
+
+def _get_xattrs(path: str) -> tuple:
+    with contextlib.suppress(OSError):  # filesystems without xattr support
+        return tuple(sorted((name, os.getxattr(path, name, follow_symlinks=False))
+                            for name in os.listxattr(path, follow_symlinks=False)))
+    return ()
+
+
+def _hash_file(path: str, size: int = None) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        if size is not None:
+            sha256.update(file.read(size))
+        else:
+            while chunk := file.read(1048576):
+                sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# Atomically replace a file with a link to another one: the link is created next to it and renamed over it
+def _replace_with_link(src: str, dst: str, reflink: bool) -> None:
+    temp_path = f"{dst}.dedup-tmp"
+    rmfile(temp_path)
+    try:
+        if reflink:
+            dst_stat = os.stat(dst, follow_symlinks=False)
+            with open(src, "rb") as src_file, open(temp_path, "wb") as temp_file:
+                fcntl.ioctl(temp_file.fileno(), _FICLONE, src_file.fileno())
+            _copy_metadata(dst, temp_path, dst_stat, preserve_owner=True)
+        else:
+            os.link(src, temp_path)
+        os.replace(temp_path, dst)
+    except OSError:
+        rmfile(temp_path)
+        raise
+
+
+#######################################################################################
+#                                    GPT                                              #
+#######################################################################################
+# Write a GUID partition table into an image file directly, without parted or a loop device.
+# Partitions are dicts with "name", "type" (GUID), "start" and "size" in bytes and optionally "guid" and "attributes".
+GPT_SECTOR_SIZE = 512
+GPT_ENTRIES = 128
+GPT_ENTRY_SIZE = 128
+GPT_TYPE_CHROMEOS_KERNEL = "fe3a2a5d-4f32-41a7-b725-accc3285a309"
+GPT_TYPE_EFI = "c12a7328-f81f-11d2-ba4b-00a0c93ec93b"
+GPT_TYPE_LINUX = "0fc63daf-8483-4772-8e79-3d69d8477de4"
+
+
+# Attribute bits depthcharge uses to pick the kernel partition to boot, same as cgpt add -P -T -S
+def get_chromeos_kernel_attributes(priority: int, tries: int, successful: bool) -> int:
+    return priority << 48 | tries << 52 | int(successful) << 56
+
+
+def write_gpt(image_path: str, partitions: list) -> None:
+    image_sectors = os.stat(image_path).st_size // GPT_SECTOR_SIZE
+    entry_sectors = GPT_ENTRIES * GPT_ENTRY_SIZE // GPT_SECTOR_SIZE
+    first_usable = 2 + entry_sectors
+    last_usable = image_sectors - 2 - entry_sectors
+
+    entries = b""
+    for partition in partitions:
+        start = partition["start"] // GPT_SECTOR_SIZE
+        end = start + partition["size"] // GPT_SECTOR_SIZE - 1  # inclusive
+        if start < first_usable or end > last_usable:
+            raise ValueError(f"Partition {partition['name']} doesn't fit into {image_path}")
+        entries += struct.pack("<16s16sQQQ72s", uuid.UUID(partition["type"]).bytes_le,
+                               uuid.UUID(partition.get("guid") or str(uuid.uuid4())).bytes_le, start, end,
+                               partition.get("attributes", 0), partition["name"].encode("utf-16-le"))
+    entries = entries.ljust(GPT_ENTRIES * GPT_ENTRY_SIZE, b"\0")
+    disk_guid = uuid.uuid4().bytes_le
+
+    def pack_header(current_lba: int, backup_lba: int, entries_lba: int) -> bytes:
+        fields = [b"EFI PART", 0x00010000, 92, 0, 0, current_lba, backup_lba, first_usable, last_usable, disk_guid,
+                  entries_lba, GPT_ENTRIES, GPT_ENTRY_SIZE, zlib.crc32(entries)]
+        header_crc = zlib.crc32(struct.pack("<8sIIIIQQQQ16sQIII", *fields))
+        fields[3] = header_crc
+        return struct.pack("<8sIIIIQQQQ16sQIII", *fields).ljust(GPT_SECTOR_SIZE, b"\0")
+
+    # protective mbr: one partition of type 0xee over the whole disk, so that old tools don't touch it
+    mbr_entry = struct.pack("<B3sB3sII", 0, b"\x00\x02\x00", 0xEE, b"\xff\xff\xff", 1,
+                            min(image_sectors - 1, 0xFFFFFFFF))
+    mbr = bytes(446) + mbr_entry + bytes(48) + b"\x55\xaa"
+
+    with open(image_path, "r+b") as image:
+        os.pwrite(image.fileno(), mbr, 0)
+        os.pwrite(image.fileno(), pack_header(1, image_sectors - 1, 2), GPT_SECTOR_SIZE)
+        os.pwrite(image.fileno(), entries, 2 * GPT_SECTOR_SIZE)
+        # the backup table is at the end of the disk: the entries, followed by the header in the last sector
+        os.pwrite(image.fileno(), entries, (image_sectors - 1 - entry_sectors) * GPT_SECTOR_SIZE)
+        os.pwrite(image.fileno(), pack_header(image_sectors - 1, 1, image_sectors - 1 - entry_sectors),
+                  (image_sectors - 1) * GPT_SECTOR_SIZE)
+
+
+# Read the partitions of the primary gpt of an image or device, in the same format write_gpt() takes
+def read_gpt(image_path: str) -> list:
+    with open(image_path, "rb") as image:
+        header = os.pread(image.fileno(), 92, GPT_SECTOR_SIZE)
+        fields = list(struct.unpack("<8sIIIIQQQQ16sQIII", header))
+        if fields[0] != b"EFI PART":
+            raise ValueError(f"{image_path} has no gpt")
+        header_crc = fields[3]
+        fields[3] = 0
+        if zlib.crc32(struct.pack("<8sIIIIQQQQ16sQIII", *fields)) != header_crc:
+            raise ValueError(f"The gpt header of {image_path} is corrupted")
+        entries_lba, entry_count, entry_size = fields[10:13]
+        entries = os.pread(image.fileno(), entry_count * entry_size, entries_lba * GPT_SECTOR_SIZE)
+    partitions = []
+    for index in range(entry_count):
+        type_guid, guid, start, end, attributes, name = struct.unpack_from("<16s16sQQQ72s", entries,
+                                                                           index * entry_size)
+        if type_guid == bytes(16):  # unused entry
+            continue
+        partitions.append({"index": index + 1, "name": name.decode("utf-16-le").rstrip("\0"),
+                           "type": str(uuid.UUID(bytes_le=type_guid)), "guid": str(uuid.UUID(bytes_le=guid)),
+                           "start": start * GPT_SECTOR_SIZE, "size": (end - start + 1) * GPT_SECTOR_SIZE,
+                           "attributes": attributes})
+    return partitions
+
+
+# Change the size of one partition and move the backup gpt to the current end of the image, e.g. after the image was
+# truncated. The partition guids and attributes are kept, the disk guid is new
+def resize_gpt_partition(image_path: str, index: int, size: int) -> None:
+    partitions = read_gpt(image_path)
+    for partition in partitions:
+        if partition["index"] == index:
+            partition["size"] = size
+            break
+    else:
+        raise ValueError(f"{image_path} has no partition {index}")
+    write_gpt(image_path, partitions)
+
+
+#######################################################################################
+#                                    BLOCK MANIFEST                                   #
+#######################################################################################
+# A manifest of sha256 hashes of fixed-size blocks of every gpt partition of an image, with the merkle root of the
+# hashes of each partition. A flashed device or a downloaded image is checked against it block by block, so a
+# corruption is located to a block of a partition and checking can stop at the first bad block.
+# The leaves are plain sha256 hashes of the blocks, inner nodes hash 0x01 + left + right, so that a node can never be
+# mistaken for a block.
+BLOCK_MANIFEST_BLOCK_SIZE = 1024 ** 2
+# Blocks hashed or checked per pool task
+BLOCK_MANIFEST_BATCH = 16
+
+
+def get_merkle_root(leaves: list) -> str:
+    level = [bytes.fromhex(leaf) for leaf in leaves]
+    if not level:
+        return hashlib.sha256(b"").hexdigest()
+    while len(level) > 1:
+        # an odd node at the end is carried up to the next level as it is
+        level = [hashlib.sha256(b"\x01" + level[index] + level[index + 1]).digest() if index + 1 < len(level)
+                 else level[index] for index in range(0, len(level), 2)]
+    return level[0].hex()
+
+
+def build_block_manifest(image_path: str, block_size: int = BLOCK_MANIFEST_BLOCK_SIZE, max_workers: int = None) -> dict:
+    """
+    Hash the blocks of all partitions of an image in parallel.
+
+    :param image_path: A string representing the path to the image or device with a gpt.
+    :param block_size: An int representing the size of the hashed blocks in bytes.
+    :param max_workers: Number of threads that hash blocks.
+    :return: A dict with the image size, the block size and every partition with its block hashes and merkle root.
+    """
+    partitions = read_gpt(image_path)
+    with _BlockReader(image_path) as reader, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for partition in partitions:
+            if partition["start"] + partition["size"] > reader.size:
+                raise ValueError(f"Partition {partition['index']} ({partition['name']}) ends after the end of "
+                                 f"{image_path}")
+            batches = [pool.submit(reader.hash_blocks, blocks)
+                       for blocks in _get_block_batches(partition["start"], partition["size"], block_size)]
+            partition["leaves"] = [leaf for batch in batches for leaf in batch.result()]
+            partition["root"] = get_merkle_root(partition["leaves"])
+        image_size = reader.size
+    return {"version": 1, "block_size": block_size, "size": image_size, "partitions": partitions}
+
+
+def verify_block_manifest(target_path: str, manifest: dict, stop_early: bool = True, max_workers: int = None) -> list:
+    """
+    Check an image or device against a block manifest. Blocks are checked in parallel, but in order per partition.
+
+    :param target_path: A string representing the path to the image or device.
+    :param manifest: A dict from build_block_manifest().
+    :param stop_early: Stop at the first bad block.
+    :param max_workers: Number of threads that check blocks.
+    :return: A list of the bad blocks as dicts with the partition index and name, the block index, offset and size.
+    """
+    for partition in manifest["partitions"]:
+        if get_merkle_root(partition["leaves"]) != partition["root"]:
+            raise ValueError(f"The block hashes of partition {partition['name']} don't match its merkle root")
+    max_workers = max_workers or os.cpu_count() or 1
+    bad_blocks = []
+    with _BlockReader(target_path) as reader, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for partition in manifest["partitions"]:
+            if partition["start"] + partition["size"] > reader.size:
+                bad_blocks.append({"partition": partition["index"], "name": partition["name"], "block": None,
+                                   "offset": reader.size, "size": partition["start"] + partition["size"] - reader.size})
+                if stop_early:
+                    return bad_blocks
+                continue
+            batches = _get_block_batches(partition["start"], partition["size"], manifest["block_size"])
+            pending = deque()  # (future, index of the first block) in order
+            first_block = 0
+            for blocks in batches:
+                expected = partition["leaves"][first_block:first_block + len(blocks)]
+                # keep the pool busy, but don't queue up the whole partition in case of an early stop
+                while len(pending) >= max_workers * 2 and not (stop_early and bad_blocks):
+                    _collect_bad_blocks(pending, partition, bad_blocks)
+                if stop_early and bad_blocks:
+                    break
+                pending.append((pool.submit(reader.check_blocks, blocks, expected), first_block))
+                first_block += len(blocks)
+            while pending and not (stop_early and bad_blocks):
+                _collect_bad_blocks(pending, partition, bad_blocks)
+            for future, _ in pending:
+                future.cancel()
+            if stop_early and bad_blocks:
+                return bad_blocks[:1]
+    return bad_blocks
+
+
+def _collect_bad_blocks(pending: deque, partition: dict, bad_blocks: list) -> None:
+    future, first_block = pending.popleft()
+    for index, offset, size in future.result():
+        bad_blocks.append({"partition": partition["index"], "name": partition["name"], "block": first_block + index,
+                           "offset": offset, "size": size})
+
+
+# Split a partition into batches of (offset, size) blocks, the last block can be shorter
+def _get_block_batches(start: int, size: int, block_size: int) -> list:
+    blocks = [(offset, min(block_size, start + size - offset)) for offset in range(start, start + size, block_size)]
+    return [blocks[index:index + BLOCK_MANIFEST_BATCH] for index in range(0, len(blocks), BLOCK_MANIFEST_BATCH)]
+
+
+# Reads blocks of an image or device through an mmap. Holes of sparse files are known to be zero and never read.
+# hashlib releases the GIL, so the blocks are hashed in parallel
+class _BlockReader:
+    def __init__(self, path: str):
+        self._fd = os.open(path, os.O_RDONLY)
+        self.size = os.lseek(self._fd, 0, os.SEEK_END)  # also works for block devices
+        self._map = mmap.mmap(self._fd, self.size, prot=mmap.PROT_READ) if self.size else b""
+        self._view = memoryview(self._map)
+        self._data_ranges = self._get_data_ranges()
+        self._zero_leaves = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._view.release()
+        if self.size:
+            self._map.close()
+        os.close(self._fd)
+
+    def hash_blocks(self, blocks: list) -> list:
+        return [self._get_zero_leaf(size) if self._is_hole(offset, size)
+                else hashlib.sha256(self._view[offset:offset + size]).hexdigest() for offset, size in blocks]
+
+    # Get the blocks that don't match their expected hash as (index in blocks, offset, size)
+    def check_blocks(self, blocks: list, expected: list) -> list:
+        bad_blocks = []
+        for index, ((offset, size), leaf) in enumerate(zip(blocks, expected)):
+            zero_leaf = self._get_zero_leaf(size)
+            if self._is_hole(offset, size):
+                is_good = leaf == zero_leaf
+            elif leaf == zero_leaf:
+                is_good = self._map[offset:offset + size] == bytes(size)  # comparing is a lot faster than hashing
+            else:
+                is_good = hashlib.sha256(self._view[offset:offset + size]).hexdigest() == leaf
+            if not is_good:
+                bad_blocks.append((index, offset, size))
+        return bad_blocks
+
+    def _get_zero_leaf(self, size: int) -> str:
+        if size not in self._zero_leaves:
+            self._zero_leaves[size] = hashlib.sha256(bytes(size)).hexdigest()
+        return self._zero_leaves[size]
+
+    # Get the (start, end) ranges of a sparse file that contain data. Devices are data from start to end
+    def _get_data_ranges(self) -> list:
+        ranges = []
+        offset = 0
         try:
-            print("\rDownloading: " + "%.0f" % int(file_path.stat().st_size / 1048576) + "mb / "
-                  + "%.0f" % (total_size / 1048576) + "mb", end="", flush=True)
-        except FileNotFoundError:
-            sleep(0.5)  # in case download hasn't started yet
+            while offset < self.size:
+                start = os.lseek(self._fd, offset, os.SEEK_DATA)
+                offset = os.lseek(self._fd, start, os.SEEK_HOLE)
+                ranges.append((start, offset))
+        except OSError as error:
+            if error.errno != errno.ENXIO:  # ENXIO: no data after the offset
+                return [(0, self.size)]
+        return ranges
+
+    def _is_hole(self, offset: int, size: int) -> bool:
+        index = bisect.bisect_right(self._data_ranges, (offset, float("inf"))) - 1
+        # the data range that starts before the block, or the next one, could overlap the block
+        for start, end in self._data_ranges[max(index, 0):index + 2]:
+            if start < offset + size and end > offset:
+                return False
+        return True
 
 
 #######################################################################################
-#                                    PRINT FUNCTIONS                                  #
+#                                    CHUNK INDEX                                      #
+#######################################################################################
+# Images are split into content defined chunks, so that a new image can be assembled from the chunks of an old one.
+# Chunk borders are only placed between 4kb blocks: filesystems never shift data by less than a block, and a byte
+# wise rolling hash would be far too slow in python. A block ends a chunk if the crc32 of its content has its lowest
+# bits unset -> an average chunk has 16 blocks (64kb). Chunks are at least 4 and at most 64 blocks long.
+# The crc32 of an empty block never ends a chunk -> sparse regions become 256kb chunks that are all the same.
+# The store keeps every chunk zlib compressed in <store>/<first 4 hex digits>/<sha256>.cnk. The mtime of a chunk is
+# updated whenever an image uses it again, evict_chunk_store() removes the chunks that weren't used for the longest
+CHUNK_BLOCK_SIZE = 4096
+CHUNK_BORDER_MASK = 0xF
+CHUNK_MIN_BLOCKS = 4
+CHUNK_MAX_BLOCKS = 64
+CHUNKS_IN_FLIGHT = 256  # max chunks hashed and compressed at once -> bounds the memory use to 64mb
+
+
+class ContentChunker:
+    """
+    Splits a stream into content defined chunks. feed() returns the chunks that are complete so far.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scanned = 0  # bytes of the buffer that were already checked for chunk borders
+        self._blocks = 0  # blocks in the current chunk
+
+    def feed(self, data: bytes) -> list:
+        self._buffer += data
+        chunks = []
+        chunk_start = 0
+        buffer_view = memoryview(self._buffer)
+        while self._scanned + CHUNK_BLOCK_SIZE <= len(self._buffer):
+            block_end = self._scanned + CHUNK_BLOCK_SIZE
+            self._blocks += 1
+            if self._blocks >= CHUNK_MAX_BLOCKS or (
+                    self._blocks >= CHUNK_MIN_BLOCKS
+                    and not zlib.crc32(buffer_view[self._scanned:block_end]) & CHUNK_BORDER_MASK):
+                chunks.append(bytes(buffer_view[chunk_start:block_end]))
+                chunk_start = block_end
+                self._blocks = 0
+            self._scanned = block_end
+        buffer_view.release()
+        del self._buffer[:chunk_start]
+        self._scanned -= chunk_start
+        return chunks
+
+    def finish(self) -> list:
+        chunks = [bytes(self._buffer)] if self._buffer else []
+        self._buffer = bytearray()
+        self._scanned = 0
+        self._blocks = 0
+        return chunks
+
+
+def get_chunk_path(store: str, digest: str) -> str:
+    return f"{store}/{digest[:4]}/{digest}.cnk"
+
+
+def _hash_chunk(data: bytes, store: str = None) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    if store is None:
+        return digest
+    chunk_path = get_chunk_path(store, digest)
+    try:
+        os.utime(chunk_path)  # mark the chunk as used for evict_chunk_store()
+    except FileNotFoundError:
+        mkdir(os.path.dirname(chunk_path), create_parents=True)
+        # write to a temp file first, so that an interrupted write never leaves a broken chunk behind. Builds of a
+        # matrix run in separate processes and share the store -> the pid is part of the name
+        temp_path = f"{chunk_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(zlib.compress(data, 1))
+        os.replace(temp_path, chunk_path)
+    return digest
+
+
+# Delete the least recently used chunks until the store fits into its size limit again. Returns the size of the store
+def evict_chunk_store(store: str, max_size: int) -> int:
+    with open(f"{store}/.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # parallel builds don't evict the same chunks twice
+        chunks = [(chunk, chunk.stat()) for chunk in Path(store).glob("*/*.cnk")]
+        total_size = sum(chunk_stat.st_size for _, chunk_stat in chunks)
+        for chunk, chunk_stat in sorted(chunks, key=lambda entry: entry[1].st_mtime):
+            if total_size <= max_size:
+                break
+            chunk.unlink(missing_ok=True)
+            total_size -= chunk_stat.st_size
+    return total_size
+
+
+class ChunkIndexer:
+    """
+    Builds the chunk manifest of a stream and adds its new chunks to a store. Chunks are hashed and compressed in a
+    thread pool while the stream is still being fed, hashlib and zlib release the GIL.
+    """
+
+    def __init__(self, store: str = None, max_workers: int = None):
+        self.store = store
+        self.chunks = []  # [sha256, size] in stream order
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self._chunker = ContentChunker()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._pending = deque()  # (future, size) in stream order
+
+    def feed(self, data: bytes) -> None:
+        self.sha256.update(data)
+        self.size += len(data)
+        self._submit(self._chunker.feed(data))
+
+    def finish(self) -> dict:
+        self._submit(self._chunker.finish())
+        while self._pending:
+            self._collect()
+        self._pool.shutdown()
+        return {"version": 1, "block_size": CHUNK_BLOCK_SIZE, "size": self.size, "sha256": self.sha256.hexdigest(),
+                "chunks": self.chunks}
+
+    def _submit(self, chunks: list) -> None:
+        for chunk in chunks:
+            while len(self._pending) >= CHUNKS_IN_FLIGHT:
+                self._collect()
+            self._pending.append((self._pool.submit(_hash_chunk, chunk, self.store), len(chunk)))
+
+    def _collect(self) -> None:
+        future, size = self._pending.popleft()
+        self.chunks.append([future.result(), size])
+
+
+#######################################################################################
+#                                    SEEKABLE ZSTD                                    #
 #######################################################################################
+# The zstd seekable format: the data is split into independent zstd frames of a fixed uncompressed size, followed by
+# a seek table in a skippable frame. Any zstd can decompress the file as a whole, tools that read the seek table can
+# decompress the frames in parallel or only the part they need.
+# https://github.com/facebook/zstd/blob/dev/contrib/seekable_format/zstd_seekable_compression_format.md
+ZSTD_SEEKABLE_FRAME_SIZE = 16 * 1024 ** 2
+_ZSTD_SKIPPABLE_MAGIC = 0x184D2A5E
+_ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+
+
+def compress_zstd_frame(data: bytes, level: int = 19) -> bytes:
+    level_options = ["--ultra", f"-{level}"] if level > 19 else [f"-{level}"]
+    return subprocess.run(["zstd", "-q", "-c", *level_options], input=data, stdout=subprocess.PIPE,
+                          check=True).stdout
+
+
+def decompress_zstd_frame(data: bytes) -> bytes:
+    return subprocess.run(["zstd", "-q", "-dc"], input=data, stdout=subprocess.PIPE, check=True).stdout
+
+
+# Get the frames of a seekable zstd file as (compressed offset, compressed size, offset, size)
+def read_zstd_seek_table(path: str) -> list:
+    with open(path, "rb") as file:
+        file.seek(0, os.SEEK_END)
+        file_size = file.tell()
+        if file_size < 9:
+            raise ValueError(f"{path} is not a seekable zstd file")
+        file.seek(file_size - 9)
+        frame_count, descriptor, magic = struct.unpack("<IBI", file.read(9))
+        if magic != _ZSTD_SEEKABLE_MAGIC:
+            raise ValueError(f"{path} is not a seekable zstd file")
+        entry_size = 12 if descriptor & 0x80 else 8  # optional checksum per frame
+        table_size = frame_count * entry_size
+        file.seek(file_size - 9 - table_size - 8)
+        skippable_magic, _ = struct.unpack("<II", file.read(8))
+        if skippable_magic != _ZSTD_SKIPPABLE_MAGIC:
+            raise ValueError(f"{path} has a broken seek table")
+        table = file.read(table_size)
+    frames = []
+    compressed_offset = 0
+    offset = 0
+    for index in range(frame_count):
+        compressed_size, size = struct.unpack_from("<II", table, index * entry_size)
+        frames.append((compressed_offset, compressed_size, offset, size))
+        compressed_offset += compressed_size
+        offset += size
+    return frames
+
+
+class SeekableZstdCompressor:
+    """
+    Writes a stream as seekable zstd. Every frame is compressed by its own zstd process, so the frames are
+    compressed in parallel while the stream is still being fed. Frames are written in stream order.
+    """
+
+    def __init__(self, path: str, level: int = 19, frame_size: int = ZSTD_SEEKABLE_FRAME_SIZE,
+                 max_workers: int = None):
+        self.path = path
+        self.level = level
+        self.frame_size = frame_size
+        self.sha256 = hashlib.sha256()  # of the compressed file
+        self.size = 0
+        self.compressed_size = 0
+        self.frames = []  # (compressed size, size) in stream order
+        self._max_workers = max_workers or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(max_workers=self._max_workers)
+        self._pending = deque()  # (future, size) in stream order
+        self._buffer = bytearray()
+        self._file = open(f"{path}.tmp", "wb")
+
+    def feed(self, data: bytes) -> None:
+        self.size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.frame_size:
+            self._submit(bytes(self._buffer[:self.frame_size]))
+            del self._buffer[:self.frame_size]
+
+    def finish(self) -> None:
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._collect()
+        self._pool.shutdown()
+        # seek table without checksums, every frame has its own zstd content checksum
+        table = b"".join(struct.pack("<II", *frame) for frame in self.frames)
+        table += struct.pack("<IBI", len(self.frames), 0, _ZSTD_SEEKABLE_MAGIC)
+        self._write(struct.pack("<II", _ZSTD_SKIPPABLE_MAGIC, len(table)) + table)
+        self._file.close()
+        # an interrupted run never leaves a truncated file behind
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def _submit(self, frame: bytes) -> None:
+        # every frame in flight holds its data in memory -> keep just enough to keep all workers busy
+        while len(self._pending) >= self._max_workers + 2:
+            self._collect()
+        self._pending.append((self._pool.submit(compress_zstd_frame, frame, self.level), len(frame)))
+
+    def _collect(self) -> None:
+        future, size = self._pending.popleft()
+        compressed = future.result()
+        self._write(compressed)
+        self.frames.append((len(compressed), size))
+
+    def _write(self, data: bytes) -> None:
+        self._file.write(data)
+        self.sha256.update(data)
+        self.compressed_size += len(data)
+
+
+#######################################################################################
+#                                    FILE TREES                                       #
+#######################################################################################
+# Walk trees with os.scandir() one directory at a time: only the listings of the directories on the current path are
+# held in memory, so rootfs trees with hundreds of thousands of files are streamed. Symlinks are never followed.
+# Entries are sorted by name, which makes the walk order of two trees the same, see diff_tree_manifests()
+TREE_MANIFEST_FIELDS = ["path", "type", "mode", "uid", "gid", "size", "target"]
 
-# tree implementation in python
-# Credit: https://stackoverflow.com/a/59109706
-def create_tree(dir_str: str) -> str:
-    # TODO: sort alphabetically
-    def tree(dir_path: Path, prefix: str = ''):
-        # prefix components:
-        space = '    '
-        branch = '│   '
-        # pointers:
-        tee = '├── '
-        last = '└── '
-
-        dir_path.iterdir()
-        contents = list(dir_path.iterdir())
-        # contents each get pointers that are ├── with a final └── :
-        pointers = [tee] * (len(contents) - 1) + [last]
-        for pointer, path in zip(pointers, contents):
-            yield prefix + pointer + path.name
-            if path.is_dir():  # extend the prefix and recurse:
-                extension = branch if pointer == tee else space
-                # i.e. space because last, └── , above so no more |
-                yield from tree(path, prefix=prefix + extension)
-
-    final_tree = dir_str + "\n"
-    for line in tree(Path(dir_str)):
-        final_tree += line + "\n"
-    return final_tree
 
+def walk_tree(root: str, sort: bool = True, max_depth: int = None, exclude: list = None):
+    """
+    Yield the entries of a tree depth first.
+
+    :param root: A string representing the path to the top directory.
+    :param sort: Sort the entries of every directory by name.
+    :param max_depth: Don't descend into directories deeper than this, the top directory has depth 0.
+    :param exclude: A list of glob patterns, matched against the path relative to root and the name.
+    :return: Tuples of the relative path, the os.DirEntry, the depth and whether it is the last entry of its directory.
+    """
+    try:
+        with os.scandir(root) as scanner:
+            entries = [entry for entry in scanner if not _is_excluded(entry.name, entry.name, exclude)]
+    except OSError:  # unreadable directory, e.g. a dead mount point
+        return
+    if sort:
+        entries.sort(key=lambda entry: entry.name)
+    yield from _walk_entries(entries, "", 1, sort, max_depth, exclude)
+
+
+def _walk_entries(entries: list, parent: str, depth: int, sort: bool, max_depth: int, exclude: list):
+    for index, entry in enumerate(entries):
+        path = f"{parent}{entry.name}"
+        yield path, entry, depth, index == len(entries) - 1
+        if (max_depth is None or depth < max_depth) and entry.is_dir(follow_symlinks=False):
+            try:
+                with os.scandir(entry.path) as scanner:
+                    children = [child for child in scanner
+                                if not _is_excluded(f"{path}/{child.name}", child.name, exclude)]
+            except OSError:
+                continue
+            if sort:
+                children.sort(key=lambda child: child.name)
+            # the listing of this directory is dropped as soon as the walk leaves it
+            yield from _walk_entries(children, f"{path}/", depth + 1, sort, max_depth, exclude)
+
+
+def _is_excluded(path: str, name: str, exclude: list) -> bool:
+    return bool(exclude) and any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(name, pattern)
+                                 for pattern in exclude)
+
+
+# Yield the lines of a tree drawing like the tree command. Sizes are in bytes, like tree -s
+def iter_tree_lines(dir_str: str, sort: bool = True, max_depth: int = None, exclude: list = None,
+                    sizes: bool = False):
+    yield dir_str
+    prefixes = []  # prefix of the children of every directory on the current path
+    for path, entry, depth, is_last in walk_tree(dir_str, sort, max_depth, exclude):
+        del prefixes[depth - 1:]
+        line = "".join(prefixes) + ("└── " if is_last else "├── ")
+        if sizes:
+            line += f"[{entry.stat(follow_symlinks=False).st_size:>11}]  "
+        line += entry.name
+        if entry.is_symlink():
+            line += f" -> {os.readlink(entry.path)}"
+        prefixes.append("    " if is_last else "│   ")
+        yield line
+
+
+def create_tree(dir_str: str, sort: bool = True, max_depth: int = None, exclude: list = None,
+                sizes: bool = False) -> str:
+    return "".join(f"{line}\n" for line in iter_tree_lines(dir_str, sort, max_depth, exclude, sizes))
+
+
+def get_tree_manifest_entry(path: str, entry: os.DirEntry) -> dict:
+    entry_stat = entry.stat(follow_symlinks=False)
+    if stat.S_ISDIR(entry_stat.st_mode):
+        entry_type = "dir"
+    elif stat.S_ISREG(entry_stat.st_mode):
+        entry_type = "file"
+    elif stat.S_ISLNK(entry_stat.st_mode):
+        entry_type = "symlink"
+    else:
+        entry_type = "other"
+    # no timestamps: they differ between every build and would hide the real changes in a diff
+    return {"path": path, "type": entry_type, "mode": f"{stat.S_IMODE(entry_stat.st_mode):04o}",
+            "uid": entry_stat.st_uid, "gid": entry_stat.st_gid,
+            "size": entry_stat.st_size if entry_type == "file" else 0,
+            "target": os.readlink(entry.path) if entry_type == "symlink" else ""}
+
+
+def write_tree_manifest(root: str, manifest_path: str, exclude: list = None, max_depth: int = None) -> tuple:
+    """
+    Write a manifest of all entries of a tree, streamed while the tree is walked.
+
+    :param root: A string representing the path to the top directory.
+    :param manifest_path: A string representing the path to the manifest. .csv files are written as csv, everything
+        else as json lines: one json object per entry.
+    :param exclude: A list of glob patterns, matched against the path relative to root and the name.
+    :param max_depth: Don't descend into directories deeper than this.
+    :return: A tuple of the number of entries and the total size of the files in bytes.
+    """
+    entry_count = 0
+    total_size = 0
+    with open(f"{manifest_path}.tmp", "w", newline="") as file:
+        writer = csv.DictWriter(file, TREE_MANIFEST_FIELDS) if manifest_path.endswith(".csv") else None
+        if writer:
+            writer.writeheader()
+        for path, entry, _, _ in walk_tree(root, max_depth=max_depth, exclude=exclude):
+            manifest_entry = get_tree_manifest_entry(path, entry)
+            if writer:
+                writer.writerow(manifest_entry)
+            else:
+                file.write(json.dumps(manifest_entry) + "\n")
+            entry_count += 1
+            total_size += manifest_entry["size"]
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    return entry_count, total_size
+
+
+# Yield the entries of a manifest from write_tree_manifest() as dicts in the same format
+def read_tree_manifest(manifest_path: str):
+    with open(manifest_path, newline="") as file:
+        if manifest_path.endswith(".csv"):
+            for row in csv.DictReader(file):
+                row["uid"], row["gid"], row["size"] = int(row["uid"]), int(row["gid"]), int(row["size"])
+                yield row
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def diff_tree_manifests(old_path: str, new_path: str):
+    """
+    Compare two manifests from write_tree_manifest() without loading them into memory. Both are walked in the same
+    sorted order, so they are merged like sorted lists.
+
+    :param old_path: A string representing the path to the old manifest.
+    :param new_path: A string representing the path to the new manifest.
+    :return: Tuples of "added", "removed" or "changed", the path, the old entry and the new entry (None if missing).
+    """
+    old_entries = read_tree_manifest(old_path)
+    new_entries = read_tree_manifest(new_path)
+    old_entry = next(old_entries, None)
+    new_entry = next(new_entries, None)
+    while old_entry is not None or new_entry is not None:
+        # the walk order: a directory is followed by its children before its next sibling
+        old_key = old_entry["path"].split("/") if old_entry is not None else None
+        new_key = new_entry["path"].split("/") if new_entry is not None else None
+        if new_key is None or (old_key is not None and old_key < new_key):
+            yield "removed", old_entry["path"], old_entry, None
+            old_entry = next(old_entries, None)
+        elif old_key is None or new_key < old_key:
+            yield "added", new_entry["path"], None, new_entry
+            new_entry = next(new_entries, None)
+        else:
+            if old_entry != new_entry:
+                yield "changed", old_entry["path"], old_entry, new_entry
+            old_entry = next(old_entries, None)
+            new_entry = next(new_entries, None)
+
+
+#######################################################################################
+#                                    PRINT FUNCTIONS                                  #
+#######################################################################################
 
 def print_warning(message: str) -> None:
     print("\033[93m" + message + "\033[0m", flush=True)
@@ -372,11 +2405,15 @@ def print_header(message: str) -> None:
     print("\033[95m" + message + "\033[0m", flush=True)
 
 
+_FICLONE = 0x40049409  # ioctl from linux/fs.h
 verbose = False
-# on import check if pv is installed and set global variable
-try:
-    bash("which pv > /dev/null 2>&1")  # suppress all output to avoid scaring the user (pv is not a hard dependency)
-    no_extract_progress = False
-except subprocess.CalledProcessError:
-    no_extract_progress = True
+profiling = False
+profile_start = time.perf_counter()
+profile_timeline = []
+_profile_threads = threading.local()  # stack of the running steps per thread
+_profile_lock = threading.Lock()
+no_extract_progress = not sys.stdout.isatty()  # disable extraction progress if terminal is not interactive
 no_download_progress = not sys.stdout.isatty()  # disable download progress if terminal is not interactive
+download_cache_dir = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "eupnea-downloads"
+download_cache_max_size = 20 * 1024 ** 3
+_download_cache_lock = threading.Lock()  # downloads can run in parallel, the index is shared
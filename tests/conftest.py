@@ -0,0 +1,76 @@
+import hashlib
+import sys
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+import functions
+
+# the build scripts import functions.py from the root of the repo
+sys.path.insert(0, Path(__file__).parent.parent.as_posix())
+
+
+# Serves the files of server.files with ETag, Last-Modified, conditional requests and single Range requests.
+# server.requests records (path, request headers, status) of every request. A response whose (path, range start) is
+# in server.cuts ends after that many bytes of the body, once, like a dropped connection
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            self.server.requests.append((self.path, dict(self.headers), 404))
+            return
+        etag = f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+        start, end, status = 0, len(data), 200
+        if self.headers["If-None-Match"] == etag:
+            status = 304
+        elif self.headers["Range"] and self.headers.get("If-Range", etag) == etag:
+            first, _, last = self.headers["Range"].removeprefix("bytes=").partition("-")
+            start, end, status = int(first), int(last) + 1 if last else len(data), 206
+            if start >= len(data):
+                status = 416
+        self.server.requests.append((self.path, dict(self.headers), status))
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(self.server.mtime, usegmt=True))
+        self.send_header("Accept-Ranges", "bytes")
+        if status in [304, 416]:
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(data)}")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        cut = self.server.cuts.pop((self.path, start), None)
+        self.wfile.write(data[start:end if cut is None else start + cut])
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    server.files = {}
+    server.requests = []
+    server.cuts = {}
+    server.mtime = 1700000000
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+# An empty download cache, see functions.download_file()
+@pytest.fixture
+def download_cache(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setattr(functions, "download_cache_dir", cache_dir)
+    monkeypatch.setattr(functions, "download_cache_max_size", 1024 ** 3)
+    return cache_dir
@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+from functions import (GPT_TYPE_CHROMEOS_KERNEL, GPT_TYPE_EFI, GPT_TYPE_LINUX, build_block_manifest,
+                       resize_gpt_partition, verify_block_manifest, write_gpt)
+
+MIB = 1024 ** 2
+
+
+# A sparse image with the partition layout of build_image.py, scaled down. Root fills the rest of the image
+def create_image(path, size: int = 64 * MIB) -> str:
+    with open(path, "wb") as image:
+        image.truncate(size)
+    write_gpt(path, [{"name": "Kernel", "type": GPT_TYPE_CHROMEOS_KERNEL, "start": 1 * MIB, "size": 4 * MIB},
+                     {"name": "Kernel", "type": GPT_TYPE_CHROMEOS_KERNEL, "start": 5 * MIB, "size": 4 * MIB},
+                     {"name": "ESP", "type": GPT_TYPE_EFI, "start": 9 * MIB, "size": 8 * MIB},
+                     {"name": "Root", "type": GPT_TYPE_LINUX, "start": 17 * MIB, "size": size - 18 * MIB}])
+    with open(path, "r+b") as image:
+        os.pwrite(image.fileno(), os.urandom(2 * MIB), 1 * MIB)
+        os.pwrite(image.fileno(), os.urandom(10 * MIB), 20 * MIB)
+    return str(path)
+
+
+def corrupt_byte(path: str, offset: int) -> None:
+    with open(path, "r+b") as image:
+        byte = os.pread(image.fileno(), 1, offset)
+        os.pwrite(image.fileno(), bytes([byte[0] ^ 0xFF]), offset)
+
+
+def test_unchanged_image_verifies(tmp_path):
+    image = create_image(tmp_path / "image.bin")
+    assert verify_block_manifest(image, build_block_manifest(image)) == []
+
+
+@pytest.mark.parametrize("offset, partition, block", [
+    (1 * MIB + 12345, 1, 0),  # data block of the first kernel partition
+    (25 * MIB + 7, 4, 8),  # data block of root
+    (40 * MIB, 4, 23),  # hole in root, expected to be zero
+])
+def test_corrupted_byte_is_located(tmp_path, offset, partition, block):
+    image = create_image(tmp_path / "image.bin")
+    manifest = build_block_manifest(image)
+    corrupt_byte(image, offset)
+    bad_blocks = verify_block_manifest(image, manifest)
+    assert len(bad_blocks) == 1
+    assert bad_blocks[0]["partition"] == partition
+    assert bad_blocks[0]["block"] == block
+    assert bad_blocks[0]["offset"] <= offset < bad_blocks[0]["offset"] + bad_blocks[0]["size"]
+
+
+def test_all_bad_blocks_are_reported(tmp_path):
+    image = create_image(tmp_path / "image.bin")
+    manifest = build_block_manifest(image)
+    corrupt_byte(image, 2 * MIB)
+    corrupt_byte(image, 21 * MIB)
+    bad_blocks = verify_block_manifest(image, manifest, stop_early=False)
+    assert [(bad_block["partition"], bad_block["block"]) for bad_block in bad_blocks] == [(1, 1), (4, 4)]
+
+
+def test_truncated_target(tmp_path):
+    image = create_image(tmp_path / "image.bin")
+    manifest = build_block_manifest(image)
+    os.truncate(image, 40 * MIB)
+    bad_blocks = verify_block_manifest(image, manifest)
+    assert bad_blocks[0]["partition"] == 4 and bad_blocks[0]["block"] is None
+
+
+# shrink_image() in build_image.py truncates the image and then shrinks the root partition to the filesystem
+def test_shrunk_image_verifies(tmp_path):
+    image = create_image(tmp_path / "image.bin")
+    os.truncate(image, 40 * MIB)
+    with pytest.raises(ValueError):  # root still ends at the old end of the image
+        build_block_manifest(image)
+    resize_gpt_partition(image, 4, 20 * MIB)
+    manifest = build_block_manifest(image)
+    assert manifest["partitions"][3]["size"] == 20 * MIB
+    assert verify_block_manifest(image, manifest) == []
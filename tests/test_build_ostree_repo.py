@@ -0,0 +1,83 @@
+import configparser
+import json
+from pathlib import Path
+
+from build_ostree_repo import (append_history, diff_packages, get_compose_key, get_offline_repo_config,
+                               is_up_to_date, parse_dry_run, use_offline_repo)
+
+DRY_RUN = (Path(__file__).parent / "logs" / "rpm-ostree-dry-run.log").read_text()
+PACKAGES = ["NetworkManager-1:1.44.2-1.fc39.x86_64", "bash-5.2.21-1.fc39.x86_64", "glibc-2.38-10.fc39.x86_64",
+            "kernel-6.5.11-300.fc39.x86_64", "plasma-workspace-5.27.9-1.fc39.x86_64", "zstd-1.5.5-4.fc39.x86_64"]
+TREEFILE = {"ref": "fedora/39/x86_64/eupneaos", "packages": ["kernel", "plasma-workspace"]}
+
+FEDORA_REPO = """[fedora]
+name=Fedora $releasever - $basearch
+metalink=https://mirrors.fedoraproject.org/metalink?repo=fedora-$releasever&arch=$basearch
+enabled=1
+gpgcheck=1
+gpgkey=file:///etc/pki/rpm-gpg/RPM-GPG-KEY-fedora-$releasever-$basearch
+
+[fedora-cisco-openh264]
+name=Fedora $releasever openh264
+mirrorlist=https://mirrors.fedoraproject.org/mirrorlist?repo=fedora-cisco-openh264-$releasever&arch=$basearch
+enabled=1
+"""
+
+
+def test_parse_dry_run():
+    # the repo and progress lines around the transaction are ignored
+    assert parse_dry_run(DRY_RUN) == PACKAGES
+    assert parse_dry_run("error: Could not depsolve transaction\n") == []
+
+
+def test_offline_repo_config(tmp_path):
+    (tmp_path / "fedora.repo").write_text(FEDORA_REPO)
+    (tmp_path / "fedora-eupneaos.yaml").write_text("ref: fedora/39/x86_64/eupneaos\n")
+    use_offline_repo(str(tmp_path), "/srv/fedora-mirror")
+    repos = configparser.ConfigParser(interpolation=None)
+    repos.read_string((tmp_path / "fedora.repo").read_text())
+    for section in ["fedora", "fedora-cisco-openh264"]:
+        assert repos[section]["baseurl"] == "file:///srv/fedora-mirror"
+        assert repos[section]["gpgcheck"] == "0"
+        assert "metalink" not in repos[section] and "mirrorlist" not in repos[section]
+    # $releasever and $basearch are dnf variables, not interpolated
+    assert repos["fedora"]["name"] == "Fedora $releasever - $basearch"
+    assert (tmp_path / "fedora-eupneaos.yaml").read_text() == "ref: fedora/39/x86_64/eupneaos\n"
+    assert get_offline_repo_config("", "/srv/fedora-mirror") == ""
+
+
+def test_compose_key():
+    key = get_compose_key(TREEFILE, PACKAGES, "rpm-ostree 2023.8")
+    assert get_compose_key(dict(reversed(TREEFILE.items())), PACKAGES, "rpm-ostree 2023.8") == key
+    updated_packages = PACKAGES[:2] + ["glibc-2.38-11.fc39.x86_64"] + PACKAGES[3:]
+    assert get_compose_key(TREEFILE, updated_packages, "rpm-ostree 2023.8") != key
+    assert get_compose_key({**TREEFILE, "packages": ["kernel"]}, PACKAGES, "rpm-ostree 2023.8") != key
+    assert get_compose_key(TREEFILE, PACKAGES, "rpm-ostree 2023.11") != key
+
+
+def test_is_up_to_date():
+    state = {"key": "abc", "commit": "0123", "packages": PACKAGES}
+    assert is_up_to_date(state, "abc", "0123")
+    assert not is_up_to_date(state, "def", "0123")
+    # the ref was moved since the last compose, e.g. by a manual commit
+    assert not is_up_to_date(state, "abc", "4567")
+    assert not is_up_to_date({"key": None, "commit": "0123"}, None, "0123")
+    assert not is_up_to_date({}, "abc", None)
+
+
+def test_diff_packages():
+    new_packages = ["bash-5.2.21-1.fc39.x86_64", "glibc-2.38-11.fc39.x86_64", "htop-3.2.2-5.fc39.x86_64",
+                    "kernel-6.5.11-300.fc39.x86_64", "NetworkManager-1:1.44.2-1.fc39.x86_64"]
+    assert diff_packages(PACKAGES, new_packages) == {"added": 1, "removed": 2, "updated": 1}
+    assert diff_packages([], PACKAGES) == {"added": 6, "removed": 0, "updated": 0}
+
+
+def test_append_history(tmp_path):
+    history = tmp_path / "compose-history.jsonl"
+    append_history(str(history), {"ref": TREEFILE["ref"], "commit": "0123", "composed": True,
+                                  "compose_seconds": 512.3, "delta_size": 104857600}, 1700000000)
+    append_history(str(history), {"ref": TREEFILE["ref"], "commit": "0123", "composed": False}, 1700003600)
+    entries = [json.loads(line) for line in history.read_text().splitlines()]
+    assert entries == [{"time": 1700000000, "ref": TREEFILE["ref"], "commit": "0123", "composed": True,
+                        "compose_seconds": 512.3, "delta_size": 104857600},
+                       {"time": 1700003600, "ref": TREEFILE["ref"], "commit": "0123", "composed": False}]
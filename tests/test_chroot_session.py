@@ -0,0 +1,41 @@
+import os
+import subprocess
+
+import pytest
+
+from functions import COMMAND_TAIL_LINES, ChrootSession
+
+pytestmark = pytest.mark.skipif(os.geteuid() != 0, reason="chroot needs root")
+
+
+@pytest.fixture
+def session():
+    with ChrootSession("/") as chroot_session:
+        yield chroot_session
+
+
+def test_output_and_status(session):
+    result = session.run("echo out; echo err >&2; printf partial", check=False)
+    assert (result.stdout, result.stderr, result.returncode) == ("out\npartial", "err", 0)
+    result = session.run("exit 3", check=False)
+    assert result.returncode == 3
+    with pytest.raises(subprocess.CalledProcessError):
+        session.run("false")
+
+
+def test_noisy_command_keeps_a_tail(session):
+    lines = []
+    command = "for i in $(seq 5000); do echo out$i; echo err$i >&2; done"
+    result = session.run(command, line_callback=lambda line, stream: lines.append((stream, line)), capture=False)
+    # every line reaches the callback, only the last lines of each stream are kept
+    assert len(lines) == 10000
+    assert ("stderr", "err1\n") in lines
+    assert result.stdout.splitlines() == [f"out{index}" for index in range(5001 - COMMAND_TAIL_LINES, 5001)]
+    assert result.stderr.splitlines() == [f"err{index}" for index in range(5001 - COMMAND_TAIL_LINES, 5001)]
+    # the session is still in sync with its commands
+    assert session.run("echo next").stdout == "next"
+
+
+def test_captured_output_is_kept_whole(session):
+    result = session.run("seq 1000 >&2")
+    assert result.stderr.splitlines() == [str(index) for index in range(1, 1001)]
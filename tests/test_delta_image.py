@@ -0,0 +1,41 @@
+import json
+import os
+import random
+
+import delta_image
+from delta_image import apply_delta, index_image
+
+MIB = 1024 ** 2
+
+
+def test_apply_delta(tmp_path, monkeypatch):
+    random.seed(0)
+    old_data = random.randbytes(4 * MIB) + bytes(MIB) + random.randbytes(3 * MIB)
+    # a changed block, two inserted blocks that shift everything behind them and a new end
+    new_data = bytearray(old_data)
+    new_data[100 * 4096:101 * 4096] = random.randbytes(4096)
+    new_data[6 * MIB:6 * MIB] = random.randbytes(2 * 4096)
+    new_data += random.randbytes(MIB)
+    old_image = tmp_path / "old-eupneaos.bin"
+    old_image.write_bytes(old_data)
+    new_image = tmp_path / "eupneaos.bin"
+    new_image.write_bytes(new_data)
+    store = tmp_path / "eupneaos-chunks"
+    index_image(str(new_image), str(store), f"{new_image}.chunks.json")
+
+    fetched = []
+
+    def fetch_chunk(chunk_store: str, digest: str) -> tuple:
+        fetched.append(digest)
+        return original_fetch_chunk(chunk_store, digest)
+
+    original_fetch_chunk = delta_image.fetch_chunk
+    monkeypatch.setattr(delta_image, "fetch_chunk", fetch_chunk)
+    output = tmp_path / "assembled.bin"
+    apply_delta(f"{new_image}.chunks.json", str(old_image), str(store), str(output), jobs=2)
+    assert output.read_bytes() == bytes(new_data)
+    assert not os.path.exists(f"{output}.tmp")
+    # only the chunks around the changes and the new end are fetched
+    with open(f"{new_image}.chunks.json") as file:
+        chunks = json.load(file)["chunks"]
+    assert 0 < sum(size for digest, size in chunks if digest in fetched) < 2 * MIB
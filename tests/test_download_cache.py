@@ -0,0 +1,66 @@
+import hashlib
+import os
+
+import pytest
+
+import functions
+from functions import download_file
+
+
+def get_statuses(server, path: str) -> list:
+    return [status for request_path, _, status in server.requests if request_path == path]
+
+
+def test_download_is_cached(tmp_path, http_server, download_cache):
+    data = os.urandom(300000)
+    http_server.files["/rootfs.tar.xz"] = data
+    sha256 = hashlib.sha256(data).hexdigest()
+    download_file(f"{http_server.url}/rootfs.tar.xz", str(tmp_path / "first"), sha256=sha256)
+    assert (tmp_path / "first").read_bytes() == data
+    assert (download_cache / "objects" / sha256).read_bytes() == data
+
+    # the second download only revalidates the cached file
+    download_file(f"{http_server.url}/rootfs.tar.xz", str(tmp_path / "second"), sha256=sha256)
+    assert (tmp_path / "second").read_bytes() == data
+    assert get_statuses(http_server, "/rootfs.tar.xz") == [200, 304]
+    assert http_server.requests[-1][1]["If-None-Match"]
+
+
+def test_changed_file_is_downloaded_again(tmp_path, http_server, download_cache):
+    http_server.files["/bzImage"] = b"old kernel"
+    download_file(f"{http_server.url}/bzImage", str(tmp_path / "bzImage"))
+    http_server.files["/bzImage"] = b"new kernel"
+    download_file(f"{http_server.url}/bzImage", str(tmp_path / "bzImage"))
+    assert (tmp_path / "bzImage").read_bytes() == b"new kernel"
+    assert get_statuses(http_server, "/bzImage") == [200, 200]
+
+
+def test_checksum_mismatch(tmp_path, http_server, download_cache):
+    http_server.files["/bzImage"] = b"kernel"
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        download_file(f"{http_server.url}/bzImage", str(tmp_path / "bzImage"), sha256="0" * 64)
+    assert not (tmp_path / "bzImage").exists()
+
+
+def test_interrupted_download_is_resumed(tmp_path, http_server, download_cache):
+    data = os.urandom(300000)
+    http_server.files["/rootfs.tar.xz"] = data
+    http_server.cuts[("/rootfs.tar.xz", 0)] = 100000
+    with pytest.raises(ConnectionError):
+        download_file(f"{http_server.url}/rootfs.tar.xz", str(tmp_path / "rootfs.tar.xz"))
+    download_file(f"{http_server.url}/rootfs.tar.xz", str(tmp_path / "rootfs.tar.xz"),
+                  sha256=hashlib.sha256(data).hexdigest())
+    assert (tmp_path / "rootfs.tar.xz").read_bytes() == data
+    # only the missing bytes were requested again
+    assert http_server.requests[-1][1]["Range"] == "bytes=100000-"
+    assert get_statuses(http_server, "/rootfs.tar.xz") == [200, 206]
+    assert list((download_cache / "partial").iterdir()) == []
+
+
+def test_least_recently_used_file_is_evicted(tmp_path, http_server, download_cache, monkeypatch):
+    monkeypatch.setattr(functions, "download_cache_max_size", 250000)
+    for name in ["first", "second"]:
+        http_server.files[f"/{name}"] = os.urandom(200000)
+        download_file(f"{http_server.url}/{name}", str(tmp_path / name))
+    assert [path.name for path in (download_cache / "objects").iterdir()] == [
+        hashlib.sha256(http_server.files["/second"]).hexdigest()]
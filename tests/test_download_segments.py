@@ -0,0 +1,60 @@
+import hashlib
+import os
+
+import pytest
+
+import functions
+from functions import download_file
+
+SEGMENT_SIZE = 128 * 1024
+FILE_SIZE = 8 * SEGMENT_SIZE
+
+
+# Files of 2 segments and more are downloaded in segments, scaled down from 16mb
+@pytest.fixture
+def rootfs_url(http_server, download_cache, monkeypatch):
+    monkeypatch.setattr(functions, "DOWNLOAD_SEGMENT_MIN_SIZE", SEGMENT_SIZE)
+    http_server.files["/rootfs.tar.xz"] = os.urandom(FILE_SIZE)
+    return f"{http_server.url}/rootfs.tar.xz"
+
+
+def get_range_starts(requests: list) -> list:
+    return sorted(int(headers["Range"].removeprefix("bytes=").split("-")[0]) for _, headers, _ in requests
+                  if "Range" in headers)
+
+
+def test_segmented_download(tmp_path, http_server, download_cache, rootfs_url):
+    data = http_server.files["/rootfs.tar.xz"]
+    progress = []
+    download_file(rootfs_url, str(tmp_path / "rootfs.tar.xz"), sha256=hashlib.sha256(data).hexdigest(),
+                  progress_callback=lambda done, total, seconds: progress.append((done, total)))
+    assert (tmp_path / "rootfs.tar.xz").read_bytes() == data
+    # one request for the size, then one per segment
+    assert get_range_starts(http_server.requests) == list(range(0, FILE_SIZE, SEGMENT_SIZE))
+    assert [status for _, _, status in http_server.requests[1:]] == [206] * 8
+    assert progress[-1] == (FILE_SIZE, FILE_SIZE)
+    assert list((download_cache / "partial").iterdir()) == []
+
+    # the next download only revalidates the cached file
+    http_server.requests.clear()
+    download_file(rootfs_url, str(tmp_path / "again.tar.xz"))
+    assert (tmp_path / "again.tar.xz").read_bytes() == data
+    assert [status for _, _, status in http_server.requests] == [304]
+
+
+def test_interrupted_segment_is_resumed(tmp_path, http_server, download_cache, rootfs_url):
+    data = http_server.files["/rootfs.tar.xz"]
+    http_server.cuts[("/rootfs.tar.xz", 3 * SEGMENT_SIZE)] = 50000
+    with pytest.raises(ConnectionError):
+        download_file(rootfs_url, str(tmp_path / "rootfs.tar.xz"))
+    assert not (tmp_path / "rootfs.tar.xz").exists()
+    assert len(list((download_cache / "partial").glob("*.segments"))) == 1
+
+    http_server.requests.clear()
+    download_file(rootfs_url, str(tmp_path / "rootfs.tar.xz"), sha256=hashlib.sha256(data).hexdigest())
+    assert (tmp_path / "rootfs.tar.xz").read_bytes() == data
+    # the interrupted segment continues where it ended. The other segments were stopped at any point
+    resumed_starts = get_range_starts(http_server.requests)
+    assert 3 * SEGMENT_SIZE + 50000 in resumed_starts
+    assert 3 * SEGMENT_SIZE not in resumed_starts
+    assert list((download_cache / "partial").iterdir()) == []
@@ -0,0 +1,84 @@
+import json
+import subprocess
+import threading
+
+import pytest
+
+import build_image
+from build_image import KDE_LAYER, build_variant_layer, get_layer_key, save_layer
+
+
+@pytest.fixture
+def rootfs(tmp_path, monkeypatch):
+    rootfs_dir = tmp_path / "rootfs"
+    (rootfs_dir / "boot").mkdir(parents=True)
+    (rootfs_dir / "boot" / "vmlinuz").write_bytes(b"kernel")
+    (rootfs_dir / "usr" / "bin").mkdir(parents=True)
+    (rootfs_dir / "usr" / "bin" / "obsolete").write_bytes(b"replaced by the step")
+    monkeypatch.setattr(build_image, "rootfs_dir", str(rootfs_dir))
+    # labeling needs setfiles in the chroot
+    monkeypatch.setattr(build_image, "relabel_rootfs", lambda label_manifest: {"labeled": True})
+    monkeypatch.setattr(build_image, "get_label_manifest", lambda excludes: {"restored": True})
+    return rootfs_dir
+
+
+def test_kde_layer_key(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "configs").mkdir()
+    kde_packages = tmp_path / "configs" / "kde-packages.json"
+    kde_packages.write_text(json.dumps([{"action": "group-install", "packages": ["KDE Plasma Workspaces"]}]))
+    key = get_layer_key("base", *KDE_LAYER)
+    assert get_layer_key("base", *KDE_LAYER) == key
+    assert get_layer_key("other base", *KDE_LAYER) != key
+    kde_packages.write_text(json.dumps([{"action": "group-install", "packages": ["KDE Plasma Workspaces", "kate"]}]))
+    assert get_layer_key("base", *KDE_LAYER) != key
+
+
+def test_variant_layer_is_restored(tmp_path, rootfs):
+    cache_dir = tmp_path / "layers"
+    cache_dir.mkdir()
+    calls = []
+
+    def install_desktop() -> None:
+        calls.append("install_desktop")
+        (rootfs / "usr" / "bin" / "obsolete").unlink()
+        (rootfs / "usr" / "bin" / "plasmashell").write_bytes(b"desktop")
+        (rootfs / "boot" / "splash").write_bytes(b"splash")
+
+    assert build_variant_layer(str(cache_dir), True, "base", install_desktop, [], {}) == {"labeled": True}
+    assert calls == ["install_desktop"]
+    key = get_layer_key("base", install_desktop, [])
+    assert (cache_dir / f"{key}.tar.zst").exists()
+
+    # the next variant starts from the base rootfs again
+    (rootfs / "usr" / "bin" / "plasmashell").unlink()
+    (rootfs / "boot" / "splash").unlink()
+    (rootfs / "usr" / "bin" / "obsolete").write_bytes(b"replaced by the step")
+    assert build_variant_layer(str(cache_dir), True, "base", install_desktop, [], {}) == {"restored": True}
+    assert calls == ["install_desktop"]
+    assert (rootfs / "usr" / "bin" / "plasmashell").read_bytes() == b"desktop"
+    assert (rootfs / "boot" / "splash").read_bytes() == b"splash"
+    assert not (rootfs / "usr" / "bin" / "obsolete").exists()
+
+
+def test_layer_saved_by_another_build_is_kept(tmp_path, rootfs):
+    cache_dir = tmp_path / "layers"
+    cache_dir.mkdir()
+    (cache_dir / "0123.tar.zst").write_bytes(b"saved by another build")
+    save_layer(str(cache_dir), "0123")
+    assert (cache_dir / "0123.tar.zst").read_bytes() == b"saved by another build"
+    assert not (cache_dir / "0123.tar.zst.tmp").exists()
+
+
+def test_parallel_saves_of_one_layer(tmp_path, rootfs):
+    cache_dir = tmp_path / "layers"
+    cache_dir.mkdir()
+    saves = [threading.Thread(target=save_layer, args=(str(cache_dir), "0123")) for _ in range(4)]
+    for save in saves:
+        save.start()
+    for save in saves:
+        save.join()
+    listing = subprocess.run(["tar", "-I", "zstd", "-tf", cache_dir / "0123.tar.zst"], capture_output=True, text=True,
+                             check=True).stdout.split()
+    assert "./usr/bin/obsolete" in listing
+    assert [path.name for path in cache_dir.iterdir() if path.name.endswith(".tmp")] == []
@@ -0,0 +1,83 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from functions import LOG_PARSERS, LogFollower
+
+LOGS_DIR = Path(__file__).parent / "logs"
+
+# (event, package) of every progress event of the recorded logs
+EXPECTED_EVENTS = {
+    "pacman": [("resolved", None), ("downloaded", "readline-8.2.001-2-x86_64"), ("downloaded", "glibc-2.37-3-x86_64"),
+               ("downloaded", "bash-5.2.015-1-x86_64"), ("installed", "readline"), ("installed", "glibc"),
+               ("installed", "bash"), ("hook", None), ("complete", None)],
+    "dnf": [("resolved", None), ("downloaded", "libktorrent-23.08.1-1.fc39.x86_64.rpm"),
+            ("downloaded", "kget-23.08.1-1.fc39.x86_64.rpm"), ("installed", "libktorrent-23.08.1-1.fc39.x86_64"),
+            ("installed", "kget-23.08.1-1.fc39.x86_64"), ("complete", None)],
+    "apt": [("resolved", None), ("downloaded", "bash-completion"), ("downloaded", "htop"),
+            ("installed", "bash-completion"), ("installed", "htop"), ("complete", None)],
+}
+
+
+# Replay a recorded log through a pipe in the given chunks and get the events the follower wrote
+def replay_log(package_manager: str, chunks: list, metrics_path: Path) -> list:
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(read_fd, "rb") as stream:
+        follower = LogFollower(LOG_PARSERS[package_manager](), stream=stream, metrics_path=str(metrics_path)).start()
+        with os.fdopen(write_fd, "wb") as pipe:
+            for chunk in chunks:
+                pipe.write(chunk)
+                pipe.flush()
+        follower.join(10)
+        assert not follower._thread.is_alive()
+    with open(metrics_path) as file:
+        events = [json.loads(line) for line in file]
+    # the time and the download speed depend on when the lines arrived
+    for event in events:
+        del event["time"]
+        event.pop("bytes_per_second", None)
+    return events
+
+
+def read_log(package_manager: str) -> bytes:
+    return (LOGS_DIR / f"{package_manager}.log").read_bytes()
+
+
+@pytest.mark.parametrize("package_manager", EXPECTED_EVENTS)
+def test_recorded_log(tmp_path, package_manager):
+    lines = read_log(package_manager).splitlines(keepends=True)
+    events = replay_log(package_manager, lines, tmp_path / "metrics.jsonl")
+    assert [(event["event"], event.get("package")) for event in events] == EXPECTED_EVENTS[package_manager]
+
+
+@pytest.mark.parametrize("package_manager", EXPECTED_EVENTS)
+@pytest.mark.parametrize("chunk_size", [1, 7, 100])
+def test_split_lines(tmp_path, package_manager, chunk_size):
+    log = read_log(package_manager)
+    whole_lines = replay_log(package_manager, log.splitlines(keepends=True), tmp_path / "whole.jsonl")
+    chunks = [log[offset:offset + chunk_size] for offset in range(0, len(log), chunk_size)]
+    assert replay_log(package_manager, chunks, tmp_path / "split.jsonl") == whole_lines
+
+
+def test_split_utf8_character(tmp_path):
+    log = "Letzte Prüfung auf abgelaufene Metadaten: vor 0:00:01\n".encode() + read_log("dnf")
+    split = log.index("ü".encode()) + 1  # between the two bytes of ü
+    events = replay_log("dnf", [log[:split], log[split:]], tmp_path / "metrics.jsonl")
+    assert [(event["event"], event.get("package")) for event in events] == EXPECTED_EVENTS["dnf"]
+
+
+def test_stop_after_finish_writes_nothing(tmp_path):
+    read_fd, write_fd = os.pipe()
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as stream:
+        follower = LogFollower(LOG_PARSERS["dnf"](), stream=stream).start()
+        follower.join(10)
+    # the follower closed its wake up pipe -> the next files can get the same fd numbers
+    files = [open(tmp_path / f"file{index}", "wb+") for index in range(4)]
+    follower.stop()
+    for file in files:
+        file.seek(0)
+        assert file.read() == b""
+        file.close()
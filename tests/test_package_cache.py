@@ -0,0 +1,91 @@
+import argparse
+import os
+
+import pytest
+
+import build_image
+from build_image import (OFFLINE_REPO_MOUNT, check_offline_repo, check_package_cache, evict_package_cache,
+                         get_dnf_options, get_dnf_shell_script, get_offline_path, mark_used_packages,
+                         plan_dnf_transactions)
+
+RPM_LEAD = b"\xed\xab\xee\xdb"
+
+
+def create_rpm(path, size: int = 1000, mtime: int = 1700000000):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(RPM_LEAD + bytes(size - len(RPM_LEAD)))
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+# A repo synced for offline builds: metadata, the .repo files and rpms the manifest references by url
+@pytest.fixture
+def local_repo(tmp_path):
+    repo_dir = tmp_path / "offline-repo"
+    (repo_dir / "repodata").mkdir(parents=True)
+    (repo_dir / "repodata" / "repomd.xml").write_text("<repomd/>")
+    (repo_dir / "rpmfusion.repo").write_text("[rpmfusion]\nbaseurl=https://example.org/rpmfusion\n")
+    create_rpm(repo_dir / "rpmfusion-free-release-39.noarch.rpm")
+    return repo_dir
+
+
+def set_offline_repo(monkeypatch, repo_dir) -> None:
+    monkeypatch.setattr(build_image, "args", argparse.Namespace(offline_repo=repo_dir), raising=False)
+
+
+def test_used_packages_are_evicted_last(tmp_path):
+    packages_dir = tmp_path / "fedora-0123456789abcdef" / "packages"
+    # the oldest package on disk was used by this build, the newer ones weren't
+    used = create_rpm(packages_dir / "bash-5.2.15-5.fc39.x86_64.rpm", mtime=1600000000)
+    unused = [create_rpm(packages_dir / f"unused{index}-1.0-1.fc39.noarch.rpm", mtime=1700000000 + index)
+              for index in range(3)]
+    assert mark_used_packages(str(tmp_path), {"bash-5.2.15-5.fc39.x86_64", "glibc-2.38-7.fc39.x86_64"}) == 1
+    evict_package_cache(str(tmp_path), 2000)
+    assert used.exists()
+    assert [rpm.exists() for rpm in unused] == [False, False, True]
+
+
+def test_broken_packages_are_removed(tmp_path):
+    packages_dir = tmp_path / "updates-0123456789abcdef" / "packages"
+    complete = create_rpm(packages_dir / "bash-5.2.15-5.fc39.x86_64.rpm")
+    truncated = packages_dir / "glibc-2.38-7.fc39.x86_64.rpm"
+    truncated.write_bytes(b"")
+    check_package_cache(str(tmp_path))
+    assert complete.exists()
+    assert not truncated.exists()
+
+
+def test_offline_repo(monkeypatch, local_repo):
+    set_offline_repo(monkeypatch, str(local_repo))
+    check_offline_repo(str(local_repo))
+    transaction = plan_dnf_transactions([
+        {"action": "install", "packages": ["https://example.org/rpmfusion-free-release-39.noarch.rpm"],
+         "adds_repos": True},
+        {"action": "add-repo", "repo": "https://example.org/rpmfusion.repo"},
+        {"action": "install", "packages": ["kernel-tools"], "options": ["--setopt=install_weak_deps=False"]},
+    ])
+    # only the offline repo is enabled, every other repo of the rootfs is disabled
+    assert get_dnf_options(transaction[1]).split() == [
+        "--setopt=install_weak_deps=False", "--setopt=keepcache=True", "--disablerepo=*",
+        f"--repofrompath=eupneaos-offline,{OFFLINE_REPO_MOUNT}", "--enablerepo=eupneaos-offline",
+        "--setopt=eupneaos-offline.gpgcheck=False"]
+    # packages and repos referenced by url are installed from the root of the repo, which is mounted into the chroot
+    assert get_dnf_shell_script(transaction[0]) == \
+        f"install {OFFLINE_REPO_MOUNT}/rpmfusion-free-release-39.noarch.rpm\nrun\n"
+    repo_path = get_offline_path(transaction[1]["repos"][0])
+    assert repo_path == f"{OFFLINE_REPO_MOUNT}/rpmfusion.repo"
+    assert (local_repo / repo_path.removeprefix(f"{OFFLINE_REPO_MOUNT}/")).exists()
+    assert get_offline_path("kernel-tools") == "kernel-tools"
+
+
+def test_offline_repo_needs_metadata(local_repo):
+    (local_repo / "repodata" / "repomd.xml").unlink()
+    with pytest.raises(FileNotFoundError):
+        check_offline_repo(str(local_repo))
+
+
+def test_online_mode_uses_the_repos_of_the_rootfs(monkeypatch):
+    set_offline_repo(monkeypatch, None)
+    transaction = {"repos": [], "operations": [], "options": []}
+    assert get_dnf_options(transaction) == "--setopt=keepcache=True"
+    assert get_offline_path("https://example.org/rpmfusion.repo") == "https://example.org/rpmfusion.repo"
@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from functions import rmdir
+
+WIDE_DIRS = 50
+FILES_PER_DIR = 200
+DEEP_LEVELS = 300
+
+
+# A wide tree with many files per directory, a deep chain of directories, hardlinks and symlinks that point out of
+# the tree. Returns the number of non-directories in the tree
+def create_tree(root, outside) -> int:
+    entries = 0
+    for dir_index in range(WIDE_DIRS):
+        wide_dir = root / "wide" / f"dir{dir_index}"
+        wide_dir.mkdir(parents=True)
+        for file_index in range(FILES_PER_DIR):
+            (wide_dir / f"file{file_index}").write_bytes(b"x" * file_index)
+        entries += FILES_PER_DIR
+    deep_dir = root / "deep"
+    for level in range(DEEP_LEVELS):
+        deep_dir = deep_dir / "d"
+    deep_dir.mkdir(parents=True)
+    (deep_dir / "bottom").write_bytes(b"bottom")
+    os.link(deep_dir / "bottom", root / "hardlink")
+    entries += 2
+    # removing the symlinks must never touch what they point to
+    (root / "link-to-dir").symlink_to(outside)
+    (root / "link-to-file").symlink_to(outside / "keep")
+    (root / "wide" / "dir0" / "dangling").symlink_to(root / "missing")
+    entries += 3
+    read_only_dir = root / "read-only"
+    read_only_dir.mkdir()
+    (read_only_dir / "file").write_bytes(b"read only")
+    read_only_dir.chmod(0o555)
+    (root / "read-only-file").write_bytes(b"read only")
+    (root / "read-only-file").chmod(0o444)
+    entries += 2
+    return entries
+
+
+@pytest.fixture
+def outside(tmp_path):
+    outside_dir = tmp_path / "outside"
+    outside_dir.mkdir()
+    (outside_dir / "keep").write_bytes(b"keep")
+    return outside_dir
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="the build runs as root, only root can delete from read-only dirs")
+@pytest.mark.parametrize("keep_dir", [True, False])
+def test_remove_tree(tmp_path, outside, keep_dir):
+    root = tmp_path / "tree"
+    entries = create_tree(root, outside)
+    removed_files, freed_bytes = rmdir(str(root), keep_dir=keep_dir)
+    assert removed_files == entries
+    assert freed_bytes > 0
+    if keep_dir:
+        assert list(root.iterdir()) == []
+    else:
+        assert not root.exists()
+    assert (outside / "keep").read_bytes() == b"keep"
+
+
+def test_symlink_is_not_followed(tmp_path, outside):
+    link = tmp_path / "link"
+    link.symlink_to(outside)
+    with pytest.raises(OSError):
+        rmdir(str(link))
+    assert (outside / "keep").exists()
+
+
+def test_missing_dir(tmp_path):
+    assert rmdir(str(tmp_path / "missing")) == (0, 0)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Audit rootfs trees: draw them, write a manifest of all files with their types, modes, owners and sizes, and compare
+# the manifests of two builds. build_image.py writes the manifest of every image (eupneaos.files.jsonl).
+#   tree_manifest.py tree /mnt/eupneaos --max-depth 2 --sizes
+#   tree_manifest.py manifest /mnt/eupneaos eupneaos.files.csv --exclude "proc/*" --exclude "sys/*"
+#   tree_manifest.py diff old-eupneaos.files.jsonl eupneaos.files.jsonl
+
+import argparse
+from time import perf_counter
+
+from functions import *
+
+
+def process_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    tree_parser = subparsers.add_parser("tree", help="Print a directory tree.")
+    tree_parser.add_argument("root", help="Top directory.")
+    tree_parser.add_argument("--sizes", dest="sizes", action="store_true", default=False,
+                             help="Print the size of every entry in bytes.")
+    tree_parser.add_argument("--unsorted", dest="unsorted", action="store_true", default=False,
+                             help="Print entries in directory order, slightly faster on huge directories.")
+    manifest_parser = subparsers.add_parser("manifest", help="Write a manifest of all entries of a tree.")
+    manifest_parser.add_argument("root", help="Top directory.")
+    manifest_parser.add_argument("manifest", help="Path of the manifest: .csv for csv, json lines otherwise.")
+    for command_parser in [tree_parser, manifest_parser]:
+        command_parser.add_argument("--max-depth", dest="max_depth", type=int, default=None,
+                                    help="Don't descend into directories deeper than this.")
+        command_parser.add_argument("--exclude", dest="exclude", action="append", default=[],
+                                    help="Glob of relative paths or names to leave out, can be repeated.")
+    diff_parser = subparsers.add_parser("diff", help="Compare two manifests.")
+    diff_parser.add_argument("old", help="Manifest of the old tree.")
+    diff_parser.add_argument("new", help="Manifest of the new tree.")
+    return parser.parse_args()
+
+
+def print_tree(args) -> None:
+    for line in iter_tree_lines(args.root, sort=not args.unsorted, max_depth=args.max_depth, exclude=args.exclude,
+                                sizes=args.sizes):
+        print(line)
+
+
+def print_diff(old: str, new: str) -> bool:
+    counts = {"added": 0, "removed": 0, "changed": 0}
+    size_change = 0
+    for change, path, old_entry, new_entry in diff_tree_manifests(old, new):
+        counts[change] += 1
+        size_change += (new_entry["size"] if new_entry else 0) - (old_entry["size"] if old_entry else 0)
+        if change == "changed":
+            fields = [f"{field}: {old_entry[field]} -> {new_entry[field]}" for field in TREE_MANIFEST_FIELDS
+                      if old_entry[field] != new_entry[field]]
+            print(f"~ {path} ({', '.join(fields)})")
+        else:
+            print(f"{'+' if change == 'added' else '-'} {path}")
+    print_header(f"{counts['added']} added, {counts['removed']} removed, {counts['changed']} changed, "
+                 f"size change: {size_change / 1048576:+.1f}mb")
+    return any(counts.values())
+
+
+if __name__ == "__main__":
+    args = process_args()
+    if args.command == "tree":
+        print_tree(args)
+    elif args.command == "manifest":
+        start = perf_counter()
+        entry_count, total_size = write_tree_manifest(args.root, args.manifest, args.exclude, args.max_depth)
+        print_status(f"Wrote {entry_count} entries ({total_size / 1048576:.0f}mb of files) to {args.manifest} in "
+                     f"{perf_counter() - start:.1f}s")
+    elif print_diff(args.old, args.new):
+        exit(1)  # like diff: 1 if the trees differ